@@ -6,7 +6,6 @@ Dựa trên simple_face_swap.py để tạo web interface
 
 import os
 import cv2
-import insightface
 import numpy as np
 import uuid
 import logging
@@ -14,6 +13,7 @@ from flask import Flask, render_template_string, request, jsonify, send_file, ur
 from werkzeug.utils import secure_filename
 from typing import Any, Optional
 import urllib.request
+from modules.session_factory import FaceAnalysis, get_model
 
 MODEL_PATH = 'models/inswapper_128_fp16.onnx'
 MODEL_URL = 'https://huggingface.co/hacksider/deep-live-cam/resolve/main/inswapper_128_fp16.onnx'
@@ -56,7 +56,7 @@ class SimpleFaceSwap:
         """Lấy face analyser từ insightface"""
         if self.face_analyser is None:
             logger.info("Khởi tạo face analyser...")
-            self.face_analyser = insightface.app.FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
+            self.face_analyser = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
             self.face_analyser.prepare(ctx_id=0, det_size=(640, 640))
         return self.face_analyser
     
@@ -67,7 +67,7 @@ class SimpleFaceSwap:
                 logger.error(f"Model không tồn tại tại: {self.model_path}")
                 return None
             logger.info("Khởi tạo face swapper model...")
-            self.face_swapper = insightface.model_zoo.get_model(
+            self.face_swapper = get_model(
                 self.model_path, providers=['CPUExecutionProvider']
             )
         return self.face_swapper
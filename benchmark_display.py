@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of showing one live preview frame.
+
+Compares the old display path (cvtColor, PIL image, ImageOps.contain with
+LANCZOS and a new CTkImage per frame) with LiveDisplay, which converts into
+a reused buffer and pastes into one reused PhotoImage. Needs a display,
+--no-display measures only the conversion of the frames, without Tk.
+"""
+
+import argparse
+import json
+import sys
+import time
+from typing import Callable, Optional
+
+import customtkinter as ctk
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from modules.live_display import LiveDisplay
+
+RESOLUTIONS = {"720p": (1280, 720), "1080p": (1920, 1080)}
+
+
+def convert_ctk_image(frame: np.ndarray) -> Image.Image:
+    image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    image = Image.fromarray(image)
+    return ImageOps.contain(image, (frame.shape[1], frame.shape[0]), Image.LANCZOS)
+
+
+def show_ctk_image(label: ctk.CTkLabel, frame: np.ndarray) -> None:
+    image = convert_ctk_image(frame)
+    image = ctk.CTkImage(image, size=image.size)
+    label.configure(image=image)
+
+
+def measure(root: Optional[ctk.CTk], show: Callable, frames: list, repeat: int) -> float:
+    for frame in frames[:2]:
+        show(frame)
+        if root:
+            root.update()
+    start = time.perf_counter()
+    for index in range(repeat):
+        show(frames[index % len(frames)])
+        if root:
+            root.update()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def measure_conversion(frames: list, repeat: int) -> dict:
+    ctk_ms = measure(None, convert_ctk_image, frames, repeat)
+    photo_ms = measure(None, LiveDisplay(None).convert, frames, repeat)
+    return {
+        "ctk_image_conversion_ms": round(ctk_ms, 2),
+        "live_display_conversion_ms": round(photo_ms, 2),
+        "speedup": round(ctk_ms / photo_ms, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the live preview display cost per frame")
+    parser.add_argument("--repeat", type=int, default=200, help="frames shown per measurement")
+    parser.add_argument("--no-display", action="store_true", help="only measure the frame conversion, without Tk")
+    args = parser.parse_args()
+
+    if args.no_display:
+        report = {}
+        for name, (width, height) in RESOLUTIONS.items():
+            frames = [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(4)]
+            report[name] = measure_conversion(frames, args.repeat)
+        print(json.dumps(report, indent=2))
+        return
+
+    try:
+        root = ctk.CTk()
+    except Exception as e:
+        print(f"No display available, use --no-display: {e}")
+        sys.exit(1)
+
+    report = {}
+    for name, (width, height) in RESOLUTIONS.items():
+        root.geometry(f"{width}x{height}")
+        frames = [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(4)]
+
+        label = ctk.CTkLabel(root, text=None)
+        label.pack(fill="both", expand=True)
+        ctk_ms = measure(root, lambda frame: show_ctk_image(label, frame), frames, args.repeat)
+        label.destroy()
+
+        label = ctk.CTkLabel(root, text=None)
+        label.pack(fill="both", expand=True)
+        display = LiveDisplay(label)
+        photo_ms = measure(root, display.show, frames, args.repeat)
+        label.destroy()
+
+        report[name] = {
+            "ctk_image_ms": round(ctk_ms, 2),
+            "live_display_ms": round(photo_ms, 2),
+            "speedup": round(ctk_ms / photo_ms, 2),
+        }
+    root.destroy()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Compare face_enhancer (GFPGANv1.4, 512px) with face_enhancer_lite
+(GPEN-BFR-256).
+
+The faces in a directory of sample images are degraded by downscaling and
+JPEG compression, then restored by both processors. Reports the time per
+frame and, against the original images, the PSNR of the face areas and the
+identity similarity of the restored faces.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from typing import Any, List, Tuple
+
+import cv2
+import numpy as np
+
+import modules.globals
+from modules.face_analyser import get_face_analyser, get_many_faces
+from modules.processors.frame import face_enhancer, face_enhancer_lite
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def load_samples(samples_dir: str, limit: int) -> List[Tuple[np.ndarray, List[Any]]]:
+    samples = []
+    for image_path in sorted(glob.glob(os.path.join(glob.escape(samples_dir), "*"))):
+        if not image_path.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        frame = cv2.imread(image_path)
+        if frame is None:
+            continue
+        faces = get_many_faces(frame)
+        if faces:
+            samples.append((frame, faces))
+        if len(samples) >= limit:
+            break
+    return samples
+
+
+def degrade(frame: np.ndarray, scale: float, quality: int) -> np.ndarray:
+    height, width = frame.shape[:2]
+    small = cv2.resize(frame, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    _, encoded = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return cv2.resize(cv2.imdecode(encoded, cv2.IMREAD_COLOR), (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def face_psnr(original: np.ndarray, restored: np.ndarray, faces: List[Any]) -> float:
+    values = []
+    for face in faces:
+        x1, y1, x2, y2 = np.clip(face.bbox.astype(int), 0, None)
+        difference = original[y1:y2, x1:x2].astype(np.float32) - restored[y1:y2, x1:x2].astype(np.float32)
+        mse = max(float(np.mean(difference ** 2)), 1e-10)
+        values.append(10 * np.log10(255.0 ** 2 / mse))
+    return float(np.mean(values))
+
+
+def identity_similarity(original: np.ndarray, restored: np.ndarray, faces: List[Any]) -> float:
+    recognizer = get_face_analyser().models["recognition"]
+    values = []
+    for face in faces:
+        original_embedding = np.array(recognizer.get(original, face), copy=True)
+        restored_embedding = np.array(recognizer.get(restored, face), copy=True)
+        values.append(
+            np.dot(original_embedding, restored_embedding)
+            / (np.linalg.norm(original_embedding) * np.linalg.norm(restored_embedding))
+        )
+    return float(np.mean(values))
+
+
+def evaluate(enhance_face: Any, samples: List[Tuple[np.ndarray, List[Any]]], degraded: List[np.ndarray], repeat: int) -> dict:
+    results = [enhance_face(frame, faces) for frame, (_, faces) in zip(degraded, samples)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for frame, (_, faces) in zip(degraded, samples):
+            enhance_face(frame, faces)
+    elapsed = (time.perf_counter() - start) * 1000 / (repeat * len(samples))
+    return {
+        "ms_per_frame": round(elapsed, 2),
+        "face_psnr": round(float(np.mean([face_psnr(original, result, faces) for (original, faces), result in zip(samples, results)])), 2),
+        "identity_similarity": round(float(np.mean([identity_similarity(original, result, faces) for (original, faces), result in zip(samples, results)])), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare face_enhancer and face_enhancer_lite")
+    parser.add_argument("--samples", required=True, help="directory of sample images with faces")
+    parser.add_argument("--max-images", type=int, default=16, help="number of sample images")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes over the sample images")
+    parser.add_argument("--scale", type=float, default=0.35, help="downscale factor of the degradation")
+    parser.add_argument("--quality", type=int, default=40, help="jpeg quality of the degradation")
+    parser.add_argument("--execution-provider", default="CPUExecutionProvider", help="onnxruntime execution provider")
+    args = parser.parse_args()
+
+    modules.globals.execution_providers = [args.execution_provider]
+    if not face_enhancer.pre_check() or not face_enhancer_lite.pre_check():
+        return
+    samples = load_samples(args.samples, args.max_images)
+    if not samples:
+        print(f"No faces found in {args.samples}")
+        return
+    degraded = [degrade(frame, args.scale, args.quality) for frame, _ in samples]
+
+    report = {
+        "images": len(samples),
+        "faces": sum(len(faces) for _, faces in samples),
+        "degraded": {
+            "face_psnr": round(float(np.mean([face_psnr(original, frame, faces) for (original, faces), frame in zip(samples, degraded)])), 2),
+            "identity_similarity": round(float(np.mean([identity_similarity(original, frame, faces) for (original, faces), frame in zip(samples, degraded)])), 4),
+        },
+        "face_enhancer": evaluate(face_enhancer.enhance_face, samples, degraded, args.repeat),
+        "face_enhancer_lite": evaluate(face_enhancer_lite.enhance_face, samples, degraded, args.repeat),
+    }
+    report["speedup"] = round(report["face_enhancer"]["ms_per_frame"] / report["face_enhancer_lite"]["ms_per_frame"], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark live mode without a camera or a display.
+
+Replays a recorded video in real time through ReplayCapturer and runs it
+through LivePipeline, the same capture, inference and frame processor code
+as the webcam preview. Frames are taken as the preview takes them, so
+frames the pipeline cannot keep up with are dropped as they would be live.
+Reports the achieved frame rate, dropped frames and glass-to-glass latency
+percentiles as JSON.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import cv2
+
+import modules.globals
+from modules.live import LivePipeline, LiveStats, draw_live_stats
+from modules.live_io import ReplayCapturer, parse_size
+from modules.processors.frame.core import get_frame_processors_modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark live mode against a recorded video")
+    parser.add_argument("--video", required=True, help="recorded video replayed at its frame rate")
+    parser.add_argument("--source", required=True, help="source face image")
+    parser.add_argument("--frame-processor", nargs="+", default=["face_swapper"], choices=["face_swapper", "face_enhancer", "face_enhancer_lite"], help="frame processors")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run, the video loops")
+    parser.add_argument("--preview-size", default="960x540", help="WIDTHxHEIGHT frames are fitted to, as in the preview window")
+    parser.add_argument("--workers", type=int, default=1, help="inference threads")
+    parser.add_argument("--target-fps", type=float, default=None, help="frame rate the latency governor holds")
+    parser.add_argument("--many-faces", action="store_true", help="process every face")
+    parser.add_argument("--mouth-mask", action="store_true", help="mask the mouth region")
+    parser.add_argument("--execution-provider", default="CPUExecutionProvider", help="onnxruntime execution provider")
+    args = parser.parse_args()
+
+    modules.globals.source_path = args.source
+    modules.globals.frame_processors = args.frame_processor
+    modules.globals.fp_ui["face_enhancer"] = "face_enhancer" in args.frame_processor
+    modules.globals.many_faces = args.many_faces
+    modules.globals.mouth_mask = args.mouth_mask
+    modules.globals.live_target_fps = args.target_fps
+    modules.globals.execution_providers = [args.execution_provider]
+    modules.globals.headless = True
+
+    frame_processors = get_frame_processors_modules(args.frame_processor)
+    for frame_processor in frame_processors:
+        if not frame_processor.pre_check():
+            sys.exit(1)
+    capturer = ReplayCapturer(args.video, loop=True)
+    if not capturer.isOpened():
+        print(f"Failed to open {args.video}")
+        sys.exit(1)
+
+    pipeline = LivePipeline(capturer, frame_processors, args.workers)
+    pipeline.frame_size = parse_size(args.preview_size)
+    # latencies of the whole run, not only the recent ones
+    pipeline.stats = LiveStats(window=None)
+    # the source face and the models load before the clock starts
+    warmup_capture = cv2.VideoCapture(args.video)
+    pipeline.process(warmup_capture.read()[1])
+    warmup_capture.release()
+
+    pipeline.start()
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.duration:
+        result = pipeline.processed.get(timeout=0.1)
+        if result is None:
+            if not pipeline.running:
+                break
+            continue
+        capture_time, temp_frame = result[1:]
+        draw_live_stats(temp_frame, pipeline.stats, pipeline.governor)
+        pipeline.stats.record(capture_time)
+    elapsed = time.perf_counter() - start
+    pipeline.stop()
+    capturer.release()
+
+    captured = capturer.frame_number + 1
+    report = {
+        "video_fps": round(capturer.fps, 2),
+        "duration": round(elapsed, 2),
+        "frames_offered": captured,
+        "frames_shown": pipeline.stats.frames,
+        "frames_dropped": captured - pipeline.stats.frames,
+        "fps": round(pipeline.stats.frames / elapsed, 2),
+        "latency_p50_ms": round(pipeline.stats.get_latency(50), 1),
+        "latency_p95_ms": round(pipeline.stats.get_latency(95), 1),
+        "latency_p99_ms": round(pipeline.stats.get_latency(99), 1),
+    }
+    if pipeline.governor:
+        report["quality"] = pipeline.governor.get_quality()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
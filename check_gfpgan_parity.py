@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Compare the onnx and torch face enhancer backends.
+
+Aligns the faces found in a directory of sample images, runs them through
+both backends with the same fixed noise and reports the pixel difference of
+the restored crops, the agreement of the face parsing labels and the speed
+of each backend. Exits with status 1 when the crops fall below --min-psnr.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from typing import Any, List
+
+import cv2
+import numpy as np
+
+import modules.globals
+from modules.face_analyser import get_many_faces
+from modules.processors.frame.face_enhancer import (
+    OnnxFaceEnhancer,
+    TorchFaceEnhancer,
+    align_face,
+)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def load_cropped_faces(samples_dir: str, limit: int) -> List[np.ndarray]:
+    cropped_faces = []
+    for image_path in sorted(glob.glob(os.path.join(glob.escape(samples_dir), "*"))):
+        if not image_path.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        frame = cv2.imread(image_path)
+        if frame is None:
+            continue
+        for face in get_many_faces(frame) or []:
+            cropped_face, _ = align_face(frame, face)
+            if cropped_face is not None:
+                cropped_faces.append(cropped_face)
+            if len(cropped_faces) >= limit:
+                return cropped_faces
+    return cropped_faces
+
+
+def run_backend(face_enhancer: Any, cropped_faces: np.ndarray, batch_size: int) -> Any:
+    restored_faces = []
+    parsings = []
+    start = time.perf_counter()
+    for index in range(0, len(cropped_faces), batch_size):
+        batch = cropped_faces[index:index + batch_size]
+        restored = face_enhancer.restore(batch, randomize_noise=False)
+        restored_faces.append(restored)
+        parsings.append(face_enhancer.parse(restored))
+    elapsed = (time.perf_counter() - start) * 1000 / len(cropped_faces)
+    return np.concatenate(restored_faces), np.concatenate(parsings), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the onnx and torch face enhancer backends")
+    parser.add_argument("--samples", required=True, help="directory of sample images with faces")
+    parser.add_argument("--max-faces", type=int, default=16, help="number of sample faces to compare")
+    parser.add_argument("--batch-size", type=int, default=2, help="faces per restore call, torch runs them as one batch, onnx one at a time")
+    parser.add_argument("--execution-provider", default="CPUExecutionProvider", help="onnxruntime execution provider")
+    parser.add_argument("--min-psnr", type=float, default=40.0, help="lowest acceptable psnr of the onnx crops against torch")
+    args = parser.parse_args()
+
+    modules.globals.execution_providers = [args.execution_provider]
+    cropped_faces = load_cropped_faces(args.samples, args.max_faces)
+    if not cropped_faces:
+        print(f"No faces found in {args.samples}")
+        sys.exit(1)
+    cropped_faces = np.stack(cropped_faces)
+
+    torch_faces, torch_parsing, torch_ms = run_backend(TorchFaceEnhancer(), cropped_faces, args.batch_size)
+    onnx_faces, onnx_parsing, onnx_ms = run_backend(OnnxFaceEnhancer(), cropped_faces, args.batch_size)
+
+    difference = np.abs(torch_faces.astype(np.float32) - onnx_faces.astype(np.float32))
+    mse = np.mean(difference ** 2, axis=(1, 2, 3))
+    psnr = 10 * np.log10(255.0 ** 2 / np.maximum(mse, 1e-10))
+    report = {
+        "faces": len(cropped_faces),
+        "batch_size": args.batch_size,
+        "torch_ms": round(torch_ms, 2),
+        "onnx_ms": round(onnx_ms, 2),
+        "speedup": round(torch_ms / onnx_ms, 2),
+        "max_abs_difference": int(difference.max()),
+        "mean_abs_difference": round(float(difference.mean()), 4),
+        "psnr_min": round(float(psnr.min()), 2),
+        "psnr_mean": round(float(psnr.mean()), 2),
+        "parsing_agreement": round(float(np.mean(torch_parsing == onnx_parsing)), 5),
+    }
+    print(json.dumps(report, indent=2))
+    if report["psnr_min"] < args.min_psnr:
+        print(f"Parity check failed: psnr {report['psnr_min']} below {args.min_psnr}")
+        sys.exit(1)
+    print("Parity check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Export GFPGANv1.4 and the facexlib face parser to ONNX.
+
+Writes models/GFPGANv1.4.onnx and models/parsing_parsenet.onnx, which the
+face enhancer runs through onnxruntime instead of torch. Both graphs take
+1x3x512x512 rgb input normalised to [-1, 1], one face per run: the
+generator's modulated convolutions group by the batch size, which tracing
+fixes at the size of the example input. The generator is exported with the
+fixed noise maps of the model, random noise is not part of the graph. Run check_gfpgan_parity.py afterwards to compare
+the exported models against torch.
+"""
+
+import argparse
+import os
+
+import torch
+from gfpgan import GFPGANer
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
+
+class GeneratorExport(torch.nn.Module):
+    def __init__(self, generator: torch.nn.Module):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.generator(x, return_rgb=False, randomize_noise=False)[0]
+
+
+class ParserExport(torch.nn.Module):
+    def __init__(self, parser: torch.nn.Module):
+        super().__init__()
+        self.parser = parser
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.parser(x)[0]
+
+
+def export(module: torch.nn.Module, output_path: str, opset: int) -> None:
+    dummy_input = torch.randn(1, 3, 512, 512)
+    torch.onnx.export(
+        module.eval(),
+        dummy_input,
+        output_path,
+        input_names=["input"],
+        output_names=["output"],
+        opset_version=opset,
+        do_constant_folding=True,
+    )
+    print(f"Saved {output_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export GFPGANv1.4 and its face parser to ONNX")
+    parser.add_argument("--model", default=os.path.join(MODELS_DIR, "GFPGANv1.4.pth"), help="GFPGANv1.4 weights")
+    parser.add_argument("--output-dir", default=MODELS_DIR, help="directory for the onnx models")
+    parser.add_argument("--opset", type=int, default=17, help="onnx opset version")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.model):
+        print(f"GFPGAN model not found: {args.model}")
+        return
+
+    gfpganer = GFPGANer(model_path=args.model, upscale=1, device=torch.device("cpu"))
+    os.makedirs(args.output_dir, exist_ok=True)
+    with torch.no_grad():
+        export(GeneratorExport(gfpganer.gfpgan), os.path.join(args.output_dir, "GFPGANv1.4.onnx"), args.opset)
+        export(ParserExport(gfpganer.face_helper.face_parse), os.path.join(args.output_dir, "parsing_parsenet.onnx"), args.opset)
+
+
+if __name__ == "__main__":
+    main()
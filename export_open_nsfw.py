@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Convert the OpenNSFW2 keras model to ONNX.
+
+Writes models/open_nsfw.onnx, which modules.predicter runs through
+onnxruntime instead of tensorflow. The graph takes Nx224x224x3 frames
+preprocessed like opennsfw2 Preprocessing.YAHOO and returns the
+[sfw, nsfw] probabilities. Compares both models on random input afterwards.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import onnxruntime
+import opennsfw2
+import tensorflow as tf
+import tf2onnx
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the OpenNSFW2 model to ONNX")
+    parser.add_argument("--output", default=os.path.join(MODELS_DIR, "open_nsfw.onnx"), help="onnx model path")
+    parser.add_argument("--opset", type=int, default=17, help="onnx opset version")
+    args = parser.parse_args()
+
+    model = opennsfw2.make_open_nsfw_model()
+    input_signature = [tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input")]
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=args.opset, output_path=args.output)
+    print(f"Saved {args.output}")
+
+    views = np.random.default_rng(0).uniform(-123, 151, (4, 224, 224, 3)).astype(np.float32)
+    session = onnxruntime.InferenceSession(args.output, providers=["CPUExecutionProvider"])
+    onnx_probabilities = session.run(None, {session.get_inputs()[0].name: views})[0]
+    keras_probabilities = model.predict(views, verbose=0)
+    print(f"Max probability difference: {np.abs(onnx_probabilities - keras_probabilities).max():.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import glob
+import os
+import platform
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+import cv2
+
+if platform.system() == "Windows":
+    import comtypes
+    from pygrabber.dshow_graph import FilterGraph
+
+SYSFS_VIDEO4LINUX = "/sys/class/video4linux"
+# seconds the parallel camera probes get in total
+PROBE_TIMEOUT = 2.0
+
+CAMERA_CACHE = None
+CAMERA_CACHE_SIGNATURE = None
+THREAD_LOCK = threading.Lock()
+
+
+def read_sysfs(device_dir: str, attribute: str) -> Optional[str]:
+    try:
+        with open(os.path.join(device_dir, attribute), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def list_video_devices() -> List[Tuple[int, str]]:
+    """Capture nodes under /dev/video*, with their names from sysfs."""
+    devices = []
+    for device_path in glob.glob("/dev/video*"):
+        suffix = device_path[len("/dev/video"):]
+        if not suffix.isdigit():
+            continue
+        index = int(suffix)
+        device_dir = os.path.join(SYSFS_VIDEO4LINUX, f"video{index}")
+        # cameras add nodes for metadata next to the capture node, which is index 0
+        if read_sysfs(device_dir, "index") not in (None, "0"):
+            continue
+        devices.append((index, read_sysfs(device_dir, "name") or f"Camera {index}"))
+    return sorted(devices)
+
+
+def get_devices_signature() -> Tuple:
+    """Changes whenever a video device is added, removed or replaced."""
+    signature = []
+    for device_path in sorted(glob.glob("/dev/video*")):
+        try:
+            stat = os.stat(device_path)
+        except OSError:
+            continue
+        signature.append((device_path, stat.st_rdev, stat.st_ctime_ns))
+    return tuple(signature)
+
+
+def probe_cameras(indices: List[int], backend: int = cv2.CAP_ANY, timeout: float = PROBE_TIMEOUT) -> dict:
+    """
+    Opens all cameras at once. Returns whether each opened; cameras that did
+    not answer within timeout are left out, their probe finishes unseen.
+    """
+    results = {}
+
+    def probe(index: int) -> None:
+        results[index] = probe_camera(index, backend)
+
+    threads = [threading.Thread(target=probe, args=(index,), daemon=True) for index in indices]
+    for thread in threads:
+        thread.start()
+    deadline = time.perf_counter() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.perf_counter()))
+    return dict(results)
+
+
+def probe_camera(index: int, backend: int = cv2.CAP_ANY) -> bool:
+    cap = cv2.VideoCapture(index, backend)
+    opened = cap.isOpened()
+    cap.release()
+    return opened
+
+
+def get_directshow_devices() -> List[str]:
+    """Camera names from DirectShow, needs COM set up on the calling thread."""
+    try:
+        return FilterGraph().get_input_devices()
+    except Exception as e:
+        print(f"Error detecting cameras: {str(e)}")
+        return []
+
+
+def find_windows_cameras(devices: List[str]) -> Tuple[List[int], List[str]]:
+    if devices:
+        return list(range(len(devices))), devices
+
+    # If no cameras found through DirectShow, try OpenCV fallback
+    # Try to open camera with index -1 and 0
+    test_indices = [-1, 0]
+    opened = probe_cameras(test_indices)
+    working_cameras = [f"Camera {idx}" for idx in test_indices if opened.get(idx)]
+    return test_indices[: len(working_cameras)], working_cameras
+
+
+def find_macos_cameras(first_camera_opened: bool) -> Tuple[List[int], List[str]]:
+    # The default FaceTime camera is 0, additional cameras typically use 1 and 2
+    opened = probe_cameras([1, 2])
+    opened[0] = first_camera_opened
+    camera_indices = [index for index in (0, 1, 2) if opened.get(index)]
+    camera_names = ["FaceTime Camera" if index == 0 else f"Camera {index}" for index in camera_indices]
+    return camera_indices, camera_names
+
+
+def find_cameras() -> Tuple[List[int], List[str]]:
+    if platform.system() == "Windows":
+        return find_windows_cameras(get_directshow_devices())
+
+    if platform.system() == "Darwin":  # macOS specific handling
+        return find_macos_cameras(probe_camera(0))
+
+    # Linux: the devices are known from /dev and sysfs, the probes only weed
+    # out nodes that cannot capture. A camera whose probe hangs is kept.
+    devices = list_video_devices()
+    opened = probe_cameras([index for index, _ in devices], cv2.CAP_V4L2)
+    devices = [(index, name) for index, name in devices if opened.get(index, True)]
+    names = [name for _, name in devices]
+    # the menu picks cameras by name, identical models need telling apart
+    names = [f"{name} ({index})" if names.count(name) > 1 else name for (index, _), name in zip(devices, names)]
+    return [index for index, _ in devices], names
+
+
+def get_available_cameras(refresh: bool = False, find: Callable[[], Tuple[List[int], List[str]]] = find_cameras, signature: Optional[Tuple] = None) -> Tuple[List[int], List[str]]:
+    """
+    Camera indices and names. The result is cached until the devices change,
+    or refresh asks to search again: on Linux the devices under /dev/video*,
+    on Windows the DirectShow device list, which signature can hand in when
+    it was read on another thread. macOS has no device list to compare with,
+    every call searches again.
+    """
+    global CAMERA_CACHE, CAMERA_CACHE_SIGNATURE
+
+    with THREAD_LOCK:
+        if platform.system() == "Darwin":
+            return find()
+        if signature is None:
+            if platform.system() == "Windows":
+                signature = tuple(get_directshow_devices())
+            else:
+                signature = get_devices_signature()
+        if refresh or CAMERA_CACHE is None or signature != CAMERA_CACHE_SIGNATURE:
+            CAMERA_CACHE = find()
+            CAMERA_CACHE_SIGNATURE = signature
+        return CAMERA_CACHE
+
+
+def discover_cameras(refresh: bool = False) -> Future:
+    """
+    get_available_cameras on a background thread, the future holds its
+    result. Call it from the ui thread: what has to run there does before it
+    returns. On Windows that is the DirectShow device list, which is quick
+    and uses the COM apartment comtypes set up on the importing thread. On
+    macOS it is the probe of the first camera, as OpenCV only asks for camera
+    permission on the main thread.
+    """
+    future = Future()
+    find = find_cameras
+    signature = None
+    if platform.system() == "Windows":
+        devices = get_directshow_devices()
+        find = lambda: find_windows_cameras(devices)
+        signature = tuple(devices)
+    elif platform.system() == "Darwin":
+        first_camera_opened = probe_camera(0)
+        find = lambda: find_macos_cameras(first_camera_opened)
+
+    def discover() -> None:
+        # COM is set up per thread, DirectShow calls made from here need their own
+        if platform.system() == "Windows":
+            comtypes.CoInitialize()
+        try:
+            future.set_result(get_available_cameras(refresh, find, signature))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            if platform.system() == "Windows":
+                comtypes.CoUninitialize()
+
+    threading.Thread(target=discover, daemon=True).start()
+    return future
@@ -1,24 +1,78 @@
 import numpy as np
-from sklearn.cluster import KMeans
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import pdist, squareform
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.metrics import silhouette_score
-from typing import Any
+from typing import Any, List, Tuple
 
+# embeddings the number of identities is chosen on, the full set is only
+# used to refine the centroids
+CLUSTER_SAMPLE_SIZE = 2000
+# average cosine distance below which everything is taken as one identity
+SINGLE_IDENTITY_DISTANCE = 0.6
+MAX_IDENTITIES = 64
+# cosine similarity above which two sampled embeddings count as the same shot
+NEAR_DUPLICATE_SIMILARITY = 0.99
 
-def find_cluster_centroids(embeddings, max_k=10) -> Any:
-    inertia = []
-    cluster_centroids = []
-    K = range(1, max_k+1)
 
-    for k in K:
-        kmeans = KMeans(n_clusters=k, random_state=0)
+def find_cluster_centroids(embeddings, max_k=MAX_IDENTITIES) -> Any:
+    """
+    Cluster face embeddings into identities and return the normalised
+    centroids. A seeded sample of the embeddings is clustered with average
+    linkage on cosine distance and the number of identities picked by the
+    silhouette score of each cut of that tree. The centroids are then refined
+    with mini-batch k-means over all embeddings.
+    """
+    embeddings = normalize_embeddings(embeddings)
+    if len(embeddings) < 2:
+        return embeddings
+
+    sample = embeddings
+    if len(embeddings) > CLUSTER_SAMPLE_SIZE:
+        rng = np.random.default_rng(0)
+        sample = embeddings[rng.choice(len(embeddings), CLUSTER_SAMPLE_SIZE, replace=False)]
+    # consecutive frames give near identical embeddings, they add cost but
+    # no information to the tree
+    sample = drop_near_duplicates(sample)
+    if len(sample) < 2:
+        return normalize_embeddings(sample)
+
+    distances = pdist(sample, metric="cosine")
+    tree = linkage(distances, method="average")
+    labels = np.zeros(len(sample), dtype=int)
+    if tree[-1, 2] >= SINGLE_IDENTITY_DISTANCE:
+        distance_matrix = squareform(distances)
+        best_score = -1.0
+        for k in range(2, min(max_k, len(sample) - 1) + 1):
+            k_labels = fcluster(tree, k, criterion="maxclust") - 1
+            if len(np.unique(k_labels)) < 2:
+                continue
+            score = silhouette_score(distance_matrix, k_labels, metric="precomputed")
+            if score > best_score:
+                best_score = score
+                labels = k_labels
+
+    k = labels.max() + 1
+    centroids = normalize_embeddings(
+        np.stack([sample[labels == label].mean(axis=0) for label in range(k)])
+    )
+    if k > 1:
+        kmeans = MiniBatchKMeans(
+            n_clusters=k, init=centroids, n_init=1, batch_size=4096, random_state=0
+        )
         kmeans.fit(embeddings)
-        inertia.append(kmeans.inertia_)
-        cluster_centroids.append({"k": k, "centroids": kmeans.cluster_centers_})
+        centroids = normalize_embeddings(kmeans.cluster_centers_)
+    return centroids
 
-    diffs = [inertia[i] - inertia[i+1] for i in range(len(inertia)-1)]
-    optimal_centroids = cluster_centroids[diffs.index(max(diffs)) + 1]['centroids']
+def drop_near_duplicates(embeddings: np.ndarray, threshold: float = NEAR_DUPLICATE_SIMILARITY) -> np.ndarray:
+    """Keep the first of every group of normalised embeddings whose cosine similarity exceeds threshold."""
+    kept = np.zeros(len(embeddings), dtype=bool)
+    for index, embedding in enumerate(embeddings):
+        if not np.any(embeddings[kept] @ embedding > threshold):
+            kept[index] = True
+    return embeddings[kept]
 
-    return optimal_centroids
 
 def find_closest_centroid(centroids: list, normed_face_embedding) -> list:
     try:
@@ -29,4 +83,237 @@ def find_closest_centroid(centroids: list, normed_face_embedding) -> list:
         
         return closest_centroid_index, centroids[closest_centroid_index]
     except ValueError:
-        return None
\ No newline at end of file
+        return None
+
+
+def find_closest_centroids(centroids: Any, normed_face_embeddings: Any) -> np.ndarray:
+    """find_closest_centroid for many faces, one matrix product for all."""
+    centroid_matrix = np.asarray(centroids, dtype=np.float32)
+    embeddings = np.asarray(normed_face_embeddings, dtype=np.float32)
+    if len(embeddings) == 0 or len(centroid_matrix) == 0:
+        return np.zeros(len(embeddings), dtype=int)
+    return np.argmax(embeddings @ centroid_matrix.T, axis=1)
+
+
+def normalize_embeddings(embeddings: Any) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.size == 0:
+        return embeddings.reshape(0, 0)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def assign_faces_to_centroids(centroid_matrix: np.ndarray, normed_face_embeddings: Any, threshold: float = -1.0) -> List[Tuple[int, int]]:
+    """
+    One-to-one assignment of faces to centroids maximising the total cosine
+    similarity. Pairs below threshold are left unmatched.
+    Returns a list of (face_index, centroid_index).
+    """
+    if len(normed_face_embeddings) == 0 or len(centroid_matrix) == 0:
+        return []
+    similarities = np.asarray(normed_face_embeddings, dtype=np.float32) @ centroid_matrix.T
+    face_indices, centroid_indices = linear_sum_assignment(similarities, maximize=True)
+    matched = similarities[face_indices, centroid_indices] >= threshold
+    return list(zip(face_indices[matched].tolist(), centroid_indices[matched].tolist()))
+
+
+class OnlineIdentityClusterer:
+    """
+    Identity clustering while frames are still being analysed. Embeddings
+    join the most similar prototype above threshold or start a new one.
+    Every refine_interval embeddings prototypes that describe the same
+    identity are merged and prototypes holding two identities are split.
+    Memory is bounded by the number of prototypes: each keeps the sum of its
+    embeddings and a fixed size reservoir sample of them, together with the
+    member given for each, for the splits and the final identities.
+    Prototype labels stay valid across refines, a merged label points to the
+    one it was merged into and after a split the half nearer the old
+    prototype keeps its label.
+    """
+
+    def __init__(self, threshold: float = 0.4, merge_threshold: float = 0.55, refine_interval: int = 256, reservoir_size: int = 64):
+        self.threshold = threshold
+        self.merge_threshold = merge_threshold
+        self.refine_interval = refine_interval
+        self.reservoir_size = reservoir_size
+        self.sums = None
+        self.centroids = None
+        self.counts = []
+        self.reservoirs = []
+        self.members = []
+        self.prototype_labels = []
+        self.merged_labels = {}
+        self.next_label = 0
+        self.seen = 0
+        self.rng = np.random.default_rng(0)
+
+    def add(self, normed_face_embeddings: Any, members: List[Any] = None) -> bool:
+        """
+        Add the embeddings of one frame, members holds what to return for
+        each of them from get_identities. True when prototypes were refined.
+        """
+        refined = False
+        embeddings = normalize_embeddings(normed_face_embeddings)
+        if members is None:
+            members = [None] * len(embeddings)
+        for embedding, member in zip(embeddings, members):
+            if self.sums is None:
+                self.sums = np.zeros((0, len(embedding)), dtype=np.float32)
+                self.centroids = self.sums.copy()
+            index = -1
+            if len(self.centroids):
+                similarities = self.centroids @ embedding
+                index = int(np.argmax(similarities))
+                if similarities[index] < self.threshold:
+                    index = -1
+            if index < 0:
+                self.add_prototype(embedding[None], 1, [embedding], [member])
+            else:
+                self.sums[index] += embedding
+                self.centroids[index] = normalize_embeddings(self.sums[index])
+                self.counts[index] += 1
+                self.add_to_reservoir(index, embedding, member)
+            self.seen += 1
+
+            if self.seen % self.refine_interval == 0:
+                self.refine()
+                refined = True
+        return refined
+
+    def add_prototype(self, embeddings: np.ndarray, count: int, reservoir: List[np.ndarray], members: List[Any], label: int = None) -> int:
+        if label is None:
+            label = self.next_label
+            self.next_label += 1
+        embedding_sum = embeddings.mean(axis=0) * count
+        self.sums = np.vstack([self.sums, embedding_sum[None]])
+        self.centroids = np.vstack([self.centroids, normalize_embeddings(embedding_sum)[None]])
+        self.counts.append(count)
+        self.reservoirs.append(list(reservoir))
+        self.members.append(list(members))
+        self.prototype_labels.append(label)
+        return label
+
+    def add_to_reservoir(self, index: int, embedding: np.ndarray, member: Any) -> None:
+        reservoir = self.reservoirs[index]
+        if len(reservoir) < self.reservoir_size:
+            reservoir.append(embedding)
+            self.members[index].append(member)
+            return
+        slot = self.rng.integers(0, self.counts[index])
+        if slot < self.reservoir_size:
+            reservoir[slot] = embedding
+            self.members[index][slot] = member
+
+    def remove_prototype(self, index: int) -> None:
+        self.sums = np.delete(self.sums, index, axis=0)
+        self.centroids = np.delete(self.centroids, index, axis=0)
+        del self.counts[index]
+        del self.reservoirs[index]
+        del self.members[index]
+        del self.prototype_labels[index]
+
+    def refine(self) -> None:
+        self.merge()
+        self.split()
+
+    def merge(self) -> None:
+        while len(self.centroids) > 1:
+            similarities = self.centroids @ self.centroids.T
+            np.fill_diagonal(similarities, -1)
+            first, second = np.unravel_index(np.argmax(similarities), similarities.shape)
+            if similarities[first, second] < self.merge_threshold:
+                return
+            first, second = min(first, second), max(first, second)
+            self.sums[first] += self.sums[second]
+            self.centroids[first] = normalize_embeddings(self.sums[first])
+            count = self.counts[first] + self.counts[second]
+            # keep the merged reservoir proportional to the two prototypes
+            reservoir = self.reservoirs[first] + self.reservoirs[second]
+            members = self.members[first] + self.members[second]
+            weights = np.array(
+                [self.counts[first] / len(self.reservoirs[first])] * len(self.reservoirs[first])
+                + [self.counts[second] / len(self.reservoirs[second])] * len(self.reservoirs[second])
+            )
+            if len(reservoir) > self.reservoir_size:
+                keep = self.rng.choice(len(reservoir), self.reservoir_size, replace=False, p=weights / weights.sum())
+                reservoir = [reservoir[index] for index in keep]
+                members = [members[index] for index in keep]
+            self.counts[first] = count
+            self.reservoirs[first] = reservoir
+            self.members[first] = members
+            self.merged_labels[self.prototype_labels[second]] = self.prototype_labels[first]
+            self.remove_prototype(second)
+
+    def split(self) -> None:
+        for index in range(len(self.centroids) - 1, -1, -1):
+            reservoir = np.array(self.reservoirs[index])
+            if len(reservoir) < self.reservoir_size // 2:
+                continue
+            labels = split_in_two(reservoir)
+            if labels is None:
+                continue
+            first, second = reservoir[labels == 0], reservoir[labels == 1]
+            first_centroid = normalize_embeddings(first.mean(axis=0))
+            second_centroid = normalize_embeddings(second.mean(axis=0))
+            if float(first_centroid @ second_centroid) >= self.threshold:
+                continue
+            halves = [0, 1]
+            if float(second_centroid @ self.centroids[index]) > float(first_centroid @ self.centroids[index]):
+                first, second = second, first
+                halves = [1, 0]
+            members = self.members[index]
+            first_members = [member for member, half in zip(members, labels) if half == halves[0]]
+            second_members = [member for member, half in zip(members, labels) if half == halves[1]]
+            count = self.counts[index]
+            label = self.prototype_labels[index]
+            first_count = max(1, round(count * len(first) / len(reservoir)))
+            self.remove_prototype(index)
+            self.add_prototype(first, first_count, first, first_members, label)
+            self.add_prototype(second, max(1, count - first_count), second, second_members)
+
+    def resolve_label(self, label: int) -> int:
+        while label in self.merged_labels:
+            label = self.merged_labels[label]
+        return label
+
+    def get_identities(self, min_count: int = 3) -> Tuple[np.ndarray, List[int], List[List[Any]]]:
+        """
+        The prototypes as they are now, the label of each and the members of
+        all reservoirs nearest to each. Prototypes with fewer than min_count
+        faces are dropped. Members are matched to the prototypes again rather
+        than taken from the reservoir they were sampled into, members sampled
+        before a split go with the half they belong to.
+        """
+        if self.sums is None:
+            return np.zeros((0, 0), dtype=np.float32), [], []
+        keep = np.array(self.counts) >= min_count
+        if not keep.any():
+            keep[:] = True
+        centroids = self.centroids[keep]
+        labels = [label for label, kept in zip(self.prototype_labels, keep) if kept]
+        identity_members = [[] for _ in range(len(centroids))]
+        reservoir = np.concatenate([np.array(reservoir) for reservoir in self.reservoirs])
+        members = [member for prototype_members in self.members for member in prototype_members]
+        for member, identity in zip(members, find_closest_centroids(centroids, reservoir)):
+            identity_members[identity].append(member)
+        return centroids, labels, identity_members
+
+
+def split_in_two(members: np.ndarray, min_fraction: float = 0.25) -> Any:
+    """Spherical 2-means, None unless both halves hold min_fraction."""
+    similarities = members @ members.T
+    first, second = np.unravel_index(np.argmin(similarities), similarities.shape)
+    centroids = members[[first, second]]
+    labels = None
+    for _ in range(10):
+        new_labels = np.argmax(members @ centroids.T, axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        if labels.min() == labels.max():
+            return None
+        centroids = normalize_embeddings(np.stack([members[labels == 0].mean(axis=0), members[labels == 1].mean(axis=0)]))
+    if min(np.mean(labels == 0), np.mean(labels == 1)) < min_fraction:
+        return None
+    return labels
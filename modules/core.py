@@ -11,13 +11,19 @@ import platform
 import signal
 import shutil
 import argparse
+import time
 import torch
 import onnxruntime
-import tensorflow
 
 import modules.globals
 import modules.metadata
 import modules.ui as ui
+from modules.face_analyser import get_unique_faces_from_target_image, get_unique_faces_from_target_video
+from modules.identity_gallery import fill_map_from_gallery
+from modules.live import LivePipeline, draw_live_stats
+from modules.live_io import create_capturer, create_sink, parse_size
+from modules.live_streams import MultiStreamEngine, load_streams, release_streams
+from modules.predicter import FrameGate
 from modules.processors.frame.core import get_frame_processors_modules
 from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
 
@@ -27,6 +33,9 @@ if 'ROCMExecutionProvider' in modules.globals.execution_providers:
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
 
+# seconds between headless live status reports
+LIVE_REPORT_INTERVAL = 5
+
 
 def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
@@ -34,22 +43,38 @@ def parse_args() -> None:
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
     program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
-    program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer'], nargs='+')
+    program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer', 'face_enhancer_lite'], nargs='+')
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=False)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
+    program.add_argument('--swap-interval', help='run the face swapper on every n-th frame and carry the swapped faces over the frames in between', dest='swap_interval', type=int, default=1)
+    program.add_argument('--frame-reuse-tolerance', help='reuse the previous result for duplicate or static frames within this fingerprint difference (0 disables)', dest='frame_reuse_tolerance', type=float, default=2.0)
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
     program.add_argument('--nsfw-filter', help='filter the NSFW image or video', dest='nsfw_filter', action='store_true', default=False)
     program.add_argument('--map-faces', help='map source target faces', dest='map_faces', action='store_true', default=False)
+    program.add_argument('--map-faces-clustering', help='cluster map-faces identities after analysing the video (batch) or while analysing it (online)', dest='map_faces_clustering', default='batch', choices=['batch', 'online'])
+    program.add_argument('--map-faces-threshold', help='minimum similarity for a live face to match a mapped target', dest='map_faces_threshold', type=float, default=0.2)
+    program.add_argument('--identity-gallery', help='directory of known identities, map-faces fills in their sources and remembers new mappings; without the ui only known identities are swapped', dest='identity_gallery', default=None)
     program.add_argument('--mouth-mask', help='mask the mouth region', dest='mouth_mask', action='store_true', default=False)
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
     program.add_argument('--video-quality', help='adjust output video quality', dest='video_quality', type=int, default=18, choices=range(52), metavar='[0-51]')
     program.add_argument('-l', '--lang', help='Ui language', default="en")
     program.add_argument('--live-mirror', help='The live camera display as you see it in the front-facing camera frame', dest='live_mirror', action='store_true', default=False)
     program.add_argument('--live-resizable', help='The live camera frame is resizable', dest='live_resizable', action='store_true', default=False)
+    program.add_argument('--live-workers', help='number of inference threads processing live camera frames', dest='live_workers', type=int, default=1)
+    program.add_argument('--live-target-fps', help='frame rate live mode holds by lowering detection, tracking, enhancer, mouth mask and resolution quality as needed', dest='live_target_fps', type=float, default=None)
+    program.add_argument('--live', help='run live mode headless from a camera index, a video file or url, or - for raw bgr24 frames on stdin', dest='live_source', default=None)
+    program.add_argument('--live-size', help='WIDTHxHEIGHT of raw stdin frames and of the camera capture', dest='live_size', default=None)
+    program.add_argument('--live-sink', help='where headless live frames go: raw bgr24 on stdout, mjpeg over http or a shared memory ring', dest='live_sink', default='mjpeg', choices=['stdout', 'mjpeg', 'shm'])
+    program.add_argument('--live-sink-address', help='host:port of the mjpeg sink (default 127.0.0.1:8080) or name of the shared memory ring (default deep-live-cam)', dest='live_sink_address', default=None)
+    program.add_argument('--live-streams', help='json file of several live streams served together, each with its own input, source face or mapping and sink', dest='live_streams', default=None)
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
+    program.add_argument('--swapper-precision', help='face swapper model variant, auto picks fp16 on gpu providers and int8 (if quantized) or fp32 on cpu', dest='swapper_precision', default='auto', choices=['auto', 'fp32', 'fp16', 'int8'])
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--enhancer-replicas', help='number of face enhancer model replicas running in parallel (default: one per execution thread on cpu, one on gpu, bounded by --max-memory)', dest='enhancer_replicas', type=int, default=None)
+    program.add_argument('--enhancer-backend', help='face enhancer backend, auto uses onnx when export_gfpgan.py has been run', dest='enhancer_backend', default='auto', choices=['auto', 'onnx', 'torch'])
+    program.add_argument('--enhancer-batch-size', help='faces enhanced per model run across faces and frames (default: 8 on gpu, 1 on cpu, bounded by memory)', dest='enhancer_batch_size', type=int, default=None)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     # register deprecated args
@@ -64,21 +89,37 @@ def parse_args() -> None:
     modules.globals.target_path = args.target_path
     modules.globals.output_path = normalize_output_path(modules.globals.source_path, modules.globals.target_path, args.output_path)
     modules.globals.frame_processors = args.frame_processor
-    modules.globals.headless = args.source_path or args.target_path or args.output_path
+    modules.globals.headless = args.source_path or args.target_path or args.output_path or args.live_source is not None or args.live_streams is not None
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
+    modules.globals.frame_reuse_tolerance = args.frame_reuse_tolerance
+    modules.globals.swap_interval = args.swap_interval
     modules.globals.many_faces = args.many_faces
     modules.globals.mouth_mask = args.mouth_mask
     modules.globals.nsfw_filter = args.nsfw_filter
     modules.globals.map_faces = args.map_faces
+    modules.globals.map_faces_clustering = args.map_faces_clustering
+    modules.globals.map_faces_threshold = args.map_faces_threshold
+    modules.globals.identity_gallery = args.identity_gallery
     modules.globals.video_encoder = args.video_encoder
     modules.globals.video_quality = args.video_quality
     modules.globals.live_mirror = args.live_mirror
     modules.globals.live_resizable = args.live_resizable
+    modules.globals.live_workers = args.live_workers
+    modules.globals.live_target_fps = args.live_target_fps
+    modules.globals.live_source = args.live_source
+    modules.globals.live_size = args.live_size
+    modules.globals.live_sink = args.live_sink
+    modules.globals.live_sink_address = args.live_sink_address
+    modules.globals.live_streams = args.live_streams
     modules.globals.max_memory = args.max_memory
     modules.globals.execution_providers = decode_execution_providers(args.execution_provider)
     modules.globals.execution_threads = args.execution_threads
+    modules.globals.enhancer_replicas = args.enhancer_replicas
+    modules.globals.enhancer_backend = args.enhancer_backend
+    modules.globals.enhancer_batch_size = args.enhancer_batch_size
+    modules.globals.swapper_precision = args.swapper_precision
     modules.globals.lang = args.lang
 
     #for ENHANCER tumbler:
@@ -137,10 +178,6 @@ def suggest_execution_threads() -> int:
 
 
 def limit_resources() -> None:
-    # prevent tensorflow memory leak
-    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
-    for gpu in gpus:
-        tensorflow.config.experimental.set_memory_growth(gpu, True)
     # limit memory usage
     if modules.globals.max_memory:
         memory = modules.globals.max_memory * 1024 ** 3
@@ -175,10 +212,30 @@ def update_status(message: str, scope: str = 'DLC.CORE') -> None:
     if not modules.globals.headless:
         ui.update_status(message)
 
+def map_faces_from_gallery() -> bool:
+    """Without the ui there is no mapper popup, the identity gallery gives the sources."""
+    if not modules.globals.identity_gallery:
+        update_status('Map faces without the ui needs --identity-gallery.')
+        return False
+    update_status('Getting unique faces...')
+    if is_image(modules.globals.target_path):
+        get_unique_faces_from_target_image()
+    else:
+        get_unique_faces_from_target_video()
+    filled = fill_map_from_gallery(modules.globals.source_target_map)
+    if not filled:
+        update_status('No known faces from the identity gallery in target.')
+        return False
+    update_status(f'Mapped {filled} known faces from the identity gallery.')
+    return True
+
+
 def start() -> None:
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         if not frame_processor.pre_start():
             return
+    if modules.globals.headless and modules.globals.map_faces and not map_faces_from_gallery():
+        return
     update_status('Processing...')
     # process image to image
     if has_image_extension(modules.globals.target_path):
@@ -198,16 +255,22 @@ def start() -> None:
             update_status('Processing to image failed!')
         return
     # process image to videos
-    if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
-        return
-
+    # the nsfw filter checks the frames as they are extracted, no second decode
+    frame_gate = FrameGate() if modules.globals.nsfw_filter else None
     if not modules.globals.map_faces:
         update_status('Creating temp resources...')
         create_temp(modules.globals.target_path)
         update_status('Extracting frames...')
-        extract_frames(modules.globals.target_path)
-
+        frame_passed = extract_frames(modules.globals.target_path, frame_gate)
     temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+    if modules.globals.map_faces and frame_gate:
+        # frames were extracted while mapping faces
+        frame_passed = all(frame_gate.add(temp_frame_path) for temp_frame_path in temp_frame_paths) and frame_gate.finish()
+    if frame_gate and not frame_passed:
+        destroy(to_quit=False)
+        update_status('Processing ignored!')
+        return
+
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         update_status('Progressing...', frame_processor.NAME)
         frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
@@ -238,6 +301,77 @@ def start() -> None:
         update_status('Processing to video failed!')
 
 
+def start_live() -> None:
+    if modules.globals.map_faces:
+        update_status('Map faces needs the ui in live mode.')
+        return
+    if not has_image_extension(modules.globals.source_path or ''):
+        update_status('Select an image for source path.')
+        return
+    try:
+        live_size = parse_size(modules.globals.live_size)
+    except ValueError:
+        update_status('Live size has to be WIDTHxHEIGHT.')
+        return
+    capturer = create_capturer(modules.globals.live_source, live_size)
+    if capturer is None:
+        update_status(f'Failed to open live source {modules.globals.live_source}.')
+        return
+    try:
+        sink = create_sink(modules.globals.live_sink, modules.globals.live_sink_address)
+    except OSError as e:
+        update_status(f'Failed to open live sink: {e}')
+        capturer.release()
+        return
+    pipeline = LivePipeline(capturer)
+    pipeline.start()
+    update_status(f'Live from {modules.globals.live_source} to {sink}...')
+    report_time = time.perf_counter()
+    try:
+        while True:
+            result = pipeline.processed.get(timeout=0.5)
+            if result is None:
+                if not pipeline.running:
+                    break
+                continue
+            capture_time, temp_frame = result[1:]
+            if modules.globals.show_fps:
+                draw_live_stats(temp_frame, pipeline.stats, pipeline.governor)
+            sink.write(temp_frame)
+            pipeline.stats.record(capture_time)
+            if time.perf_counter() - report_time >= LIVE_REPORT_INTERVAL:
+                report_time = time.perf_counter()
+                update_status(f'{pipeline.stats.fps:.1f} fps, {pipeline.stats.get_latency():.0f} ms latency, {pipeline.dropped} frames dropped', 'DLC.LIVE')
+    except BrokenPipeError:
+        pass
+    finally:
+        pipeline.stop()
+        capturer.release()
+        sink.close()
+    update_status('Live stopped.')
+
+
+def start_live_streams() -> None:
+    try:
+        streams = load_streams(modules.globals.live_streams)
+    except (OSError, ValueError, KeyError) as e:
+        update_status(f'Failed to start live streams: {e}')
+        return
+    engine = MultiStreamEngine(streams)
+    engine.start()
+    for stream in streams:
+        update_status(f'Live {stream.name} to {stream.sink}...')
+    try:
+        while engine.active:
+            time.sleep(LIVE_REPORT_INTERVAL)
+            for name, report in engine.get_report().items():
+                update_status(f"{name}: {report['fps']} fps, {report['latency_p50_ms']:.0f} ms latency, {report['dropped']} frames dropped", 'DLC.LIVE')
+    finally:
+        engine.stop()
+        release_streams(streams)
+    update_status('Live stopped.')
+
+
 def destroy(to_quit=True) -> None:
     if modules.globals.target_path:
         clean_temp(modules.globals.target_path)
@@ -252,7 +386,11 @@ def run() -> None:
         if not frame_processor.pre_check():
             return
     limit_resources()
-    if modules.globals.headless:
+    if modules.globals.live_streams is not None:
+        start_live_streams()
+    elif modules.globals.live_source is not None:
+        start_live()
+    elif modules.globals.headless:
         start()
     else:
         window = ui.init(start, destroy, modules.globals.lang)
@@ -1,29 +1,35 @@
 import os
 import shutil
-from typing import Any
-import insightface
+from typing import Any, Callable, List
 
 import cv2
 import numpy as np
 import modules.globals
 from tqdm import tqdm
 from modules.typing import Frame
-from modules.cluster_analysis import find_cluster_centroids, find_closest_centroid
+from modules.session_factory import FaceAnalysis
+from modules.cluster_analysis import OnlineIdentityClusterer, find_cluster_centroids, find_closest_centroids, normalize_embeddings
 from modules.utilities import get_temp_directory_path, create_temp, extract_frames, clean_temp, get_temp_frame_paths
 from pathlib import Path
 
 FACE_ANALYSER = None
+DETECTION_SIZE = 640
 
 
 def get_face_analyser() -> Any:
     global FACE_ANALYSER
 
     if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
+        FACE_ANALYSER = FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
+        FACE_ANALYSER.prepare(ctx_id=0, det_size=(DETECTION_SIZE, DETECTION_SIZE))
     return FACE_ANALYSER
 
 
+def set_detection_size(size: int) -> None:
+    """Input size of the face detector, smaller is faster but misses small faces."""
+    get_face_analyser().det_model.input_size = (size, size)
+
+
 def get_one_face(frame: Frame) -> Any:
     face = get_face_analyser().get(frame)
     try:
@@ -55,10 +61,10 @@ def simplify_maps() -> Any:
     faces = []
     for map in modules.globals.source_target_map:
         if "source" in map and "target" in map:
-            centroids.append(map['target']['face'].normed_embedding)
+            centroids.append(map['target'].get('centroid', map['target']['face'].normed_embedding))
             faces.append(map['source']['face'])
 
-    modules.globals.simple_map = {'source_faces': faces, 'target_embeddings': centroids}
+    modules.globals.simple_map = {'source_faces': faces, 'target_embeddings': centroids, 'target_matrix': normalize_embeddings(centroids)}
     return None
 
 def add_blank_map() -> Any:
@@ -94,7 +100,13 @@ def get_unique_faces_from_target_image() -> Any:
         return None
     
     
-def get_unique_faces_from_target_video() -> Any:
+def get_unique_faces_from_target_video(on_identities: Callable[[int, int], None] = None) -> Any:
+    """
+    Cluster the faces of the target video into identities for map-faces.
+    With --map-faces-clustering online the identities are built while the
+    frames are analysed, source_target_map holds them as they change and
+    on_identities(identities, frames) reports every change.
+    """
     try:
         modules.globals.source_target_map = []
         frame_face_embeddings = []
@@ -107,6 +119,9 @@ def get_unique_faces_from_target_video() -> Any:
         extract_frames(modules.globals.target_path)
 
         temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+        if modules.globals.map_faces_clustering == 'online':
+            get_identities_online(temp_frame_paths, on_identities)
+            return None
 
         i = 0
         for temp_frame_path in tqdm(temp_frame_paths, desc="Extracting face embeddings from frames"):
@@ -120,28 +135,91 @@ def get_unique_faces_from_target_video() -> Any:
             i += 1
 
         centroids = find_cluster_centroids(face_embeddings)
+        closest_centroid_indices = find_closest_centroids(centroids, face_embeddings)
 
+        # one pass over all faces, every identity lists the frames it is in
+        target_faces_in_frame = [[] for _ in range(len(centroids))]
+        face_index = 0
         for frame in frame_face_embeddings:
+            frame_entries = {}
             for face in frame['faces']:
-                closest_centroid_index, _ = find_closest_centroid(centroids, face.normed_embedding)
-                face['target_centroid'] = closest_centroid_index
-
-        for i in range(len(centroids)):
+                closest_centroid_index = int(closest_centroid_indices[face_index])
+                face_index += 1
+                if closest_centroid_index not in frame_entries:
+                    frame_entries[closest_centroid_index] = {'frame': frame['frame'], 'faces': [], 'location': frame['location']}
+                    target_faces_in_frame[closest_centroid_index].append(frame_entries[closest_centroid_index])
+                frame_entries[closest_centroid_index]['faces'].append(face)
+
+        # a centroid no face is closest to has nothing to map
+        target_faces_in_frame = [frames for frames in target_faces_in_frame if frames]
+        for i in range(len(target_faces_in_frame)):
+            for frame in target_faces_in_frame[i]:
+                for face in frame['faces']:
+                    face['target_centroid'] = i
             modules.globals.source_target_map.append({
-                'id' : i
+                'id' : i,
+                'target_faces_in_frame' : target_faces_in_frame[i]
             })
 
-            temp = []
-            for frame in tqdm(frame_face_embeddings, desc=f"Mapping frame embeddings to centroids-{i}"):
-                temp.append({'frame': frame['frame'], 'faces': [face for face in frame['faces'] if face['target_centroid'] == i], 'location': frame['location']})
-
-            modules.globals.source_target_map[i]['target_faces_in_frame'] = temp
-
         # dump_faces(centroids, frame_face_embeddings)
         default_target_face()
     except ValueError:
         return None
-    
+
+
+def get_identities_online(temp_frame_paths: List[str], on_identities: Callable[[int, int], None] = None) -> None:
+    """
+    Cluster the faces into identities while the frames are analysed and
+    keep source_target_map on the identities found so far, on_identities
+    is called after every update. Only the prototype reservoirs keep faces,
+    the map has no target_faces_in_frame and frames are matched to the
+    identity centroids again when they are swapped.
+    """
+    clusterer = OnlineIdentityClusterer()
+    for frame_number, temp_frame_path in enumerate(tqdm(temp_frame_paths, desc="Clustering faces from frames")):
+        many_faces = get_many_faces(cv2.imread(temp_frame_path))
+        if not many_faces:
+            continue
+        refined = clusterer.add(
+            [face.normed_embedding for face in many_faces],
+            [(face, temp_frame_path) for face in many_faces]
+        )
+        if refined:
+            update_identity_map(clusterer)
+            if on_identities:
+                on_identities(len(modules.globals.source_target_map), frame_number + 1)
+
+    clusterer.refine()
+    update_identity_map(clusterer)
+
+
+def update_identity_map(clusterer: OnlineIdentityClusterer) -> None:
+    """
+    Rebuild source_target_map from the identities of clusterer, sources
+    already chosen stay with the identity label they were chosen for.
+    """
+    chosen = {}
+    for map in modules.globals.source_target_map:
+        if 'source' in map and 'label' in map:
+            chosen.setdefault(clusterer.resolve_label(map['label']), map)
+
+    source_target_map = []
+    centroids, labels, identity_members = clusterer.get_identities()
+    for centroid, label, members in zip(centroids, labels, identity_members):
+        # a centroid no face is closest to has nothing to map
+        if not members:
+            continue
+        face, location = max(members, key=lambda member: member[0]['det_score'])
+        map = {'id': len(source_target_map), 'label': label}
+        if label in chosen:
+            map['source'] = chosen[label]['source']
+            if 'identity' in chosen[label]:
+                map['identity'] = chosen[label]['identity']
+        set_target_face(map, face, location)
+        map['target']['centroid'] = centroid
+        source_target_map.append(map)
+    modules.globals.source_target_map = source_target_map
+
 
 def default_target_face():
     for map in modules.globals.source_target_map:
@@ -159,13 +237,17 @@ def default_target_face():
                     best_face = face
                     best_frame = frame
 
-        x_min, y_min, x_max, y_max = best_face['bbox']
+        set_target_face(map, best_face, best_frame['location'])
+
+
+def set_target_face(map: dict, face: Any, location: str) -> None:
+    x_min, y_min, x_max, y_max = face['bbox']
 
-        target_frame = cv2.imread(best_frame['location'])
-        map['target'] = {
-                        'cv2' : target_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
-                        'face' : best_face
-                        }
+    target_frame = cv2.imread(location)
+    map['target'] = {
+                    'cv2' : target_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
+                    'face' : face
+                    }
 
 
 def dump_faces(centroids: Any, frame_face_embeddings: list):
@@ -19,17 +19,34 @@ frame_processors: List[str] = []
 keep_fps = True
 keep_audio = True
 keep_frames = False
+swap_interval = 1  # run the swapper on every n-th frame, track the ones in between
+frame_reuse_tolerance = 2.0  # max fingerprint cell difference for reusing the previous frame, 0 disables
 many_faces = False
 map_faces = False
+map_faces_clustering = "batch"  # batch clusters after analysis, online while analysing
+map_faces_threshold = 0.2  # minimum cosine similarity for live map-faces assignment
+identity_gallery = None  # directory of known identities that map-faces fills in automatically
 color_correction = False  # New global variable for color correction toggle
 nsfw_filter = False
 video_encoder = None
 video_quality = None
 live_mirror = False
 live_resizable = True
+live_workers = 1  # inference threads of the live pipeline
+live_target_fps = None  # frame rate the live quality governor holds, None keeps full quality
+live_source = None  # headless live input: camera index, video file or url, "-" for raw frames on stdin
+live_size = None  # "WIDTHxHEIGHT" of raw stdin frames and of the camera capture
+live_sink = "mjpeg"  # headless live output: stdout, mjpeg or shm
+live_sink_address = None  # host:port of the mjpeg sink, name of the shm ring
+live_streams = None  # json file of several headless live streams sharing the models
 max_memory = None
 execution_providers: List[str] = []
 execution_threads = None
+enhancer_replicas = None  # GFPGAN replicas, None picks one per execution thread on cpu
+enhancer_batch_size = None  # faces per GFPGAN run, None picks 8 on gpu and 1 on cpu
+enhancer_backend = "auto"  # auto, onnx or torch, auto prefers exported onnx models
+swapper_precision = "auto"  # auto, fp32, fp16 or int8
+session_cache_dir = None  # optimized onnx graphs, defaults to models/ort_cache
 headless = None
 log_level = "error"
 fp_ui: Dict[str, bool] = {"face_enhancer": False}
@@ -37,6 +54,7 @@ camera_input_combobox = None
 webcam_preview_running = False
 show_fps = False
 mouth_mask = False
+live_mouth_mask = True  # False while the live quality governor turns the mouth mask off
 show_mouth_mask_box = False
 mask_feather_ratio = 8
 mask_down_size = 0.50
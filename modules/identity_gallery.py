@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+from typing import Any, List, Optional
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import modules.globals
+from modules.cluster_analysis import normalize_embeddings
+from modules.face_analyser import get_one_face
+
+IDENTITIES_FILE = "identities.json"
+PROTOTYPES_FILE = "prototypes.npy"
+# minimum cosine similarity for a target face to be taken as a known identity
+MATCH_THRESHOLD = 0.45
+# views of one identity kept, a new one is only added when it differs
+MAX_PROTOTYPES = 8
+NEW_PROTOTYPE_SIMILARITY = 0.85
+
+IDENTITY_GALLERY = None
+THREAD_LOCK = threading.Lock()
+
+
+class IdentityGallery:
+    """
+    Named identities with embedding prototypes, kept in a directory:
+    identities.json holds the names and the source image each identity is
+    swapped with, prototypes.npy the normalised embeddings of all of them.
+    Names can be edited in identities.json. Lookups are one product against
+    the prototype matrix, milliseconds for thousands of identities.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.identities = []
+        self.prototypes = np.zeros((0, 0), dtype=np.float32)
+        self.owners = np.zeros(0, dtype=int)
+        self.load()
+
+    def load(self) -> None:
+        identities_path = os.path.join(self.directory, IDENTITIES_FILE)
+        prototypes_path = os.path.join(self.directory, PROTOTYPES_FILE)
+        if not os.path.isfile(identities_path) or not os.path.isfile(prototypes_path):
+            return
+        with open(identities_path, "r") as f:
+            self.identities = json.load(f)
+        self.prototypes = normalize_embeddings(np.load(prototypes_path))
+        self.owners = np.array(
+            [index for index, identity in enumerate(self.identities) for _ in range(identity["prototypes"])],
+            dtype=int,
+        )
+
+    def save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        identities_path = os.path.join(self.directory, IDENTITIES_FILE)
+        prototypes_path = os.path.join(self.directory, PROTOTYPES_FILE)
+        # prototypes are stored grouped by identity, in identity order
+        order = np.argsort(self.owners, kind="stable")
+        self.prototypes = self.prototypes[order]
+        self.owners = self.owners[order]
+        for index, identity in enumerate(self.identities):
+            identity["prototypes"] = int(np.sum(self.owners == index))
+
+        with open(f"{prototypes_path}.tmp", "wb") as f:
+            np.save(f, self.prototypes)
+        with open(f"{identities_path}.tmp", "w") as f:
+            json.dump(self.identities, f, indent=2)
+        os.replace(f"{prototypes_path}.tmp", prototypes_path)
+        os.replace(f"{identities_path}.tmp", identities_path)
+
+    def match(self, normed_face_embeddings: Any, threshold: float = MATCH_THRESHOLD) -> List[Optional[int]]:
+        """
+        Identity index for every embedding, None for unknown faces. Every
+        identity is given to at most one embedding.
+        """
+        embeddings = normalize_embeddings(normed_face_embeddings)
+        matches = [None] * len(embeddings)
+        if len(embeddings) == 0 or len(self.prototypes) == 0:
+            return matches
+
+        # best prototype of every identity
+        similarities = embeddings @ self.prototypes.T
+        scores = np.full((len(embeddings), len(self.identities)), -1.0, dtype=np.float32)
+        np.maximum.at(scores, (np.arange(len(embeddings))[:, None], self.owners[None, :]), similarities)
+        face_indices, identity_indices = linear_sum_assignment(scores, maximize=True)
+        for face_index, identity_index in zip(face_indices, identity_indices):
+            if scores[face_index, identity_index] >= threshold:
+                matches[face_index] = int(identity_index)
+        return matches
+
+    def remember(self, identity_index: Optional[int], normed_face_embedding: Any, source_path: str) -> int:
+        """Add a new identity or a new view of a known one, returns its index."""
+        embedding = normalize_embeddings(normed_face_embedding).reshape(1, -1)
+        if len(self.prototypes) == 0:
+            self.prototypes = np.zeros((0, embedding.shape[1]), dtype=np.float32)
+
+        if identity_index is None:
+            identity_index = len(self.identities)
+            self.identities.append({"name": f"identity-{identity_index}", "source_path": source_path, "prototypes": 0})
+        else:
+            self.identities[identity_index]["source_path"] = source_path
+            views = np.flatnonzero(self.owners == identity_index)
+            if len(views) and float(np.max(self.prototypes[views] @ embedding[0])) >= NEW_PROTOTYPE_SIMILARITY:
+                return identity_index
+            if len(views) >= MAX_PROTOTYPES:
+                # the oldest view makes room
+                self.prototypes = np.delete(self.prototypes, views[0], axis=0)
+                self.owners = np.delete(self.owners, views[0])
+
+        self.prototypes = np.vstack([self.prototypes, embedding])
+        self.owners = np.append(self.owners, identity_index)
+        self.identities[identity_index]["prototypes"] += 1
+        return identity_index
+
+
+def get_identity_gallery() -> Optional[IdentityGallery]:
+    global IDENTITY_GALLERY
+
+    if not modules.globals.identity_gallery:
+        return None
+    with THREAD_LOCK:
+        if IDENTITY_GALLERY is None or IDENTITY_GALLERY.directory != modules.globals.identity_gallery:
+            IDENTITY_GALLERY = IdentityGallery(modules.globals.identity_gallery)
+    return IDENTITY_GALLERY
+
+
+def fill_map_from_gallery(source_target_map: list) -> int:
+    """
+    Give every target of the map that is a known identity the source image
+    it was last swapped with. Returns the number of targets filled in.
+    """
+    identity_gallery = get_identity_gallery()
+    if identity_gallery is None:
+        return 0
+    entries = [entry for entry in source_target_map if "target" in entry and "source" not in entry]
+    matches = identity_gallery.match([entry["target"]["face"].normed_embedding for entry in entries])
+
+    filled = 0
+    for entry, identity_index in zip(entries, matches):
+        if identity_index is None:
+            continue
+        identity = identity_gallery.identities[identity_index]
+        source_frame = cv2.imread(identity["source_path"]) if os.path.isfile(identity["source_path"]) else None
+        source_face = get_one_face(source_frame) if source_frame is not None else None
+        if not source_face:
+            continue
+        x_min, y_min, x_max, y_max = source_face["bbox"]
+        entry["source"] = {
+            "cv2": source_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
+            "face": source_face,
+            "path": identity["source_path"],
+        }
+        entry["identity"] = identity_index
+        filled += 1
+    return filled
+
+
+def remember_map(source_target_map: list) -> None:
+    """Store the mapped targets, with the source chosen for each, in the gallery."""
+    identity_gallery = get_identity_gallery()
+    if identity_gallery is None:
+        return
+    for entry in source_target_map:
+        if "target" not in entry or "path" not in entry.get("source", {}):
+            continue
+        identity_index = entry.get("identity")
+        if identity_index is None:
+            identity_index = identity_gallery.match([entry["target"]["face"].normed_embedding])[0]
+        entry["identity"] = identity_gallery.remember(
+            identity_index, entry["target"]["face"].normed_embedding, entry["source"]["path"]
+        )
+    identity_gallery.save()
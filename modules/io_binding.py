@@ -0,0 +1,284 @@
+import threading
+from typing import Any, List, Tuple
+
+import cv2
+import numpy as np
+import onnxruntime
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.model_zoo.retinaface import RetinaFace, distance2bbox, distance2kps
+from insightface.utils import face_align
+
+ONNX_TYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64,
+}
+
+
+class BoundSession:
+    """
+    Runs an InferenceSession through IOBinding. Every worker thread gets its
+    own binding and its own input/output buffers, allocated on first use and
+    reused for as long as the shapes stay the same. Callers write inputs
+    straight into get_input_buffer() and must copy anything they keep from
+    the arrays returned by run().
+    """
+
+    def __init__(self, session: onnxruntime.InferenceSession):
+        self.session = session
+        self.input_types = {
+            node.name: ONNX_TYPES.get(node.type, np.float32) for node in session.get_inputs()
+        }
+        self.output_names = [node.name for node in session.get_outputs()]
+        self.output_types = [
+            ONNX_TYPES.get(node.type, np.float32) for node in session.get_outputs()
+        ]
+        self.local = threading.local()
+
+    def get_state(self) -> Any:
+        state = self.local
+        if not hasattr(state, "binding"):
+            state.binding = self.session.io_binding()
+            state.inputs = {}
+            state.outputs = {}
+        return state
+
+    def get_input_buffer(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        state = self.get_state()
+        buffer = state.inputs.get(name)
+        if buffer is None or buffer.shape != tuple(shape):
+            buffer = state.inputs[name] = np.empty(shape, dtype=self.input_types[name])
+        return buffer
+
+    def run(self) -> List[np.ndarray]:
+        state = self.get_state()
+        binding = state.binding
+        for name, buffer in state.inputs.items():
+            binding.bind_input(name, "cpu", 0, buffer.dtype, buffer.shape, buffer.ctypes.data)
+
+        # output shapes follow from the input shapes, the first run for a new
+        # input shape lets ORT allocate and the outputs become the buffers
+        key = tuple(buffer.shape for buffer in state.inputs.values())
+        outputs = state.outputs.get(key)
+        if outputs is None:
+            for name in self.output_names:
+                binding.bind_output(name, "cpu")
+            self.session.run_with_iobinding(binding)
+            outputs = [
+                np.ascontiguousarray(output, dtype=dtype)
+                for output, dtype in zip(binding.copy_outputs_to_cpu(), self.output_types)
+            ]
+            if len(state.outputs) > 8:
+                state.outputs.clear()
+            state.outputs[key] = outputs
+            return outputs
+
+        for name, buffer in zip(self.output_names, outputs):
+            binding.bind_output(name, "cpu", 0, buffer.dtype, buffer.shape, buffer.ctypes.data)
+        self.session.run_with_iobinding(binding)
+        return outputs
+
+
+def write_blob(image: np.ndarray, blob: np.ndarray, mean: float, std: float) -> None:
+    # same result as cv2.dnn.blobFromImage(image, 1 / std, size, mean, swapRB=True)
+    # for an image of the blob size, without allocating the blob
+    for channel in range(3):
+        np.subtract(image[:, :, 2 - channel], mean, out=blob[channel], casting="unsafe")
+    if std != 1.0:
+        np.multiply(blob, 1.0 / std, out=blob, casting="unsafe")
+
+
+def get_warp_buffer(local: threading.local, size: int) -> np.ndarray:
+    buffer = getattr(local, "warp_buffer", None)
+    if buffer is None or buffer.shape[0] != size:
+        buffer = local.warp_buffer = np.empty((size, size, 3), dtype=np.uint8)
+    return buffer
+
+
+class BoundRetinaFace(RetinaFace):
+    def __init__(self, model_file: str = None, session: Any = None):
+        super().__init__(model_file=model_file, session=session)
+        self.bound_session = BoundSession(self.session)
+
+    def detect(self, img, input_size=None, max_num=0, metric="default"):
+        assert input_size is not None or self.input_size is not None
+        input_size = self.input_size if input_size is None else input_size
+
+        im_ratio = float(img.shape[0]) / img.shape[1]
+        model_ratio = float(input_size[1]) / input_size[0]
+        if im_ratio > model_ratio:
+            new_height = input_size[1]
+            new_width = int(new_height / im_ratio)
+        else:
+            new_width = input_size[0]
+            new_height = int(new_width * im_ratio)
+        det_scale = float(new_height) / img.shape[0]
+
+        # resize and normalise straight into the bound input, the letterbox
+        # padding gets the value a black pixel would have
+        blob = self.bound_session.get_input_buffer(
+            self.input_name, (1, 3, input_size[1], input_size[0])
+        )
+        padding_value = (0.0 - self.input_mean) / self.input_std
+        blob[0, :, new_height:, :] = padding_value
+        blob[0, :, :new_height, new_width:] = padding_value
+        resized_img = cv2.resize(img, (new_width, new_height))
+        write_blob(
+            resized_img,
+            blob[0, :, :new_height, :new_width],
+            self.input_mean,
+            self.input_std,
+        )
+        net_outs = self.bound_session.run()
+        scores_list, bboxes_list, kpss_list = self.decode(
+            net_outs, input_size[1], input_size[0], self.det_thresh
+        )
+
+        scores = np.vstack(scores_list)
+        order = scores.ravel().argsort()[::-1]
+        bboxes = np.vstack(bboxes_list) / det_scale
+        pre_det = np.hstack((bboxes, scores)).astype(np.float32, copy=False)
+        pre_det = pre_det[order, :]
+        keep = self.nms(pre_det)
+        det = pre_det[keep, :]
+        kpss = None
+        if self.use_kps:
+            kpss = np.vstack(kpss_list) / det_scale
+            kpss = kpss[order, :, :][keep, :, :]
+        if max_num > 0 and det.shape[0] > max_num:
+            area = (det[:, 2] - det[:, 0]) * (det[:, 3] - det[:, 1])
+            img_center = img.shape[0] // 2, img.shape[1] // 2
+            offsets = np.vstack(
+                [
+                    (det[:, 0] + det[:, 2]) / 2 - img_center[1],
+                    (det[:, 1] + det[:, 3]) / 2 - img_center[0],
+                ]
+            )
+            offset_dist_squared = np.sum(np.power(offsets, 2.0), 0)
+            if metric == "max":
+                values = area
+            else:
+                values = area - offset_dist_squared * 2.0
+            bindex = np.argsort(values)[::-1][0:max_num]
+            det = det[bindex, :]
+            if kpss is not None:
+                kpss = kpss[bindex, :]
+        return det, kpss
+
+    def decode(self, net_outs: List[np.ndarray], input_height: int, input_width: int, threshold: float) -> Tuple[list, list, list]:
+        # RetinaFace.forward without the blob construction and session.run.
+        # Detectors exported with a batch dimension give (1, anchors, n)
+        # outputs, as SCRFD's batched branch handles them
+        if len(net_outs[0].shape) == 3:
+            net_outs = [net_out[0] for net_out in net_outs]
+        scores_list = []
+        bboxes_list = []
+        kpss_list = []
+        fmc = self.fmc
+        for idx, stride in enumerate(self._feat_stride_fpn):
+            scores = net_outs[idx]
+            bbox_preds = net_outs[idx + fmc] * stride
+            height = input_height // stride
+            width = input_width // stride
+            key = (height, width, stride)
+            anchor_centers = self.center_cache.get(key)
+            if anchor_centers is None:
+                anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+                anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+                if self._num_anchors > 1:
+                    anchor_centers = np.stack([anchor_centers] * self._num_anchors, axis=1).reshape((-1, 2))
+                if len(self.center_cache) < 100:
+                    self.center_cache[key] = anchor_centers
+
+            pos_inds = np.where(scores >= threshold)[0]
+            scores_list.append(scores[pos_inds])
+            bboxes_list.append(distance2bbox(anchor_centers[pos_inds], bbox_preds[pos_inds]))
+            if self.use_kps:
+                kps_preds = net_outs[idx + fmc * 2][pos_inds] * stride
+                kpss = distance2kps(anchor_centers[pos_inds], kps_preds)
+                kpss_list.append(kpss.reshape((kpss.shape[0], -1, 2)))
+        return scores_list, bboxes_list, kpss_list
+
+
+class BoundArcFaceONNX(ArcFaceONNX):
+    def __init__(self, model_file: str = None, session: Any = None):
+        super().__init__(model_file=model_file, session=session)
+        self.bound_session = BoundSession(self.session)
+        self.local = threading.local()
+
+    def get(self, img, face):
+        size = self.input_size[0]
+        M = face_align.estimate_norm(face.kps, size)
+        aimg = cv2.warpAffine(img, M, (size, size), dst=get_warp_buffer(self.local, size), borderValue=0.0)
+        blob = self.bound_session.get_input_buffer(self.input_name, (1, 3, size, size))
+        write_blob(aimg, blob[0], self.input_mean, self.input_std)
+        face.embedding = self.bound_session.run()[0].flatten()
+        return face.embedding
+
+
+class BoundINSwapper(INSwapper):
+    def __init__(self, model_file: str = None, session: Any = None):
+        super().__init__(model_file=model_file, session=session)
+        self.bound_session = BoundSession(self.session)
+        self.local = threading.local()
+
+    def get(self, img, target_face, source_face, paste_back=True):
+        size = self.input_size[0]
+        M = face_align.estimate_norm(target_face.kps, size)
+        aimg = cv2.warpAffine(img, M, (size, size), dst=get_warp_buffer(self.local, size), borderValue=0.0)
+
+        blob = self.bound_session.get_input_buffer(self.input_names[0], (1, 3, size, size))
+        write_blob(aimg, blob[0], self.input_mean, self.input_std)
+        latent = self.bound_session.get_input_buffer(self.input_names[1], (1, self.emap.shape[1]))
+        latent[0] = np.dot(source_face.normed_embedding, self.emap)
+        latent /= np.linalg.norm(latent)
+        pred = self.bound_session.run()[0]
+
+        img_fake = pred.transpose((0, 2, 3, 1))[0]
+        bgr_fake = np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, ::-1]
+        if not paste_back:
+            return bgr_fake, M
+        return self.paste_back(img, bgr_fake, M)
+
+    def paste_back(self, target_img: np.ndarray, bgr_fake: np.ndarray, M: np.ndarray) -> np.ndarray:
+        # INSwapper.get paste back, restricted to the area the crop lands on
+        # plus enough margin for the erosion and blur to see the same zeros
+        # they would on the full frame. Its fake_diff mask is never used for
+        # the merge and is skipped.
+        IM = cv2.invertAffineTransform(M)
+        size = bgr_fake.shape[0]
+        corners = np.array([[0, 0, 1], [size, 0, 1], [0, size, 1], [size, size, 1]], dtype=np.float32) @ IM.T
+        (min_x, min_y), (max_x, max_y) = corners.min(axis=0), corners.max(axis=0)
+        margin = int(max(max_x - min_x, max_y - min_y)) // 5 + 20
+        frame_height, frame_width = target_img.shape[:2]
+        x1 = max(0, int(min_x) - margin)
+        y1 = max(0, int(min_y) - margin)
+        x2 = min(frame_width, int(np.ceil(max_x)) + margin)
+        y2 = min(frame_height, int(np.ceil(max_y)) + margin)
+        if x2 <= x1 or y2 <= y1:
+            return target_img.copy()
+
+        IM[:, 2] -= (x1, y1)
+        roi_size = (x2 - x1, y2 - y1)
+        bgr_fake = cv2.warpAffine(bgr_fake, IM, roi_size, borderValue=0.0)
+        img_white = np.full((size, size), 255, dtype=np.float32)
+        img_mask = cv2.warpAffine(img_white, IM, roi_size, borderValue=0.0)
+        img_mask[img_mask > 20] = 255
+
+        mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+        if len(mask_h_inds) == 0:
+            return target_img.copy()
+        mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+        mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+        mask_size = int(np.sqrt(mask_h * mask_w))
+        k = max(mask_size // 10, 10)
+        img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+        k = max(mask_size // 20, 5)
+        img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+        img_mask /= 255
+
+        result = target_img.copy()
+        roi = target_img[y1:y2, x1:x2]
+        result[y1:y2, x1:x2] = cv2.blendLinear(bgr_fake, roi, img_mask, 1 - img_mask)
+        return result
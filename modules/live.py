@@ -0,0 +1,391 @@
+import threading
+import time
+from collections import deque
+from typing import Any, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import modules.globals
+from modules.face_analyser import DETECTION_SIZE, get_one_face, set_detection_size
+from modules.processors.frame.core import get_frame_processors_modules, set_frame_faces
+from modules.typing import Face, Frame
+
+# shown frames kept for the latency percentiles
+STATS_WINDOW = 300
+FPS_UPDATE_INTERVAL = 0.5
+# knobs of the latency governor, best quality first. Each level gives up a
+# little quality for speed: the enhancer first, then detections on every
+# frame (tracked in between), the detector size, the mouth mask and finally
+# the processing resolution
+QUALITY_LEVELS = [
+    {"enhancer": True, "detection_interval": 1, "detection_size": DETECTION_SIZE, "mouth_mask": True, "scale": 1.0},
+    {"enhancer": False, "detection_interval": 1, "detection_size": DETECTION_SIZE, "mouth_mask": True, "scale": 1.0},
+    {"enhancer": False, "detection_interval": 2, "detection_size": DETECTION_SIZE, "mouth_mask": True, "scale": 1.0},
+    {"enhancer": False, "detection_interval": 3, "detection_size": 480, "mouth_mask": True, "scale": 1.0},
+    {"enhancer": False, "detection_interval": 3, "detection_size": 480, "mouth_mask": False, "scale": 1.0},
+    {"enhancer": False, "detection_interval": 4, "detection_size": 320, "mouth_mask": False, "scale": 0.75},
+    {"enhancer": False, "detection_interval": 5, "detection_size": 320, "mouth_mask": False, "scale": 0.5},
+]
+# weight of the newest frame in the smoothed processing time
+GOVERNOR_SMOOTHING = 0.1
+# frames measured at a level before it is lowered, or raised again
+DEGRADE_FRAMES = 10
+UPGRADE_FRAMES = 60
+# a level that proved too slow right after being raised to is retried less often
+MAX_UPGRADE_FRAMES = 1920
+# a level is only raised with this much of the budget to spare
+UPGRADE_HEADROOM = 0.7
+# frames in a row a worker fails on before the pipeline stops
+MAX_FAILED_FRAMES = 30
+
+
+class FrameMailbox:
+    """
+    Holds only the newest item. A put replaces an item nobody has taken yet,
+    so a slow consumer skips stale frames instead of letting them queue up.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item: Any) -> None:
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """The newest item, None when nothing arrived within timeout or the mailbox is closed."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None or self.closed, timeout)
+            item, self.item = self.item, None
+            return item
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class LiveStats:
+    """
+    Frames per second shown and glass-to-glass latency, from the moment a
+    frame left the camera until it was handed to the display.
+    """
+
+    def __init__(self, window: Optional[int] = STATS_WINDOW):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.frames = 0
+        self.fps = 0.0
+        self.window_start = time.perf_counter()
+        self.window_frames = 0
+
+    def record(self, capture_time: float, shown_time: Optional[float] = None) -> None:
+        shown_time = shown_time or time.perf_counter()
+        with self.lock:
+            self.latencies.append(shown_time - capture_time)
+            self.frames += 1
+            self.window_frames += 1
+            if shown_time - self.window_start >= FPS_UPDATE_INTERVAL:
+                self.fps = self.window_frames / (shown_time - self.window_start)
+                self.window_start = shown_time
+                self.window_frames = 0
+
+    def get_latency(self, percentile: float = 50) -> float:
+        """Latency in milliseconds over the frames of the window."""
+        with self.lock:
+            if not self.latencies:
+                return 0.0
+            return float(np.percentile(self.latencies, percentile)) * 1000
+
+
+def fit_image_to_size(image, width: int, height: int):
+    if width is None or height is None or width <= 0 or height <= 0:
+        return image
+    h, w, _ = image.shape
+    # Use the smaller ratio to ensure the image fits within the given dimensions
+    ratio = min(width / w, height / h)
+
+    # Compute new dimensions, ensuring they're at least 1 pixel
+    new_width = max(1, int(ratio * w))
+    new_height = max(1, int(ratio * h))
+    return cv2.resize(image, dsize=(new_width, new_height))
+
+
+def process_live_frame(
+    frame: Frame,
+    frame_processors: List[Any],
+    source_face: Optional[Face],
+    propagator: Any = None,
+    enhance: bool = True,
+    stage_times: Optional[dict] = None,
+    simple_map: Optional[dict] = None,
+) -> Frame:
+    """
+    Runs one camera frame through the frame processors, as the live preview
+    does. With a propagator the swapper detects faces on its keyframes only,
+    enhance False skips the enhancers and stage_times receives the seconds
+    spent in each processor that ran. A simple_map swaps mapped faces
+    instead of source_face, in place of the global map-faces mapping.
+    """
+    for frame_processor in frame_processors:
+        start = time.perf_counter()
+        if frame_processor.NAME.startswith("DLC.FACE-ENHANCER"):
+            if not enhance or (
+                frame_processor.NAME == "DLC.FACE-ENHANCER"
+                and not modules.globals.fp_ui["face_enhancer"]
+            ):
+                continue
+            if modules.globals.map_faces and simple_map is None:
+                frame = frame_processor.process_frame_v2(frame)
+            else:
+                frame = frame_processor.process_frame(None, frame)
+        elif simple_map is not None and frame_processor.NAME == "DLC.FACE-SWAPPER":
+            frame = frame_processor.swap_mapped_faces(frame, simple_map)
+        elif modules.globals.map_faces:
+            modules.globals.target_path = None
+            frame = frame_processor.process_frame_v2(frame)
+        elif propagator is not None and frame_processor.NAME == "DLC.FACE-SWAPPER":
+            frame = propagator.process(source_face, frame)
+            set_frame_faces(frame, propagator.faces)
+        else:
+            frame = frame_processor.process_frame(source_face, frame)
+        if stage_times is not None:
+            stage_times[frame_processor.NAME] = time.perf_counter() - start
+    return frame
+
+
+def draw_live_stats(frame: Frame, stats: "LiveStats", governor: Optional["LatencyGovernor"] = None) -> None:
+    """The show_fps overlay: frame rate, latency and the governor's quality level."""
+    lines = [f"FPS: {stats.fps:.1f}", f"Latency: {stats.get_latency():.0f} ms"]
+    if governor is not None:
+        lines.append(f"Quality: {governor.get_quality()}")
+    for index, line in enumerate(lines):
+        cv2.putText(
+            frame,
+            line,
+            (10, 30 + index * 35),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            (0, 255, 0),
+            2,
+        )
+
+
+class LatencyGovernor:
+    """
+    Holds live processing to a target frame time. Watches the smoothed
+    processing time per frame and steps down QUALITY_LEVELS while it is over
+    budget, and back up once a level leaves enough headroom. The per-stage
+    timings tell which knobs matter: levels that would not change anything,
+    e.g. turning off an enhancer that never ran, are skipped.
+    """
+
+    def __init__(self, target_fps: float, workers: int = 1):
+        # workers process frames side by side, each may take that much longer
+        self.budget = workers / target_fps
+        self.workers = workers
+        self.level = 0
+        self.frame_time = None
+        self.frames_at_level = 0
+        self.upgrade_frames = UPGRADE_FRAMES
+        self.raised = False
+        self.stage_times = {}
+
+    def get_knobs(self, level: Optional[int] = None) -> dict:
+        """Knobs of a level, the user's own switches apply on top of them."""
+        knobs = dict(QUALITY_LEVELS[self.level if level is None else level])
+        if modules.globals.map_faces or self.workers > 1:
+            # map-faces matches every frame's faces, and workers each get
+            # every n-th frame, there is no sequence of frames to track along
+            knobs["detection_interval"] = 1
+        return knobs
+
+    def get_effective_knobs(self, level: int) -> dict:
+        knobs = self.get_knobs(level)
+        knobs["mouth_mask"] = knobs["mouth_mask"] and modules.globals.mouth_mask
+        # the last timing of a stage is kept while it is turned off
+        knobs["enhancer"] = knobs["enhancer"] and any(
+            name.startswith("DLC.FACE-ENHANCER") for name in self.stage_times
+        )
+        return knobs
+
+    def get_quality(self) -> str:
+        return f"{len(QUALITY_LEVELS) - self.level}/{len(QUALITY_LEVELS)}"
+
+    def step(self, direction: int) -> bool:
+        level = self.level
+        knobs = self.get_effective_knobs(level)
+        while 0 <= level + direction < len(QUALITY_LEVELS):
+            level += direction
+            if self.get_effective_knobs(level) != knobs:
+                self.level = level
+                self.frame_time = None
+                self.frames_at_level = 0
+                return True
+        return False
+
+    def update(self, frame_time: float, stage_times: Optional[dict] = None) -> bool:
+        """Records one processed frame, returns True when the level changed."""
+        if stage_times:
+            self.stage_times.update(stage_times)
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time += GOVERNOR_SMOOTHING * (frame_time - self.frame_time)
+        self.frames_at_level += 1
+
+        if self.frames_at_level >= DEGRADE_FRAMES and self.frame_time > self.budget:
+            if self.raised:
+                self.upgrade_frames = min(self.upgrade_frames * 2, MAX_UPGRADE_FRAMES)
+            else:
+                self.upgrade_frames = UPGRADE_FRAMES
+            self.raised = False
+            return self.step(1)
+        if self.frames_at_level >= UPGRADE_FRAMES:
+            self.raised = False
+        if self.frames_at_level >= self.upgrade_frames and self.frame_time < self.budget * UPGRADE_HEADROOM:
+            self.raised = self.step(-1)
+            return self.raised
+        return False
+
+
+class LivePipeline:
+    """
+    Live processing in three decoupled stages. A capture thread reads the
+    camera as fast as it delivers and keeps only the newest frame, inference
+    workers take the newest frame whenever they are free, and the display
+    takes the newest result from processed when it is ready for one. A slow
+    stage drops frames instead of adding latency.
+    """
+
+    def __init__(self, capturer: Any, frame_processors: Optional[List[Any]] = None, workers: Optional[int] = None):
+        self.capturer = capturer
+        self.frame_processors = frame_processors or get_frame_processors_modules(modules.globals.frame_processors)
+        self.workers = workers or modules.globals.live_workers or 1
+        self.captured = FrameMailbox()
+        self.processed = FrameMailbox()
+        self.stats = LiveStats()
+        # width and height the frames are fitted to, set by the display
+        self.frame_size: Tuple[Optional[int], Optional[int]] = (None, None)
+        self.source_face = None
+        self.running = False
+        self.threads = []
+        self.lock = threading.Lock()
+        self.processed_sequence = -1
+        self.governor = None
+        if modules.globals.live_target_fps:
+            self.governor = LatencyGovernor(modules.globals.live_target_fps, self.workers)
+        self.knobs = QUALITY_LEVELS[0]
+        # the swapper's keyframe tracking, only used with a single worker
+        # as it follows one sequence of frames
+        self.propagator = None
+
+    def start(self) -> None:
+        if self.governor:
+            self.apply_knobs(self.governor.get_knobs())
+        self.running = True
+        self.threads = [threading.Thread(target=self.capture_loop, daemon=True)]
+        self.threads += [threading.Thread(target=self.inference_loop, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        self.captured.close()
+        self.processed.close()
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+        if self.governor:
+            set_detection_size(DETECTION_SIZE)
+            modules.globals.live_mouth_mask = True
+
+    def apply_knobs(self, knobs: dict) -> None:
+        set_detection_size(knobs["detection_size"])
+        # the user's switch stays as it is, the swapper needs both
+        modules.globals.live_mouth_mask = knobs["mouth_mask"]
+        self.knobs = knobs
+
+    def capture_loop(self) -> None:
+        sequence = 0
+        while self.running:
+            has_frame, frame = self.capturer.read()
+            if not has_frame:
+                break
+            self.captured.put((sequence, time.perf_counter(), frame))
+            sequence += 1
+        self.running = False
+        self.captured.close()
+
+    def inference_loop(self) -> None:
+        failed_frames = 0
+        while self.running:
+            item = self.captured.get(timeout=0.1)
+            if item is None:
+                continue
+            sequence, capture_time, frame = item
+            start = time.perf_counter()
+            stage_times = {}
+            try:
+                temp_frame = self.process(frame, stage_times)
+            except Exception as exception:
+                print(f"Failed live processing: {exception}")
+                failed_frames += 1
+                if failed_frames >= MAX_FAILED_FRAMES:
+                    # the display stops too instead of waiting on a frozen picture
+                    self.running = False
+                continue
+            failed_frames = 0
+            if self.governor:
+                with self.lock:
+                    if self.governor.update(time.perf_counter() - start, stage_times):
+                        self.apply_knobs(self.governor.get_knobs())
+            with self.lock:
+                # with several workers a result can finish after a newer one
+                if sequence < self.processed_sequence:
+                    continue
+                self.processed_sequence = sequence
+            self.processed.put((sequence, capture_time, temp_frame))
+        self.processed.close()
+
+    def process(self, frame: Frame, stage_times: Optional[dict] = None) -> Frame:
+        if modules.globals.live_mirror:
+            frame = cv2.flip(frame, 1)
+        frame = fit_image_to_size(frame, *self.frame_size)
+        if self.source_face is None and not modules.globals.map_faces and modules.globals.source_path:
+            self.source_face = get_one_face(cv2.imread(modules.globals.source_path))
+
+        knobs = self.knobs
+        height, width = frame.shape[:2]
+        if knobs["scale"] < 1:
+            frame = cv2.resize(frame, (max(1, int(width * knobs["scale"])), max(1, int(height * knobs["scale"]))))
+        propagator = None
+        if knobs["detection_interval"] > 1 and not modules.globals.map_faces:
+            propagator = self.get_propagator()
+            if propagator is not None:
+                propagator.interval = knobs["detection_interval"]
+        frame = process_live_frame(
+            frame, self.frame_processors, self.source_face, propagator, knobs["enhancer"], stage_times
+        )
+        if frame.shape[0] != height:
+            frame = cv2.resize(frame, (width, height))
+        return frame
+
+    def get_propagator(self) -> Any:
+        if self.propagator is None:
+            for frame_processor in self.frame_processors:
+                if frame_processor.NAME == "DLC.FACE-SWAPPER":
+                    self.propagator = frame_processor.SwapPropagator(1)
+        return self.propagator
+
+    @property
+    def dropped(self) -> int:
+        """Frames that were captured or processed but never shown."""
+        return self.captured.dropped + self.processed.dropped
@@ -0,0 +1,39 @@
+from typing import Any
+
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+from modules.typing import Frame
+
+
+class LiveDisplay:
+    """
+    Shows BGR frames on a label through one reused PhotoImage. Every frame is
+    converted to RGB into a reused buffer and pasted into the Tk image in
+    place, a new image is only made when the frame size changes. Frames come
+    fitted to the window already, nothing is resampled a second time.
+    A CTkLabel only takes CTkImages, the PhotoImage goes to the tk label
+    inside it. Frames are fitted to the window in real pixels, so they need
+    no widget scaling either.
+    """
+
+    def __init__(self, label: Any):
+        self.label = getattr(label, "_label", label)
+        self.photo = None
+        self.buffer = None
+
+    def show(self, frame: Frame) -> None:
+        height, width = frame.shape[:2]
+        if self.photo is None or (self.photo.width(), self.photo.height()) != (width, height):
+            self.photo = ImageTk.PhotoImage("RGB", (width, height))
+            self.label.configure(image=self.photo)
+        self.photo.paste(self.convert(frame))
+
+    def convert(self, frame: Frame) -> Image.Image:
+        """The frame as an RGB image on the reused buffer, valid until the next frame."""
+        height, width = frame.shape[:2]
+        if self.buffer is None or self.buffer.shape != frame.shape:
+            self.buffer = np.empty_like(frame)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.buffer)
+        return Image.frombuffer("RGB", (width, height), self.buffer, "raw", "RGB", 0, 1)
@@ -0,0 +1,352 @@
+import http.server
+import os
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from modules.typing import Frame
+from modules.video_capture import VideoCapturer
+
+DEFAULT_CAPTURE_SIZE = (960, 540)
+MJPEG_ADDRESS = "127.0.0.1:8080"
+MJPEG_QUALITY = 80
+MJPEG_BOUNDARY = b"frame"
+SHARED_MEMORY_NAME = "deep-live-cam"
+SHARED_MEMORY_SLOTS = 4
+# magic, slots, width, height, channels, frames written; frames follow at HEADER_SIZE
+SHARED_MEMORY_HEADER = struct.Struct("<4sIIIIQ")
+SHARED_MEMORY_MAGIC = b"DLCF"
+SHARED_MEMORY_HEADER_SIZE = 64
+SHARED_MEMORY_COUNTER_OFFSET = 20
+# rings written by this process, its resource tracker owns them
+SHARED_MEMORY_NAMES = set()
+
+
+def parse_size(size: Optional[str]) -> Optional[Tuple[int, int]]:
+    """"1280x720" as (1280, 720)."""
+    if not size:
+        return None
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+class PipeCapturer:
+    """
+    Raw bgr24 frames of a fixed size from a pipe, as written by
+    ffmpeg -i ... -f rawvideo -pix_fmt bgr24 -
+    """
+
+    def __init__(self, stream: Any, width: int, height: int):
+        self.stream = stream
+        self.shape = (height, width, 3)
+
+    def read(self) -> Tuple[bool, Optional[Frame]]:
+        frame = np.empty(self.shape, dtype=np.uint8)
+        view = memoryview(frame).cast("B")
+        filled = 0
+        while filled < len(view):
+            count = self.stream.readinto(view[filled:])
+            if not count:
+                return False, None
+            filled += count
+        return True, frame
+
+    def release(self) -> None:
+        pass
+
+
+class ReplayCapturer:
+    """
+    Plays a video file like a camera: frames come at the file's frame rate
+    on the wall clock, read() waits for the next one, and frames that went
+    by while nobody was reading are lost, as with a real device. loop starts
+    the file over at its end.
+    """
+
+    def __init__(self, video_path: str, loop: bool = False):
+        self.video_path = video_path
+        self.loop = loop
+        self.capture = cv2.VideoCapture(video_path)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.start_time = None
+        self.frame_number = -1
+        self.dropped = 0
+
+    def isOpened(self) -> bool:
+        return self.capture.isOpened()
+
+    def read(self) -> Tuple[bool, Optional[Frame]]:
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        due_number = int((time.perf_counter() - self.start_time) * self.fps)
+        if due_number <= self.frame_number:
+            due_number = self.frame_number + 1
+            time.sleep(max(0.0, self.start_time + due_number / self.fps - time.perf_counter()))
+
+        # frames that went by meanwhile are skipped without decoding
+        while self.frame_number < due_number - 1:
+            if not self.grab():
+                return False, None
+            self.frame_number += 1
+            self.dropped += 1
+        if not self.grab():
+            return False, None
+        self.frame_number += 1
+        return self.capture.retrieve()
+
+    def grab(self) -> bool:
+        if self.capture.grab():
+            return True
+        if not self.loop or self.frame_number < 0:
+            return False
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self.capture.grab()
+
+    def release(self) -> None:
+        self.capture.release()
+
+
+def create_capturer(source: str, size: Optional[Tuple[int, int]] = None) -> Optional[Any]:
+    """
+    A capturer for --live: a camera index, "-" for raw frames on stdin (needs
+    size), a video file replayed in real time or anything else
+    cv2.VideoCapture opens, like a stream url.
+    """
+    if source == "-":
+        if size is None:
+            return None
+        return PipeCapturer(sys.stdin.buffer, *size)
+    if source.isdigit():
+        capturer = VideoCapturer(int(source))
+        width, height = size or DEFAULT_CAPTURE_SIZE
+        return capturer if capturer.start(width, height, 60) else None
+    # files play at their frame rate, streams come paced already
+    capturer = ReplayCapturer(source) if os.path.isfile(source) else cv2.VideoCapture(source)
+    if not capturer.isOpened():
+        return None
+    return capturer
+
+
+class StdoutSink:
+    """
+    Raw bgr24 frames on stdout, for ffmpeg -f rawvideo -pix_fmt bgr24 -s WxH -i -
+    Status messages move to stderr so they do not end up between frames.
+    """
+
+    def __init__(self):
+        self.stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    def write(self, frame: Frame) -> None:
+        self.stream.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
+        self.stream.flush()
+
+    def close(self) -> None:
+        pass
+
+    def __str__(self) -> str:
+        return "stdout"
+
+
+class MjpegSink:
+    """
+    Multipart JPEG over HTTP, for a browser or ffplay http://host:port/.
+    Frames are only encoded while someone watches, and a slow viewer skips
+    frames rather than falling behind.
+    """
+
+    def __init__(self, address: Optional[str] = None, quality: int = MJPEG_QUALITY):
+        host, port = (address or MJPEG_ADDRESS).rsplit(":", 1)
+        self.address = f"{host}:{port}"
+        self.quality = quality
+        self.condition = threading.Condition()
+        self.jpeg = None
+        self.sequence = 0
+        self.clients = 0
+        self.running = True
+
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                sink.serve(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def write(self, frame: Frame) -> None:
+        if not self.clients:
+            return
+        _, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        with self.condition:
+            self.jpeg = jpeg.tobytes()
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def serve(self, handler: http.server.BaseHTTPRequestHandler) -> None:
+        handler.send_response(200)
+        handler.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY.decode()}")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.end_headers()
+        with self.condition:
+            self.clients += 1
+            sequence = self.sequence
+        try:
+            while self.running:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.sequence != sequence or not self.running, timeout=1)
+                    if self.sequence == sequence:
+                        continue
+                    jpeg, sequence = self.jpeg, self.sequence
+                handler.wfile.write(
+                    b"--" + MJPEG_BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                    + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n"
+                )
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.condition:
+                self.clients -= 1
+
+    def close(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __str__(self) -> str:
+        return f"http://{self.address}/"
+
+
+class SharedMemorySink:
+    """
+    A ring of frames in shared memory that a local process maps without
+    copying (see SharedMemoryReader). The header holds the ring size, the
+    frame shape and the number of frames written so far; frame n is in slot
+    n % slots and the counter is raised after the frame is complete. The
+    ring is made with the size of the first frame.
+    """
+
+    def __init__(self, name: Optional[str] = None, slots: int = SHARED_MEMORY_SLOTS):
+        self.name = name or SHARED_MEMORY_NAME
+        self.slots = slots
+        self.memory = None
+        self.frames = None
+        self.counter = 0
+        # the ring is only made with the first frame, a name in use should fail now
+        if self.name in SHARED_MEMORY_NAMES:
+            raise FileExistsError(get_shared_memory_in_use_message(self.name))
+        try:
+            open_shared_memory(self.name).close()
+        except FileNotFoundError:
+            pass
+        else:
+            raise FileExistsError(get_shared_memory_in_use_message(self.name))
+
+    def create(self, shape: Tuple[int, int, int]) -> None:
+        height, width, channels = shape
+        size = SHARED_MEMORY_HEADER_SIZE + height * width * channels * self.slots
+        try:
+            self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            raise FileExistsError(get_shared_memory_in_use_message(self.name))
+        SHARED_MEMORY_NAMES.add(self.name)
+        SHARED_MEMORY_HEADER.pack_into(
+            self.memory.buf, 0, SHARED_MEMORY_MAGIC, self.slots, width, height, channels, 0
+        )
+        self.frames = np.ndarray(
+            (self.slots, height, width, channels), dtype=np.uint8,
+            buffer=self.memory.buf, offset=SHARED_MEMORY_HEADER_SIZE,
+        )
+
+    def write(self, frame: Frame) -> None:
+        if self.memory is None:
+            self.create(frame.shape)
+        if frame.shape != self.frames.shape[1:]:
+            frame = cv2.resize(frame, (self.frames.shape[2], self.frames.shape[1]))
+        self.frames[self.counter % self.slots] = frame
+        self.counter += 1
+        struct.pack_into("<Q", self.memory.buf, SHARED_MEMORY_COUNTER_OFFSET, self.counter)
+
+    def close(self) -> None:
+        if self.memory is not None:
+            self.frames = None
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+            SHARED_MEMORY_NAMES.discard(self.name)
+
+    def __str__(self) -> str:
+        return f"shared memory {self.name}"
+
+
+def get_shared_memory_in_use_message(name: str) -> str:
+    return (
+        f"shared memory {name} is in use by another live writer, give this one another name"
+        f" (or remove /dev/shm/{name} if it was left behind by a writer that crashed)"
+    )
+
+
+def open_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to an existing segment without taking ownership. Before Python
+    3.13 attaching registers the segment with this process's resource
+    tracker, which would unlink it under the writer when this process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    memory = shared_memory.SharedMemory(name=name)
+    if name not in SHARED_MEMORY_NAMES:
+        resource_tracker.unregister(memory._name, "shared_memory")
+    return memory
+
+
+class SharedMemoryReader:
+    """The consumer side of SharedMemorySink, latest() is a view into the ring."""
+
+    def __init__(self, name: str = SHARED_MEMORY_NAME):
+        self.memory = open_shared_memory(name)
+        magic, self.slots, width, height, channels, _ = SHARED_MEMORY_HEADER.unpack_from(self.memory.buf, 0)
+        if magic != SHARED_MEMORY_MAGIC:
+            raise ValueError(f"{name} is not a frame ring")
+        self.frames = np.ndarray(
+            (self.slots, height, width, channels), dtype=np.uint8,
+            buffer=self.memory.buf, offset=SHARED_MEMORY_HEADER_SIZE,
+        )
+
+    def get_counter(self) -> int:
+        return struct.unpack_from("<Q", self.memory.buf, SHARED_MEMORY_COUNTER_OFFSET)[0]
+
+    def latest(self) -> Tuple[int, Optional[Frame]]:
+        """
+        Number of frames written and a view of the newest. The slot stays
+        valid until the writer has gone around the ring, compare get_counter()
+        after use when that matters.
+        """
+        counter = self.get_counter()
+        if counter == 0:
+            return 0, None
+        return counter, self.frames[(counter - 1) % self.slots]
+
+    def close(self) -> None:
+        self.frames = None
+        self.memory.close()
+
+
+def create_sink(sink: str, address: Optional[str] = None) -> Any:
+    if sink == "stdout":
+        return StdoutSink()
+    if sink == "shm":
+        return SharedMemorySink(address)
+    return MjpegSink(address)
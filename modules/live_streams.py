@@ -0,0 +1,219 @@
+import json
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+import cv2
+
+import modules.globals
+from modules.cluster_analysis import normalize_embeddings
+from modules.face_analyser import get_one_face
+from modules.live import MAX_FAILED_FRAMES, LiveStats, process_live_frame
+from modules.live_io import MJPEG_ADDRESS, SHARED_MEMORY_NAME, create_capturer, create_sink, parse_size
+from modules.processors.frame.core import get_frame_processors_modules
+from modules.typing import Face, Frame
+
+
+class LiveStream:
+    """
+    One input of the multi-stream engine with its own source face or
+    mapping, sink and stats. Only the newest captured frame waits to be
+    processed, older ones are dropped.
+    """
+
+    def __init__(self, name: str, capturer: Any, sink: Any, source_face: Optional[Face] = None, simple_map: Optional[dict] = None):
+        self.name = name
+        self.capturer = capturer
+        self.sink = sink
+        self.source_face = source_face
+        self.simple_map = simple_map
+        self.stats = LiveStats()
+        self.pending = None
+        self.busy = False
+        self.running = False
+        self.dropped = 0
+        self.failed_frames = 0
+
+
+class MultiStreamEngine:
+    """
+    Serves several live streams with one set of models. The detector,
+    swapper and enhancer sessions are the process-wide ones, shared by a
+    pool of workers. Workers take streams round-robin, one frame of a stream
+    at a time so its frames stay in order, and always the newest frame: when
+    the streams ask for more than the workers manage, every stream drops
+    frames evenly and latency stays at about one processing round.
+    """
+
+    def __init__(self, streams: List[LiveStream], frame_processors: Optional[List[Any]] = None, workers: Optional[int] = None):
+        self.streams = streams
+        self.frame_processors = frame_processors or get_frame_processors_modules(modules.globals.frame_processors)
+        self.workers = workers or modules.globals.live_workers or 1
+        self.condition = threading.Condition()
+        self.cursor = 0
+        self.running = False
+        self.threads = []
+
+    def start(self) -> None:
+        self.running = True
+        for stream in self.streams:
+            stream.running = True
+            self.threads.append(threading.Thread(target=self.capture_loop, args=(stream,), daemon=True))
+        self.threads += [threading.Thread(target=self.work_loop, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+
+    @property
+    def active(self) -> bool:
+        with self.condition:
+            return self.running and any(
+                stream.running or stream.pending is not None or stream.busy for stream in self.streams
+            )
+
+    def capture_loop(self, stream: LiveStream) -> None:
+        while self.running and stream.running:
+            has_frame, frame = stream.capturer.read()
+            if not has_frame:
+                break
+            with self.condition:
+                if stream.pending is not None:
+                    stream.dropped += 1
+                stream.pending = (time.perf_counter(), frame)
+                self.condition.notify()
+        with self.condition:
+            stream.running = False
+            self.condition.notify_all()
+
+    def next_job(self) -> Optional[Tuple[LiveStream, float, Frame]]:
+        """The newest frame of the next stream in turn that has one, called holding the condition."""
+        for offset in range(len(self.streams)):
+            index = (self.cursor + offset) % len(self.streams)
+            stream = self.streams[index]
+            if stream.pending is not None and not stream.busy:
+                self.cursor = index + 1
+                capture_time, frame = stream.pending
+                stream.pending = None
+                stream.busy = True
+                return stream, capture_time, frame
+        return None
+
+    def work_loop(self) -> None:
+        while self.running:
+            with self.condition:
+                job = self.condition.wait_for(self.next_job, timeout=0.1)
+            if job is None:
+                continue
+            stream, capture_time, frame = job
+            try:
+                if modules.globals.live_mirror:
+                    frame = cv2.flip(frame, 1)
+                temp_frame = process_live_frame(
+                    frame, self.frame_processors, stream.source_face, simple_map=stream.simple_map
+                )
+                stream.sink.write(temp_frame)
+                stream.stats.record(capture_time)
+                stream.failed_frames = 0
+            except (BrokenPipeError, ConnectionResetError):
+                stream.running = False
+            except Exception as exception:
+                print(f"Failed live processing of {stream.name}: {exception}")
+                stream.failed_frames += 1
+                if stream.failed_frames >= MAX_FAILED_FRAMES:
+                    stream.running = False
+            finally:
+                with self.condition:
+                    stream.busy = False
+                    self.condition.notify()
+
+    def get_report(self) -> dict:
+        return {
+            stream.name: {
+                "fps": round(stream.stats.fps, 1),
+                "frames": stream.stats.frames,
+                "dropped": stream.dropped,
+                "latency_p50_ms": round(stream.stats.get_latency(50), 1),
+                "latency_p95_ms": round(stream.stats.get_latency(95), 1),
+            }
+            for stream in self.streams
+        }
+
+
+def load_face(image_path: str) -> Optional[Face]:
+    image = cv2.imread(image_path)
+    return get_one_face(image) if image is not None else None
+
+
+def load_streams(config_path: str) -> List[LiveStream]:
+    """
+    Streams from a json list, one object per stream:
+    {"input": "0", "size": "1280x720", "source": "face.jpg", "sink": "mjpeg", "sink_address": "127.0.0.1:8081"}
+    with "map": [{"source": "a.jpg", "target": "b.jpg"}, ...] in place of
+    "source" to swap mapped faces. input, size, sink and sink_address take
+    the values of --live, --live-size, --live-sink and --live-sink-address.
+    Without a sink_address every stream gets its own mjpeg port or shm ring.
+    """
+    with open(config_path, "r") as f:
+        configs = json.load(f)
+    # there is one stdin and one stdout to share between the streams
+    for key, value in (("input", "-"), ("sink", "stdout")):
+        if sum(str(config.get(key)) == value for config in configs) > 1:
+            raise ValueError(f'only one stream can have "{key}": "{value}"')
+
+    streams = []
+    try:
+        for index, config in enumerate(configs):
+            name = config.get("name", f"stream-{index}")
+            source_face = None
+            simple_map = None
+            if "map" in config:
+                source_faces = [load_face(pair["source"]) for pair in config["map"]]
+                target_faces = [load_face(pair["target"]) for pair in config["map"]]
+                if not all(source_faces) or not all(target_faces):
+                    raise ValueError(f"{name}: no face found in a mapped image")
+                simple_map = {
+                    "source_faces": source_faces,
+                    "target_embeddings": [face.normed_embedding for face in target_faces],
+                    "target_matrix": normalize_embeddings([face.normed_embedding for face in target_faces]),
+                }
+            else:
+                source_face = load_face(config["source"])
+                if source_face is None:
+                    raise ValueError(f"{name}: no face found in {config['source']}")
+
+            capturer = create_capturer(str(config["input"]), parse_size(config.get("size")))
+            if capturer is None:
+                raise ValueError(f"{name}: failed to open {config['input']}")
+            try:
+                sink_type = config.get("sink", "mjpeg")
+                sink = create_sink(sink_type, config.get("sink_address") or get_default_sink_address(sink_type, index, name))
+            except Exception:
+                capturer.release()
+                raise
+            streams.append(LiveStream(name, capturer, sink, source_face, simple_map))
+    except Exception:
+        release_streams(streams)
+        raise
+    return streams
+
+
+def get_default_sink_address(sink: str, index: int, name: str) -> Optional[str]:
+    if sink == "shm":
+        return f"{SHARED_MEMORY_NAME}-{name}"
+    if sink == "mjpeg":
+        host, port = MJPEG_ADDRESS.rsplit(":", 1)
+        return f"{host}:{int(port) + index}"
+    return None
+
+
+def release_streams(streams: List[LiveStream]) -> None:
+    for stream in streams:
+        stream.capturer.release()
+        stream.sink.close()
@@ -1,36 +1,138 @@
+import io
+import os
+import threading
+from typing import Any, List
+
 import numpy
-import opennsfw2
 from PIL import Image
-import cv2  # Add OpenCV import
-import modules.globals  # Import globals to access the color correction toggle
+import cv2
+import modules.globals
 
 from modules.typing import Frame
 
 MAX_PROBABILITY = 0.85
+# frames classified per model run
+BATCH_SIZE = 16
+# every n-th frame of a video is classified
+FRAME_INTERVAL = 100
+# OpenNSFW2 converted by export_open_nsfw.py, runs without tensorflow
+ONNX_MODEL_PATH = os.path.join(
+    os.path.dirname(modules.globals.ROOT_DIR), "models", "open_nsfw.onnx"
+)
+VGG_MEAN = numpy.array([104, 117, 123], dtype=numpy.float32)
 
 # Preload the model once for efficiency
 model = None
+THREAD_LOCK = threading.Lock()
 
-def predict_frame(target_frame: Frame) -> bool:
-    # Convert the frame to RGB before processing if color correction is enabled
-    if modules.globals.color_correction:
-        target_frame = cv2.cvtColor(target_frame, cv2.COLOR_BGR2RGB)
-        
-    image = Image.fromarray(target_frame)
-    image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
+
+def get_model() -> Any:
+    """
+    The classifier, loaded once: the onnx conversion through the session
+    factory when it exists, the opennsfw2 keras model otherwise.
+    """
     global model
-    if model is None: 
-        model = opennsfw2.make_open_nsfw_model()
-        
-    views = numpy.expand_dims(image, axis=0)
-    _, probability = model.predict(views)[0]
-    return probability > MAX_PROBABILITY
+
+    with THREAD_LOCK:
+        if model is None:
+            if os.path.isfile(ONNX_MODEL_PATH):
+                from modules.session_factory import create_inference_session
+
+                model = create_inference_session(ONNX_MODEL_PATH)
+            else:
+                import opennsfw2
+                import tensorflow
+
+                # prevent tensorflow memory leak
+                for gpu in tensorflow.config.experimental.list_physical_devices('GPU'):
+                    tensorflow.config.experimental.set_memory_growth(gpu, True)
+                model = opennsfw2.make_open_nsfw_model()
+    return model
+
+
+def preprocess_frame(target_frame: Frame) -> numpy.ndarray:
+    # opennsfw2 Preprocessing.YAHOO, including its jpeg round trip, without
+    # importing opennsfw2
+    image = Image.fromarray(cv2.cvtColor(target_frame, cv2.COLOR_BGR2RGB))
+    image = image.resize((256, 256), resample=Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    buffer.seek(0)
+    image = numpy.array(Image.open(buffer), dtype=numpy.float32)
+    image = image[16:240, 16:240, ::-1]
+    return image - VGG_MEAN
+
+
+def predict_probabilities(target_frames: List[Frame]) -> numpy.ndarray:
+    """NSFW probability of every frame, classified in batches of BATCH_SIZE."""
+    classifier = get_model()
+    probabilities = []
+    for index in range(0, len(target_frames), BATCH_SIZE):
+        views = numpy.stack([preprocess_frame(target_frame) for target_frame in target_frames[index:index + BATCH_SIZE]])
+        if hasattr(classifier, "get_inputs"):
+            predictions = classifier.run(None, {classifier.get_inputs()[0].name: views})[0]
+        else:
+            predictions = classifier.predict(views, verbose=0)
+        probabilities.append(predictions[:, 1])
+    if not probabilities:
+        return numpy.zeros(0, dtype=numpy.float32)
+    return numpy.concatenate(probabilities)
+
+
+def predict_frame(target_frame: Frame) -> bool:
+    return predict_probabilities([target_frame])[0] > MAX_PROBABILITY
 
 
 def predict_image(target_path: str) -> bool:
-    return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+    target_frame = cv2.imread(target_path)
+    return target_frame is not None and predict_frame(target_frame)
 
 
 def predict_video(target_path: str) -> bool:
-    _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
-    return any(probability > MAX_PROBABILITY for probability in probabilities)
+    capture = cv2.VideoCapture(target_path)
+    target_frames = []
+    frame_number = 0
+    try:
+        # frames in between are only grabbed, not decoded into images
+        while capture.grab():
+            if frame_number % FRAME_INTERVAL == 0:
+                has_frame, target_frame = capture.retrieve()
+                if has_frame:
+                    target_frames.append(target_frame)
+            frame_number += 1
+            if len(target_frames) == BATCH_SIZE:
+                if numpy.any(predict_probabilities(target_frames) > MAX_PROBABILITY):
+                    return True
+                target_frames = []
+    finally:
+        capture.release()
+    return bool(numpy.any(predict_probabilities(target_frames) > MAX_PROBABILITY))
+
+
+class FrameGate:
+    """
+    Checks the frames of a video while extract_frames writes them, so the
+    video is only decoded once. Every FRAME_INTERVAL-th frame is classified,
+    BATCH_SIZE at a time; the first batch over MAX_PROBABILITY rejects it.
+    """
+
+    def __init__(self):
+        self.frame_number = 0
+        self.target_frames = []
+
+    def add(self, frame_path: str) -> bool:
+        """Returns False once the video is rejected."""
+        if self.frame_number % FRAME_INTERVAL == 0:
+            target_frame = cv2.imread(frame_path)
+            if target_frame is not None:
+                self.target_frames.append(target_frame)
+        self.frame_number += 1
+        if len(self.target_frames) == BATCH_SIZE:
+            return self.finish()
+        return True
+
+    def finish(self) -> bool:
+        """Classifies the frames still pending, returns False if the video is rejected."""
+        target_frames = self.target_frames
+        self.target_frames = []
+        return not numpy.any(predict_probabilities(target_frames) > MAX_PROBABILITY)
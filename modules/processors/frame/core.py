@@ -1,14 +1,23 @@
 import sys
 import importlib
+import threading
+import cv2
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional
 from tqdm import tqdm
 
 import modules
 import modules.globals                   
+from modules.typing import Face
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+# faces found by an earlier processor, so later ones do not detect again
+FRAME_FACES = {}
+FRAME_FACES_LOCK = threading.Lock()
+FRAME_FACES_LOCAL = threading.local()
+FRAME_FINGERPRINT_SIZE = (64, 36)
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
@@ -67,10 +76,14 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
                  print(f"Warning: Error removing frame processor {frame_processor}: {e}")
 
 def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
-    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
+    # workers get runs of consecutive frames, so processors can compare each
+    # frame with its predecessor and set up per-run state only once
+    execution_threads = modules.globals.execution_threads or 1
+    chunk_size = max(1, -(-len(temp_frame_paths) // (execution_threads * 4)))
+    with ThreadPoolExecutor(max_workers=execution_threads) as executor:
         futures = []
-        for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], progress)
+        for index in range(0, len(temp_frame_paths), chunk_size):
+            future = executor.submit(process_frames, source_path, temp_frame_paths[index:index + chunk_size], progress)
             futures.append(future)
         for future in futures:
             future.result()
@@ -82,3 +95,51 @@ def process_video(source_path: str, frame_paths: list[str], process_frames: Call
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
         progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
         multi_process_frame(source_path, frame_paths, process_frames, progress)
+
+
+def get_frame_fingerprint(frame: Any) -> Any:
+    # area downsampled grayscale, every cell averages enough pixels to wash
+    # out compression noise while local motion still shows up
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, FRAME_FINGERPRINT_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def get_fingerprint_difference(previous_fingerprint: Any, fingerprint: Any) -> float:
+    if previous_fingerprint is None or fingerprint is None:
+        return float('inf')
+    return float(np.max(np.abs(fingerprint - previous_fingerprint)))
+
+
+def set_frame_faces(frame: Any, faces: List[Any], frame_path: str = None) -> None:
+    """
+    Record the faces found on a processed frame for the processors that run
+    after this one. Video frames are keyed by their path, live and preview
+    frames by the frame itself, which is handed on within the same thread.
+    """
+    faces = [
+        Face(bbox=face.bbox, kps=face.kps)
+        for face in faces or []
+        if getattr(face, 'kps', None) is not None
+    ]
+    if frame_path is None:
+        FRAME_FACES_LOCAL.frame = frame
+        FRAME_FACES_LOCAL.faces = faces
+        return
+    with FRAME_FACES_LOCK:
+        FRAME_FACES[frame_path] = faces
+
+
+def get_frame_faces(frame: Any, frame_path: str = None) -> Optional[List[Any]]:
+    """Faces recorded for the frame, None if no earlier processor saw it."""
+    if frame_path is None:
+        if getattr(FRAME_FACES_LOCAL, 'frame', None) is frame:
+            return FRAME_FACES_LOCAL.faces
+        return None
+    with FRAME_FACES_LOCK:
+        return FRAME_FACES.pop(frame_path, None)
+
+
+def clear_frame_faces() -> None:
+    FRAME_FACES_LOCAL.frame = None
+    with FRAME_FACES_LOCK:
+        FRAME_FACES.clear()
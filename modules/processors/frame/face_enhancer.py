@@ -1,34 +1,102 @@
-from typing import Any, List
+from contextlib import contextmanager
+from typing import Any, Iterator, List
 import cv2
+import queue
 import threading
-import gfpgan
+import numpy as np
 import os
 
 import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face
+from modules.face_analyser import get_many_faces
+from modules.processors.frame.core import get_frame_faces
+from modules.session_factory import create_inference_session
 from modules.typing import Frame, Face
 import platform
-import torch
 from modules.utilities import (
     conditional_download,
     is_image,
     is_video,
 )
 
-FACE_ENHANCER = None
-THREAD_SEMAPHORE = threading.Semaphore()
+# the onnx backend needs neither torch nor gfpgan
+try:
+    import gfpgan
+    import torch
+except ImportError:
+    gfpgan = None
+    torch = None
+
+# idle GFPGAN replicas, workers check one out per frame
+FACE_ENHANCERS = queue.Queue()
+FACE_ENHANCER_COUNT = 0
+# rough resident size of one replica on cpu: GFPGAN, the facexlib helper
+# models and the activations of a 512px pass
+ENHANCER_REPLICA_MEMORY = 1.5
+# rough peak memory of one more 512px face in a batch, in GB
+ENHANCER_FACE_MEMORY = 0.5
+# how torch (cuda, mps, cpu) and onnxruntime word failed allocations
+OUT_OF_MEMORY_MESSAGES = ("out of memory", "failed to allocate", "can't allocate", "bad allocation", "bad_alloc")
+# frames held back for a batch, as a multiple of the batch size, so a long
+# stretch without faces does not keep all its frames in memory
+MAX_PENDING_BATCHES = 4
 THREAD_LOCK = threading.Lock()
+THREAD_LOCAL = threading.local()
 NAME = "DLC.FACE-ENHANCER"
+# facexlib's five point template for the 512px GFPGAN input
+FACE_SIZE = 512
+FACE_TEMPLATE = np.array(
+    [
+        [192.98138, 239.94708],
+        [318.90277, 240.1936],
+        [256.63416, 314.01935],
+        [201.26117, 371.41043],
+        [313.08905, 371.15118],
+    ],
+    dtype=np.float32,
+)
+# face parsing classes pasted back, background, neck, cloth and hat are not
+PARSE_MASK_COLORMAP = np.array(
+    [0, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 0, 255, 0, 0, 0],
+    dtype=np.float64,
+)
 
 abs_dir = os.path.dirname(os.path.abspath(__file__))
 models_dir = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(abs_dir))), "models"
 )
+# written by export_gfpgan.py
+ONNX_ENHANCER_MODEL = "GFPGANv1.4.onnx"
+ONNX_PARSER_MODEL = "parsing_parsenet.onnx"
+ONNX_SESSIONS = None
+
+
+def get_enhancer_backend() -> str:
+    backend = modules.globals.enhancer_backend
+    if backend == "auto":
+        onnx_exported = all(
+            os.path.isfile(os.path.join(models_dir, model_name))
+            for model_name in (ONNX_ENHANCER_MODEL, ONNX_PARSER_MODEL)
+        )
+        backend = "onnx" if onnx_exported or gfpgan is None else "torch"
+    return backend
 
 
 def pre_check() -> bool:
+    if get_enhancer_backend() == "onnx":
+        for model_name in (ONNX_ENHANCER_MODEL, ONNX_PARSER_MODEL):
+            if not os.path.isfile(os.path.join(models_dir, model_name)):
+                update_status(
+                    f"{model_name} not found, export it with export_gfpgan.py or use --enhancer-backend torch.",
+                    NAME,
+                )
+                return False
+        return True
+
+    if gfpgan is None:
+        update_status("gfpgan and torch are required for --enhancer-backend torch.", NAME)
+        return False
     download_directory_path = models_dir
     conditional_download(
         download_directory_path,
@@ -59,58 +127,356 @@ except Exception as e:
     print(f"TensorRT is not available: {e}")
     pass
 
-def get_face_enhancer() -> Any:
-    global FACE_ENHANCER
+def get_device() -> Any:
+    if torch is None:
+        return None
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available() and platform.system() == "Darwin":
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def get_enhancer_replicas() -> int:
+    """
+    Replicas allowed at once: --enhancer-replicas, by default one per
+    execution thread on cpu and one on a gpu. Torch replicas are model
+    copies and never more of them than fit into --max-memory.
+    """
+    replicas = modules.globals.enhancer_replicas
+    # onnx replicas share their sessions, they only bound concurrency
+    onnx_backend = get_enhancer_backend() == "onnx"
+    if not replicas:
+        replicas = 1
+        if onnx_backend or get_device().type == "cpu":
+            replicas = modules.globals.execution_threads or 1
+    if modules.globals.max_memory and not onnx_backend:
+        replicas = min(replicas, int(modules.globals.max_memory // ENHANCER_REPLICA_MEMORY))
+    return max(1, replicas)
+
+
+def to_blob(images: np.ndarray) -> np.ndarray:
+    # bgr uint8 NxHxWx3 to normalised Nx3xHxW rgb, as GFPGANer.enhance does
+    blob = images[:, :, :, ::-1].transpose(0, 3, 1, 2).astype(np.float32)
+    return blob / 127.5 - 1.0
+
+
+def from_blob(blob: np.ndarray) -> np.ndarray:
+    images = np.rint((np.clip(blob, -1, 1) + 1) * 127.5).astype(np.uint8)
+    return np.ascontiguousarray(images.transpose(0, 2, 3, 1)[:, :, :, ::-1])
+
+
+class TorchFaceEnhancer:
+    """GFPGANv1.4 and the facexlib face parser, run by torch."""
+
+    def __init__(self):
+        self.device = get_device()
+        device_priority = [self.device.type.upper()]
+        if TENSORRT_AVAILABLE and self.device.type == "cuda":
+            device_priority = ["TensorRT+CUDA"]
+        self.gfpganer = gfpgan.GFPGANer(
+            model_path=os.path.join(models_dir, "GFPGANv1.4.pth"),
+            upscale=1,
+            device=self.device,
+        )
+
+        # for debug:
+        print(f"Selected device: {self.device} and device priority: {device_priority}")
+
+    def restore(self, cropped_faces: np.ndarray, randomize_noise: bool = True) -> np.ndarray:
+        with torch.no_grad():
+            output = self.gfpganer.gfpgan(
+                torch.from_numpy(to_blob(cropped_faces)).to(self.device),
+                return_rgb=False,
+                randomize_noise=randomize_noise,
+            )[0]
+        return from_blob(output.float().cpu().numpy())
+
+    def parse(self, restored_faces: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            parsing = self.gfpganer.face_helper.face_parse(
+                torch.from_numpy(to_blob(restored_faces)).to(self.device)
+            )[0]
+        return parsing.argmax(dim=1).cpu().numpy()
+
+
+class OnnxFaceEnhancer:
+    """
+    The same two networks exported by export_gfpgan.py, run by onnxruntime
+    with the execution providers of the swapper. The exported generator
+    uses the fixed noise maps of the model instead of random noise. The
+    graphs have a fixed batch size of 1, every face is a run of its own.
+    """
+
+    def __init__(self):
+        global ONNX_SESSIONS
+
+        with THREAD_LOCK:
+            if ONNX_SESSIONS is None:
+                ONNX_SESSIONS = tuple(
+                    create_inference_session(os.path.join(models_dir, model_name))
+                    for model_name in (ONNX_ENHANCER_MODEL, ONNX_PARSER_MODEL)
+                )
+        self.device = None
+        self.enhancer_session, self.parser_session = ONNX_SESSIONS
+
+    def restore(self, cropped_faces: np.ndarray, randomize_noise: bool = False) -> np.ndarray:
+        session = self.enhancer_session
+        input_name = session.get_inputs()[0].name
+        blob = to_blob(cropped_faces)
+        output = np.concatenate([session.run(None, {input_name: blob[index:index + 1]})[0] for index in range(len(blob))])
+        return from_blob(output)
+
+    def parse(self, restored_faces: np.ndarray) -> np.ndarray:
+        session = self.parser_session
+        input_name = session.get_inputs()[0].name
+        blob = to_blob(restored_faces)
+        parsing = np.concatenate([session.run(None, {input_name: blob[index:index + 1]})[0] for index in range(len(blob))])
+        return parsing.argmax(axis=1)
+
+
+def create_face_enhancer() -> Any:
+    if get_enhancer_backend() == "onnx":
+        return OnnxFaceEnhancer()
+    return TorchFaceEnhancer()
+
+
+def set_torch_threads() -> None:
+    # torch keeps the intra-op thread count per calling thread, every worker
+    # gets its share of the cores so the replicas do not oversubscribe them
+    threads = max(1, (os.cpu_count() or 1) // get_enhancer_replicas())
+    if getattr(THREAD_LOCAL, "torch_threads", None) != threads:
+        torch.set_num_threads(threads)
+        THREAD_LOCAL.torch_threads = threads
+
+
+@contextmanager
+def checkout_face_enhancer() -> Iterator[Any]:
+    """
+    Borrow a replica for the calling thread. Replicas are created on demand
+    until get_enhancer_replicas() exist, after that callers wait for one to
+    be returned.
+    """
+    global FACE_ENHANCER_COUNT
 
     with THREAD_LOCK:
-        if FACE_ENHANCER is None:
-            model_path = os.path.join(models_dir, "GFPGANv1.4.pth")
-            
-            selected_device = None
-            device_priority = []
-
-            if TENSORRT_AVAILABLE and torch.cuda.is_available():
-                selected_device = torch.device("cuda")
-                device_priority.append("TensorRT+CUDA")
-            elif torch.cuda.is_available():
-                selected_device = torch.device("cuda")
-                device_priority.append("CUDA")
-            elif torch.backends.mps.is_available() and platform.system() == "Darwin":
-                selected_device = torch.device("mps")
-                device_priority.append("MPS")
-            elif not torch.cuda.is_available():
-                selected_device = torch.device("cpu")
-                device_priority.append("CPU")
-            
-            FACE_ENHANCER = gfpgan.GFPGANer(model_path=model_path, upscale=1, device=selected_device)
-
-            # for debug:
-            print(f"Selected device: {selected_device} and device priority: {device_priority}")
-    return FACE_ENHANCER
-
-
-def enhance_face(temp_frame: Frame) -> Frame:
-    with THREAD_SEMAPHORE:
-        _, _, temp_frame = get_face_enhancer().enhance(temp_frame, paste_back=True)
-    return temp_frame
+        create = FACE_ENHANCERS.empty() and FACE_ENHANCER_COUNT < get_enhancer_replicas()
+        if create:
+            FACE_ENHANCER_COUNT += 1
+    if create:
+        try:
+            face_enhancer = create_face_enhancer()
+        except Exception:
+            with THREAD_LOCK:
+                FACE_ENHANCER_COUNT -= 1
+            raise
+    else:
+        face_enhancer = FACE_ENHANCERS.get()
+
+    if face_enhancer.device is not None and face_enhancer.device.type == "cpu":
+        set_torch_threads()
+    try:
+        yield face_enhancer
+    finally:
+        FACE_ENHANCERS.put(face_enhancer)
+
+
+def is_gpu_backend(face_enhancer: Any) -> bool:
+    if face_enhancer.device is not None:
+        return face_enhancer.device.type != "cpu"
+    return any(
+        provider != "CPUExecutionProvider"
+        for provider in modules.globals.execution_providers
+    )
+
+
+def get_enhancer_batch_size(face_enhancer: Any) -> int:
+    """
+    Faces per GFPGAN run: --enhancer-batch-size, by default 8 on a gpu and 1
+    on cpu where batching gains little. Bounded by the share of --max-memory
+    each replica has and, with torch on cuda, by the free device memory. The
+    exported onnx graphs take one face per run, batches gain nothing there.
+    """
+    if isinstance(face_enhancer, OnnxFaceEnhancer):
+        return 1
+    batch_size = modules.globals.enhancer_batch_size
+    if not batch_size:
+        batch_size = 8 if is_gpu_backend(face_enhancer) else 1
+    if modules.globals.max_memory:
+        replica_memory = modules.globals.max_memory / get_enhancer_replicas()
+        batch_size = min(batch_size, int(replica_memory // ENHANCER_FACE_MEMORY))
+    if face_enhancer.device is not None and face_enhancer.device.type == "cuda":
+        free_memory, _ = torch.cuda.mem_get_info(face_enhancer.device)
+        batch_size = min(batch_size, int(free_memory / 1024 ** 3 // ENHANCER_FACE_MEMORY))
+    return max(1, batch_size)
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    # torch raises RuntimeError subclasses, onnxruntime its own Exception
+    # subclasses, only the message tells a failed allocation apart
+    message = str(error).lower()
+    return any(text in message for text in OUT_OF_MEMORY_MESSAGES)
+
+
+def restore_faces(face_enhancer: Any, cropped_faces: np.ndarray) -> np.ndarray:
+    try:
+        return face_enhancer.restore(cropped_faces)
+    except Exception as error:
+        if not is_out_of_memory(error):
+            raise
+        if len(cropped_faces) > 1:
+            # one at a time still fits
+            return np.concatenate(
+                [restore_faces(face_enhancer, cropped_faces[index:index + 1]) for index in range(len(cropped_faces))]
+            )
+        print(f"Failed inference for GFPGAN: {error}.")
+        return cropped_faces
+
+
+def get_face_masks(face_enhancer: Any, restored_faces: np.ndarray) -> List[np.ndarray]:
+    return [get_face_mask(parsing) for parsing in face_enhancer.parse(restored_faces)]
+
+
+def get_face_mask(parsing: np.ndarray) -> np.ndarray:
+    # facexlib paste_faces_to_input_image with use_parse, as GFPGANer sets it
+    mask = PARSE_MASK_COLORMAP[parsing]
+    mask = cv2.GaussianBlur(mask, (101, 101), 11)
+    mask = cv2.GaussianBlur(mask, (101, 101), 11)
+    mask[:10, :] = 0
+    mask[-10:, :] = 0
+    mask[:, :10] = 0
+    mask[:, -10:] = 0
+    return mask / 255.0
+
+
+def align_face(temp_frame: Frame, target_face: Face, face_size: int = FACE_SIZE) -> Any:
+    affine_matrix = cv2.estimateAffinePartial2D(
+        target_face.kps.astype(np.float32),
+        FACE_TEMPLATE * (face_size / FACE_SIZE),
+        method=cv2.LMEDS,
+    )[0]
+    if affine_matrix is None:
+        return None, None
+    cropped_face = cv2.warpAffine(
+        temp_frame,
+        affine_matrix,
+        (face_size, face_size),
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(135, 133, 132),
+    )
+    return cropped_face, affine_matrix
+
+
+def paste_face(
+    temp_frame: Frame, restored_face: np.ndarray, mask: np.ndarray, affine_matrix: np.ndarray
+) -> None:
+    # the mask is zero along the crop border, so nothing outside the area
+    # the crop lands on changes and the paste stays inside that roi
+    inverse_affine = cv2.invertAffineTransform(affine_matrix)
+    face_size = restored_face.shape[0]
+    corners = np.array(
+        [[0, 0, 1], [face_size, 0, 1], [0, face_size, 1], [face_size, face_size, 1]],
+        dtype=np.float64,
+    ) @ inverse_affine.T
+    frame_height, frame_width = temp_frame.shape[:2]
+    x1 = max(0, int(np.floor(corners[:, 0].min())))
+    y1 = max(0, int(np.floor(corners[:, 1].min())))
+    x2 = min(frame_width, int(np.ceil(corners[:, 0].max())) + 1)
+    y2 = min(frame_height, int(np.ceil(corners[:, 1].max())) + 1)
+    if x2 <= x1 or y2 <= y1:
+        return
+
+    inverse_affine[:, 2] -= (x1, y1)
+    roi_size = (x2 - x1, y2 - y1)
+    inverse_restored = cv2.warpAffine(restored_face, inverse_affine, roi_size)
+    inverse_mask = cv2.warpAffine(mask, inverse_affine, roi_size, flags=cv2.INTER_AREA)[:, :, None]
+    roi = temp_frame[y1:y2, x1:x2]
+    roi[:] = (inverse_mask * inverse_restored + (1 - inverse_mask) * roi).astype(np.uint8)
+
+
+def enhance_face(temp_frame: Frame, target_faces: List[Face] = None) -> Frame:
+    """
+    Enhance the given faces, detecting them only when no earlier processor
+    passed them on. Only the aligned 512px crops go through GFPGAN and they
+    are pasted back within their own area of the frame.
+    """
+    return enhance_frames([temp_frame], [target_faces])[0]
+
+
+def enhance_frames(temp_frames: List[Frame], frames_faces: List[List[Face]]) -> List[Frame]:
+    """
+    enhance_face for several frames at once. The aligned crops of all their
+    faces go through GFPGAN in batches of get_enhancer_batch_size().
+    """
+    temp_frames = list(temp_frames)
+    aligned_faces = []
+    for frame_index, (temp_frame, target_faces) in enumerate(zip(temp_frames, frames_faces)):
+        if target_faces is None:
+            target_faces = get_many_faces(temp_frame) or []
+        for target_face in target_faces:
+            # GFPGANer.enhance skips faces with eyes closer than 5px
+            if np.linalg.norm(target_face.kps[0] - target_face.kps[1]) < 5:
+                continue
+            cropped_face, affine_matrix = align_face(temp_frame, target_face)
+            if cropped_face is not None:
+                aligned_faces.append((frame_index, cropped_face, affine_matrix))
+    if not aligned_faces:
+        return temp_frames
+
+    for frame_index in {frame_index for frame_index, _, _ in aligned_faces}:
+        temp_frames[frame_index] = temp_frames[frame_index].copy()
+    with checkout_face_enhancer() as face_enhancer:
+        batch_size = get_enhancer_batch_size(face_enhancer)
+        for index in range(0, len(aligned_faces), batch_size):
+            batch = aligned_faces[index:index + batch_size]
+            restored_faces = restore_faces(
+                face_enhancer, np.stack([cropped_face for _, cropped_face, _ in batch])
+            )
+            masks = get_face_masks(face_enhancer, restored_faces)
+            for (frame_index, _, affine_matrix), restored_face, mask in zip(batch, restored_faces, masks):
+                paste_face(temp_frames[frame_index], restored_face, mask, affine_matrix)
+    return temp_frames
 
 
 def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
-    return temp_frame
+    return enhance_face(temp_frame, get_frame_faces(temp_frame))
 
 
 def process_frames(
     source_path: str, temp_frame_paths: List[str], progress: Any = None
 ) -> None:
-    for temp_frame_path in temp_frame_paths:
+    # frames are read until their faces fill a batch, then enhanced together
+    with checkout_face_enhancer() as face_enhancer:
+        batch_size = get_enhancer_batch_size(face_enhancer)
+    max_pending_frames = batch_size * MAX_PENDING_BATCHES
+    pending_paths = []
+    pending_frames = []
+    pending_faces = []
+    pending_count = 0
+    for index, temp_frame_path in enumerate(temp_frame_paths):
         temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(None, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
-        if progress:
-            progress.update(1)
+        target_faces = get_frame_faces(temp_frame, temp_frame_path)
+        if target_faces is None:
+            target_faces = get_many_faces(temp_frame) or []
+        pending_paths.append(temp_frame_path)
+        pending_frames.append(temp_frame)
+        pending_faces.append(target_faces)
+        pending_count += len(target_faces)
+        if (
+            pending_count < batch_size
+            and len(pending_frames) < max_pending_frames
+            and index < len(temp_frame_paths) - 1
+        ):
+            continue
+
+        for pending_path, result in zip(pending_paths, enhance_frames(pending_frames, pending_faces)):
+            cv2.imwrite(pending_path, result)
+            if progress:
+                progress.update(1)
+        pending_paths = []
+        pending_frames = []
+        pending_faces = []
+        pending_count = 0
 
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
@@ -124,7 +490,4 @@ def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
 
 
 def process_frame_v2(temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
-    return temp_frame
+    return enhance_face(temp_frame, get_frame_faces(temp_frame))
@@ -0,0 +1,124 @@
+from typing import Any, List
+import cv2
+import threading
+import numpy as np
+import os
+
+import modules.globals
+import modules.processors.frame.core
+from modules.core import update_status
+from modules.face_analyser import get_many_faces
+from modules.processors.frame.core import get_frame_faces
+from modules.processors.frame.face_enhancer import align_face, paste_face
+from modules.session_factory import create_inference_session
+from modules.typing import Frame, Face
+from modules.utilities import (
+    conditional_download,
+    is_image,
+    is_video,
+)
+
+FACE_ENHANCER = None
+THREAD_LOCK = threading.Lock()
+NAME = "DLC.FACE-ENHANCER-LITE"
+# GPEN-BFR-256, a quarter of the pixels of GFPGAN and no parsing network
+MODEL_URL = "https://github.com/facefusion/facefusion-assets/releases/download/models/gpen_bfr_256.onnx"
+FACE_SIZE = 256
+# the crop border fades out instead of following a parsed face outline
+MASK_PADDING = 0.1
+MASK_BLUR = 0.15
+FACE_MASK = None
+
+abs_dir = os.path.dirname(os.path.abspath(__file__))
+models_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(abs_dir))), "models"
+)
+
+
+def pre_check() -> bool:
+    conditional_download(models_dir, [MODEL_URL])
+    return True
+
+
+def pre_start() -> bool:
+    if not is_image(modules.globals.target_path) and not is_video(
+        modules.globals.target_path
+    ):
+        update_status("Select an image or video for target path.", NAME)
+        return False
+    return True
+
+
+def get_face_enhancer() -> Any:
+    global FACE_ENHANCER
+
+    with THREAD_LOCK:
+        if FACE_ENHANCER is None:
+            model_path = os.path.join(models_dir, os.path.basename(MODEL_URL))
+            FACE_ENHANCER = create_inference_session(model_path)
+    return FACE_ENHANCER
+
+
+def get_face_mask() -> np.ndarray:
+    global FACE_MASK
+
+    if FACE_MASK is None:
+        padding = int(FACE_SIZE * MASK_PADDING)
+        blur = int(FACE_SIZE * MASK_BLUR) | 1
+        mask = np.zeros((FACE_SIZE, FACE_SIZE), dtype=np.float64)
+        mask[padding:-padding, padding:-padding] = 1
+        FACE_MASK = cv2.GaussianBlur(mask, (blur, blur), 0)
+    return FACE_MASK
+
+
+def restore_face(cropped_face: np.ndarray) -> np.ndarray:
+    session = get_face_enhancer()
+    blob = cropped_face[:, :, ::-1].transpose(2, 0, 1)[None].astype(np.float32)
+    blob = blob / 127.5 - 1.0
+    output = session.run(None, {session.get_inputs()[0].name: blob})[0][0]
+    restored_face = np.rint((np.clip(output, -1, 1) + 1) * 127.5).astype(np.uint8)
+    return np.ascontiguousarray(restored_face.transpose(1, 2, 0)[:, :, ::-1])
+
+
+def enhance_face(temp_frame: Frame, target_faces: List[Face] = None) -> Frame:
+    if target_faces is None:
+        target_faces = get_many_faces(temp_frame) or []
+    if not target_faces:
+        return temp_frame
+
+    temp_frame = temp_frame.copy()
+    for target_face in target_faces:
+        cropped_face, affine_matrix = align_face(temp_frame, target_face, FACE_SIZE)
+        if cropped_face is None:
+            continue
+        paste_face(temp_frame, restore_face(cropped_face), get_face_mask(), affine_matrix)
+    return temp_frame
+
+
+def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
+    return enhance_face(temp_frame, get_frame_faces(temp_frame))
+
+
+def process_frames(
+    source_path: str, temp_frame_paths: List[str], progress: Any = None
+) -> None:
+    for temp_frame_path in temp_frame_paths:
+        temp_frame = cv2.imread(temp_frame_path)
+        result = enhance_face(temp_frame, get_frame_faces(temp_frame, temp_frame_path))
+        cv2.imwrite(temp_frame_path, result)
+        if progress:
+            progress.update(1)
+
+
+def process_image(source_path: str, target_path: str, output_path: str) -> None:
+    target_frame = cv2.imread(target_path)
+    result = process_frame(None, target_frame)
+    cv2.imwrite(output_path, result)
+
+
+def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
+    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+
+
+def process_frame_v2(temp_frame: Frame) -> Frame:
+    return enhance_face(temp_frame, get_frame_faces(temp_frame))
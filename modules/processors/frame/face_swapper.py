@@ -1,40 +1,99 @@
-from typing import Any, List
+from typing import Any, List, Tuple
+import copy
 import cv2
-import insightface
 import threading
 import numpy as np
 import modules.globals
 import logging
 import modules.processors.frame.core
+from modules.processors.frame.core import (
+    clear_frame_faces,
+    get_frame_fingerprint,
+    get_fingerprint_difference,
+    set_frame_faces,
+)
 from modules.core import update_status
-from modules.face_analyser import get_one_face, get_many_faces, default_source_face
+from modules.session_factory import get_model
+from modules.face_analyser import get_one_face, get_many_faces, default_source_face, simplify_maps
 from modules.typing import Face, Frame
 from modules.utilities import (
     conditional_download,
     is_image,
     is_video,
 )
-from modules.cluster_analysis import find_closest_centroid
+from modules.cluster_analysis import assign_faces_to_centroids
 import os
 
 FACE_SWAPPER = None
 THREAD_LOCK = threading.Lock()
 NAME = "DLC.FACE-SWAPPER"
+REUSED_FRAMES = 0
+# --swap-interval tracking limits, relative to the face size
+TRACKING_ERROR_THRESHOLD = 0.02
+TRACKED_POINTS_THRESHOLD = 0.7
+MOTION_THRESHOLD = 0.35
+MAX_SCALE_CHANGE = 1.2
+OPTICAL_FLOW_PARAMS = {
+    "winSize": (21, 21),
+    "maxLevel": 3,
+    "criteria": (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+}
 
 abs_dir = os.path.dirname(os.path.abspath(__file__))
 models_dir = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(abs_dir))), "models"
 )
 
+SWAPPER_MODELS = {
+    "fp32": "inswapper_128.onnx",
+    "fp16": "inswapper_128_fp16.onnx",
+    # produced locally by quantize_swapper.py, there is no download for it
+    "int8": "inswapper_128_int8.onnx",
+}
+SWAPPER_MODEL_URLS = {
+    "fp32": "https://huggingface.co/hacksider/deep-live-cam/resolve/main/inswapper_128.onnx",
+    "fp16": "https://huggingface.co/hacksider/deep-live-cam/resolve/main/inswapper_128_fp16.onnx",
+}
+# providers with native half precision kernels, everything else gets fp32/int8
+FP16_EXECUTION_PROVIDERS = [
+    "CUDAExecutionProvider",
+    "TensorrtExecutionProvider",
+    "ROCMExecutionProvider",
+    "DmlExecutionProvider",
+    "CoreMLExecutionProvider",
+]
+
+
+def get_swapper_precision() -> str:
+    precision = modules.globals.swapper_precision
+    int8_model_path = os.path.join(models_dir, SWAPPER_MODELS["int8"])
+
+    if precision == "auto":
+        if any(
+            execution_provider in FP16_EXECUTION_PROVIDERS
+            for execution_provider in modules.globals.execution_providers
+        ):
+            return "fp16"
+        if os.path.isfile(int8_model_path):
+            return "int8"
+        return "fp32"
+    if precision == "int8" and not os.path.isfile(int8_model_path):
+        update_status(
+            "No int8 model found, run quantize_swapper.py first. Falling back to fp32.",
+            NAME,
+        )
+        return "fp32"
+    return precision
+
+
+def get_swapper_model_path() -> str:
+    return os.path.join(models_dir, SWAPPER_MODELS[get_swapper_precision()])
+
 
 def pre_check() -> bool:
-    download_directory_path = abs_dir
-    conditional_download(
-        download_directory_path,
-        [
-            "https://huggingface.co/hacksider/deep-live-cam/blob/main/inswapper_128_fp16.onnx"
-        ],
-    )
+    precision = get_swapper_precision()
+    if precision in SWAPPER_MODEL_URLS:
+        conditional_download(models_dir, [SWAPPER_MODEL_URLS[precision]])
     return True
 
 
@@ -60,8 +119,8 @@ def get_face_swapper() -> Any:
 
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
-            model_path = os.path.join(models_dir, "inswapper_128_fp16.onnx")
-            FACE_SWAPPER = insightface.model_zoo.get_model(
+            model_path = get_swapper_model_path()
+            FACE_SWAPPER = get_model(
                 model_path, providers=modules.globals.execution_providers
             )
     return FACE_SWAPPER
@@ -71,25 +130,33 @@ def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
     face_swapper = get_face_swapper()
 
     # Apply the face swap
-    swapped_frame = face_swapper.get(
-        temp_frame, target_face, source_face, paste_back=True
+    bgr_fake, M = face_swapper.get(
+        temp_frame, target_face, source_face, paste_back=False
     )
+    return paste_swapped_face(bgr_fake, M, target_face, temp_frame)
+
 
-    if modules.globals.mouth_mask:
-        # Create a mask for the target face
-        face_mask = create_face_mask(target_face, temp_frame)
+def paste_swapped_face(
+    bgr_fake: np.ndarray, M: np.ndarray, target_face: Face, temp_frame: Frame
+) -> Frame:
+    swapped_frame = get_face_swapper().paste_back(temp_frame, bgr_fake, M)
 
+    if modules.globals.mouth_mask and modules.globals.live_mouth_mask:
         # Create the mouth mask
         mouth_mask, mouth_cutout, mouth_box, lower_lip_polygon = (
             create_lower_mouth_mask(target_face, temp_frame)
         )
 
+        # The face mask is only ever sampled inside the mouth box, so only
+        # rasterise that part of it
+        face_mask = create_face_mask(target_face, temp_frame, mouth_box)
+
         # Apply the mouth area
         swapped_frame = apply_mouth_area(
             swapped_frame, mouth_cutout, mouth_box, face_mask, lower_lip_polygon
         )
 
-        if modules.globals.show_mouth_mask_box:
+        if modules.globals.show_mouth_mask_box and mouth_cutout is not None:
             mouth_mask_data = (mouth_mask, mouth_cutout, mouth_box, lower_lip_polygon)
             swapped_frame = draw_mouth_mask_visualization(
                 swapped_frame, target_face, mouth_mask_data
@@ -99,25 +166,34 @@ def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
 
 
 def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
+    result, target_faces = swap_frame_faces(source_face, temp_frame)
+    set_frame_faces(result, target_faces)
+    return result
+
+
+def get_target_faces(temp_frame: Frame) -> List[Face]:
+    if modules.globals.many_faces:
+        return get_many_faces(temp_frame) or []
+    target_face = get_one_face(temp_frame)
+    return [target_face] if target_face else []
+
+
+def swap_frame_faces(
+    source_face: Face, temp_frame: Frame, target_faces: List[Face] = None
+) -> Tuple[Frame, List[Face]]:
+    """Swap the frame, detecting the target faces unless they are passed in."""
     if modules.globals.color_correction:
         temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
 
-    if modules.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
-        if many_faces:
-            for target_face in many_faces:
-                if source_face and target_face:
-                    temp_frame = swap_face(source_face, target_face, temp_frame)
-                else:
-                    print("Face detection failed for target/source.")
-    else:
-        target_face = get_one_face(temp_frame)
-        if target_face and source_face:
-            temp_frame = swap_face(source_face, target_face, temp_frame)
-        else:
-            logging.error("Face detection failed for target or source.")
-    return temp_frame
+    if target_faces is None:
+        target_faces = get_target_faces(temp_frame)
+    if not source_face or not target_faces:
+        logging.error("Face detection failed for target or source.")
+        return temp_frame, target_faces
 
+    for target_face in target_faces:
+        temp_frame = swap_face(source_face, target_face, temp_frame)
+    return temp_frame, target_faces
 
 
 def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
@@ -135,7 +211,7 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
                     target_face = map["target"]["face"]
                     temp_frame = swap_face(source_face, target_face, temp_frame)
 
-    elif is_video(modules.globals.target_path):
+    elif is_video(modules.globals.target_path) and modules.globals.map_faces_clustering != "online":
         if modules.globals.many_faces:
             source_face = default_source_face()
             for map in modules.globals.source_target_map:
@@ -164,6 +240,8 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
                             temp_frame = swap_face(source_face, target_face, temp_frame)
 
     else:
+        # live frames and videos clustered online, the faces of the frame
+        # are matched to the mapped identities here
         detected_faces = get_many_faces(temp_frame)
         if modules.globals.many_faces:
             if detected_faces:
@@ -172,70 +250,248 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
                     temp_frame = swap_face(source_face, target_face, temp_frame)
 
         elif not modules.globals.many_faces:
-            if detected_faces:
-                if len(detected_faces) <= len(
-                    modules.globals.simple_map["target_embeddings"]
-                ):
-                    for detected_face in detected_faces:
-                        closest_centroid_index, _ = find_closest_centroid(
-                            modules.globals.simple_map["target_embeddings"],
-                            detected_face.normed_embedding,
-                        )
-
-                        temp_frame = swap_face(
-                            modules.globals.simple_map["source_faces"][
-                                closest_centroid_index
-                            ],
-                            detected_face,
-                            temp_frame,
-                        )
-                else:
-                    detected_faces_centroids = []
-                    for face in detected_faces:
-                        detected_faces_centroids.append(face.normed_embedding)
-                    i = 0
-                    for target_embedding in modules.globals.simple_map[
-                        "target_embeddings"
-                    ]:
-                        closest_centroid_index, _ = find_closest_centroid(
-                            detected_faces_centroids, target_embedding
-                        )
-
-                        temp_frame = swap_face(
-                            modules.globals.simple_map["source_faces"][i],
-                            detected_faces[closest_centroid_index],
-                            temp_frame,
-                        )
-                        i += 1
+            temp_frame = swap_mapped_faces(
+                temp_frame, modules.globals.simple_map, detected_faces
+            )
     return temp_frame
 
 
+def swap_mapped_faces(
+    temp_frame: Frame, simple_map: dict, detected_faces: List[Face] = None
+) -> Frame:
+    """Swap the faces that match a target of simple_map with its source."""
+    if detected_faces is None:
+        detected_faces = get_many_faces(temp_frame)
+    if not detected_faces:
+        return temp_frame
+    # One similarity matrix per frame, each target identity gets
+    # at most one detected face and vice versa
+    assignments = assign_faces_to_centroids(
+        simple_map["target_matrix"],
+        [face.normed_embedding for face in detected_faces],
+        modules.globals.map_faces_threshold,
+    )
+    for face_index, target_index in assignments:
+        temp_frame = swap_face(
+            simple_map["source_faces"][target_index],
+            detected_faces[face_index],
+            temp_frame,
+        )
+    set_frame_faces(temp_frame, detected_faces)
+    return temp_frame
+
+
+class SwapPropagator:
+    """
+    --swap-interval: runs the swapper on a keyframe and carries its swapped
+    crops over to the following frames. Landmarks are tracked with optical
+    flow, every face gets a similarity transform from the keyframe and its
+    crop is pasted back through the same masks. Falls back to a new keyframe
+    when tracking or motion gets out of bounds.
+    """
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.anchors = []
+        self.faces = []
+        self.points = None
+        self.previous_gray = None
+        self.frames_since_anchor = 0
+
+    def process(self, source_face: Face, temp_frame: Frame) -> Frame:
+        if modules.globals.color_correction:
+            temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
+        gray = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2GRAY)
+
+        result = None
+        if self.anchors and self.frames_since_anchor < self.interval - 1:
+            result = self.propagate(temp_frame, gray)
+        if result is None:
+            result = self.anchor(source_face, temp_frame)
+        self.previous_gray = gray
+        return result
+
+    def anchor(self, source_face: Face, temp_frame: Frame) -> Frame:
+        self.anchors = []
+        self.points = None
+        self.frames_since_anchor = 0
+
+        target_faces = self.faces = get_target_faces(temp_frame)
+        if not source_face or not target_faces:
+            logging.error("Face detection failed for target or source.")
+            return temp_frame
+
+        face_swapper = get_face_swapper()
+        points = []
+        for target_face in target_faces:
+            bgr_fake, M = face_swapper.get(
+                temp_frame, target_face, source_face, paste_back=False
+            )
+            temp_frame = paste_swapped_face(bgr_fake, M, target_face, temp_frame)
+            landmarks = target_face.landmark_2d_106
+            if landmarks is None:
+                landmarks = target_face.kps
+            anchor_points = np.asarray(landmarks, dtype=np.float32)
+            self.anchors.append((target_face, bgr_fake, M, anchor_points))
+            points.append(anchor_points)
+        self.points = np.concatenate(points)
+        return temp_frame
+
+    def propagate(self, temp_frame: Frame, gray: np.ndarray) -> Frame:
+        points = self.points.reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.previous_gray, gray, points, None, **OPTICAL_FLOW_PARAMS
+        )
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            gray, self.previous_gray, next_points, None, **OPTICAL_FLOW_PARAMS
+        )
+        next_points = next_points.reshape(-1, 2)
+        forward_backward_error = np.linalg.norm(
+            back_points.reshape(-1, 2) - self.points, axis=1
+        )
+        tracked = (status.ravel() == 1) & (back_status.ravel() == 1)
+
+        transforms = []
+        offset = 0
+        for _, _, _, anchor_points in self.anchors:
+            face_slice = slice(offset, offset + len(anchor_points))
+            offset += len(anchor_points)
+            face_size = float(
+                np.linalg.norm(anchor_points.max(axis=0) - anchor_points.min(axis=0))
+            )
+            max_error = face_size * TRACKING_ERROR_THRESHOLD
+            valid = tracked[face_slice] & (
+                forward_backward_error[face_slice] <= max_error
+            )
+            if valid.mean() < TRACKED_POINTS_THRESHOLD:
+                return None
+
+            A, _ = cv2.estimateAffinePartial2D(
+                anchor_points[valid], next_points[face_slice][valid]
+            )
+            if A is None:
+                return None
+            predicted_points = anchor_points @ A[:, :2].T + A[:, 2]
+            residual = np.linalg.norm(
+                predicted_points[valid] - next_points[face_slice][valid], axis=1
+            ).mean()
+            center = anchor_points.mean(axis=0)
+            motion = np.linalg.norm(center @ A[:, :2].T + A[:, 2] - center)
+            scale = np.sqrt(abs(np.linalg.det(A[:, :2])))
+            if (
+                residual > max_error
+                or motion > face_size * MOTION_THRESHOLD
+                or not 1 / MAX_SCALE_CHANGE <= scale <= MAX_SCALE_CHANGE
+            ):
+                return None
+            transforms.append((A, predicted_points.astype(np.float32)))
+
+        # landmarks follow the fitted transform, single points that drift
+        # off do not accumulate
+        self.points = np.concatenate([points for _, points in transforms])
+        self.frames_since_anchor += 1
+
+        self.faces = []
+        for (target_face, bgr_fake, M, _), (A, _) in zip(self.anchors, transforms):
+            # M maps the keyframe to the crop, A the keyframe to this frame
+            A_inverse = cv2.invertAffineTransform(A)
+            moved_M = np.hstack(
+                [M[:, :2] @ A_inverse[:, :2], (M[:, :2] @ A_inverse[:, 2] + M[:, 2])[:, None]]
+            )
+            moved_face = move_face(target_face, A)
+            temp_frame = paste_swapped_face(bgr_fake, moved_M, moved_face, temp_frame)
+            self.faces.append(moved_face)
+        return temp_frame
+
+
+def move_face(face: Face, A: np.ndarray) -> Face:
+    moved_face = copy.copy(face)
+    for name in ("kps", "landmark_2d_106"):
+        points = getattr(face, name, None)
+        if points is not None:
+            setattr(moved_face, name, points @ A[:, :2].T + A[:, 2])
+    if getattr(face, "bbox", None) is not None:
+        corners = face.bbox.reshape(2, 2) @ A[:, :2].T + A[:, 2]
+        moved_face.bbox = np.concatenate([corners.min(axis=0), corners.max(axis=0)])
+    return moved_face
+
+
 def process_frames(
     source_path: str, temp_frame_paths: List[str], progress: Any = None
 ) -> None:
+    global REUSED_FRAMES
+
     if not modules.globals.map_faces:
         source_face = get_one_face(cv2.imread(source_path))
-        for temp_frame_path in temp_frame_paths:
-            temp_frame = cv2.imread(temp_frame_path)
-            try:
-                result = process_frame(source_face, temp_frame)
-                cv2.imwrite(temp_frame_path, result)
-            except Exception as exception:
-                print(exception)
-                pass
-            if progress:
-                progress.update(1)
-    else:
-        for temp_frame_path in temp_frame_paths:
-            temp_frame = cv2.imread(temp_frame_path)
-            try:
-                result = process_frame_v2(temp_frame, temp_frame_path)
-                cv2.imwrite(temp_frame_path, result)
-            except Exception as exception:
-                print(exception)
-                pass
-            if progress:
-                progress.update(1)
+    tolerance = modules.globals.frame_reuse_tolerance
+    propagator = None
+    if modules.globals.swap_interval > 1 and not modules.globals.map_faces:
+        propagator = SwapPropagator(modules.globals.swap_interval)
+    # fingerprints of the frames the reusable result and faces came from,
+    # comparing against those rather than the last frame stops slow drift
+    # from being absorbed one small step at a time
+    result_fingerprint = None
+    faces_fingerprint = None
+    previous_result = None
+    previous_faces = None
+    result_faces = None
+    reused_frames = 0
+
+    for temp_frame_path in temp_frame_paths:
+        temp_frame = cv2.imread(temp_frame_path)
+        try:
+            fingerprint = None
+            if tolerance > 0:
+                fingerprint = get_frame_fingerprint(temp_frame)
+
+            if (
+                previous_result is not None
+                and get_fingerprint_difference(result_fingerprint, fingerprint)
+                <= tolerance
+            ):
+                # duplicate frame, the previous output is the output
+                result = previous_result
+                reused_frames += 1
+            else:
+                if propagator is not None:
+                    result = propagator.process(source_face, temp_frame)
+                    result_faces = propagator.faces
+                elif not modules.globals.map_faces:
+                    # static frame that is no duplicate of the last result,
+                    # the faces are where they were detected; anything that
+                    # changed more than the tolerance is detected again so
+                    # the paste never lands on a face that has moved
+                    reuse_faces = (
+                        get_fingerprint_difference(faces_fingerprint, fingerprint)
+                        <= tolerance
+                    )
+                    result, target_faces = swap_frame_faces(
+                        source_face,
+                        temp_frame,
+                        previous_faces if reuse_faces else None,
+                    )
+                    if not reuse_faces:
+                        previous_faces = target_faces
+                        faces_fingerprint = fingerprint
+                    result_faces = target_faces
+                else:
+                    result = process_frame_v2(temp_frame, temp_frame_path)
+                previous_result = result
+                result_fingerprint = fingerprint
+            cv2.imwrite(temp_frame_path, result)
+            if result_faces is not None:
+                set_frame_faces(result, result_faces, temp_frame_path)
+        except Exception as exception:
+            print(exception)
+            previous_result = None
+            previous_faces = None
+            if propagator is not None:
+                propagator.anchors = []
+        if progress:
+            progress.update(1)
+
+    with THREAD_LOCK:
+        REUSED_FRAMES += reused_frames
 
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
@@ -255,20 +511,33 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
+    global REUSED_FRAMES
+
     if modules.globals.map_faces and modules.globals.many_faces:
         update_status(
             "Many faces enabled. Using first source image. Progressing...", NAME
         )
+    REUSED_FRAMES = 0
+    clear_frame_faces()
+    if modules.globals.map_faces and modules.globals.map_faces_clustering == "online":
+        simplify_maps()
     modules.processors.frame.core.process_video(
         source_path, temp_frame_paths, process_frames
     )
+    if modules.globals.frame_reuse_tolerance > 0:
+        update_status(
+            f"Reused {REUSED_FRAMES} of {len(temp_frame_paths)} frames (duplicate or static).",
+            NAME,
+        )
 
 
 def create_lower_mouth_mask(
     face: Face, frame: Frame
 ) -> (np.ndarray, np.ndarray, tuple, np.ndarray):
-    mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+    mask = None
     mouth_cutout = None
+    mouth_box = None
+    lower_lip_polygon = None
     landmarks = face.landmark_2d_106
     if landmarks is not None:
         #                  0  1  2  3  4  5  6  7  8  9  10 11 12 13 14 15 16 17 18 19 20
@@ -321,10 +590,10 @@ def create_lower_mouth_mask(
         toplip_extension = (
             modules.globals.mask_size * 0.5
         )  # Adjust this factor to control the extension
-        for idx in toplip_indices:
-            direction = expanded_landmarks[idx] - center
-            direction = direction / np.linalg.norm(direction)
-            expanded_landmarks[idx] += direction * toplip_extension
+        expanded_landmarks[toplip_indices] += (
+            _unit_vectors(expanded_landmarks[toplip_indices] - center)
+            * toplip_extension
+        )
 
         # Extend the bottom part (chin area)
         chin_indices = [
@@ -336,10 +605,9 @@ def create_lower_mouth_mask(
             16,
         ]  # Indices for landmarks 21, 22, 23, 24, 0, 8
         chin_extension = 2 * 0.2  # Adjust this factor to control the extension
-        for idx in chin_indices:
-            expanded_landmarks[idx][1] += (
-                expanded_landmarks[idx][1] - center[1]
-            ) * chin_extension
+        expanded_landmarks[chin_indices, 1] += (
+            expanded_landmarks[chin_indices, 1] - center[1]
+        ) * chin_extension
 
         # Convert back to integer coordinates
         expanded_landmarks = expanded_landmarks.astype(np.int32)
@@ -362,23 +630,21 @@ def create_lower_mouth_mask(
             if (max_y - min_y) <= 1:
                 max_y = min_y + 1
 
-        # Create the mask
-        mask_roi = np.zeros((max_y - min_y, max_x - min_x), dtype=np.uint8)
-        cv2.fillPoly(mask_roi, [expanded_landmarks - [min_x, min_y]], 255)
+        # Create the mask, sized to the mouth box only
+        mask = np.zeros((max_y - min_y, max_x - min_x), dtype=np.uint8)
+        cv2.fillPoly(mask, [expanded_landmarks - [min_x, min_y]], 255)
 
         # Apply Gaussian blur to soften the mask edges
-        mask_roi = cv2.GaussianBlur(mask_roi, (15, 15), 5)
-
-        # Place the mask ROI in the full-sized mask
-        mask[min_y:max_y, min_x:max_x] = mask_roi
+        mask = cv2.GaussianBlur(mask, (15, 15), 5)
 
         # Extract the masked area from the frame
         mouth_cutout = frame[min_y:max_y, min_x:max_x].copy()
 
+        mouth_box = (min_x, min_y, max_x, max_y)
         # Return the expanded lower lip polygon in original frame coordinates
         lower_lip_polygon = expanded_landmarks
 
-    return mask, mouth_cutout, (min_x, min_y, max_x, max_y), lower_lip_polygon
+    return mask, mouth_cutout, mouth_box, lower_lip_polygon
 
 
 def draw_mouth_mask_visualization(
@@ -470,34 +736,33 @@ def apply_mouth_area(
     face_mask: np.ndarray,
     mouth_polygon: np.ndarray,
 ) -> np.ndarray:
-    min_x, min_y, max_x, max_y = mouth_box
-    box_width = max_x - min_x
-    box_height = max_y - min_y
-
     if (
         mouth_cutout is None
-        or box_width is None
-        or box_height is None
+        or mouth_box is None
         or face_mask is None
         or mouth_polygon is None
     ):
         return frame
 
+    min_x, min_y, max_x, max_y = mouth_box
+    box_width = max_x - min_x
+    box_height = max_y - min_y
+
     try:
-        resized_mouth_cutout = cv2.resize(mouth_cutout, (box_width, box_height))
         roi = frame[min_y:max_y, min_x:max_x]
+        height, width = roi.shape[:2]
 
-        if roi.shape != resized_mouth_cutout.shape:
-            resized_mouth_cutout = cv2.resize(
-                resized_mouth_cutout, (roi.shape[1], roi.shape[0])
-            )
+        if mouth_cutout.shape[:2] != (height, width):
+            mouth_cutout = cv2.resize(mouth_cutout, (width, height))
+        if face_mask.shape[:2] != (height, width):
+            face_mask = cv2.resize(face_mask, (width, height))
 
-        color_corrected_mouth = apply_color_transfer(resized_mouth_cutout, roi)
+        color_corrected_mouth = apply_color_transfer(mouth_cutout, roi)
 
-        # Use the provided mouth polygon to create the mask
-        polygon_mask = np.zeros(roi.shape[:2], dtype=np.uint8)
-        adjusted_polygon = mouth_polygon - [min_x, min_y]
-        cv2.fillPoly(polygon_mask, [adjusted_polygon], 255)
+        # Rasterise the mouth polygon straight into a float32 scratch buffer
+        alpha = _get_scratch_buffer("mouth_alpha", (height, width))
+        alpha.fill(0)
+        cv2.fillPoly(alpha, [mouth_polygon - [min_x, min_y]], 1.0)
 
         # Apply feathering to the polygon mask
         feather_amount = min(
@@ -505,34 +770,41 @@ def apply_mouth_area(
             box_width // modules.globals.mask_feather_ratio,
             box_height // modules.globals.mask_feather_ratio,
         )
-        feathered_mask = cv2.GaussianBlur(
-            polygon_mask.astype(float), (0, 0), feather_amount
+        if feather_amount > 0:
+            cv2.GaussianBlur(alpha, (0, 0), feather_amount, dst=alpha)
+        alpha_max = alpha.max()
+        if alpha_max <= 0:
+            return frame
+
+        # The mouth is blended through the face mask and the result is blended
+        # through the face mask again, so fold both into a single weight
+        face_weight = _get_scratch_buffer("face_weight", (height, width))
+        np.multiply(face_mask, 1.0 / 255.0, out=face_weight, casting="unsafe")
+        np.multiply(face_weight, face_weight, out=face_weight)
+        np.multiply(alpha, face_weight, out=alpha)
+        if alpha_max != 1.0:
+            np.multiply(alpha, 1.0 / alpha_max, out=alpha)
+
+        np.subtract(1.0, alpha, out=face_weight)
+        frame[min_y:max_y, min_x:max_x] = cv2.blendLinear(
+            color_corrected_mouth, roi, alpha, face_weight
         )
-        feathered_mask = feathered_mask / feathered_mask.max()
-
-        face_mask_roi = face_mask[min_y:max_y, min_x:max_x]
-        combined_mask = feathered_mask * (face_mask_roi / 255.0)
-
-        combined_mask = combined_mask[:, :, np.newaxis]
-        blended = (
-            color_corrected_mouth * combined_mask + roi * (1 - combined_mask)
-        ).astype(np.uint8)
-
-        # Apply face mask to blended result
-        face_mask_3channel = (
-            np.repeat(face_mask_roi[:, :, np.newaxis], 3, axis=2) / 255.0
-        )
-        final_blend = blended * face_mask_3channel + roi * (1 - face_mask_3channel)
-
-        frame[min_y:max_y, min_x:max_x] = final_blend.astype(np.uint8)
     except Exception as e:
         pass
 
     return frame
 
 
-def create_face_mask(face: Face, frame: Frame) -> np.ndarray:
-    mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+def create_face_mask(face: Face, frame: Frame, box: tuple = None) -> np.ndarray:
+    """
+    Rasterise the padded face hull. Only the area inside box
+    (min_x, min_y, max_x, max_y) is allocated; defaults to the whole frame.
+    """
+    frame_height, frame_width = frame.shape[:2]
+    if box is None:
+        box = (0, 0, frame_width, frame_height)
+    min_x, min_y, max_x, max_y = box
+    mask = np.zeros((max_y - min_y, max_x - min_x), dtype=np.uint8)
     landmarks = face.landmark_2d_106
     if landmarks is not None:
         # Convert landmarks to int32
@@ -579,27 +851,60 @@ def create_face_mask(face: Face, frame: Frame) -> np.ndarray:
         )  # 5% of face width
 
         # Create a slightly larger convex hull for padding
-        hull = cv2.convexHull(face_outline)
-        hull_padded = []
-        for point in hull:
-            x, y = point[0]
-            center = np.mean(face_outline, axis=0)
-            direction = np.array([x, y]) - center
-            direction = direction / np.linalg.norm(direction)
-            padded_point = np.array([x, y]) + direction * padding
-            hull_padded.append(padded_point)
-
-        hull_padded = np.array(hull_padded, dtype=np.int32)
+        hull = cv2.convexHull(face_outline)[:, 0, :]
+        center = np.mean(face_outline, axis=0)
+        hull_padded = (hull + _unit_vectors(hull - center) * padding).astype(np.int32)
+
+        # Rasterise with a margin of the blur radius so the edges of the box
+        # blur exactly as they would on a full-frame mask
+        blur_margin = 2
+        pad_min_x = max(0, min_x - blur_margin)
+        pad_min_y = max(0, min_y - blur_margin)
+        pad_max_x = min(frame_width, max_x + blur_margin)
+        pad_max_y = min(frame_height, max_y + blur_margin)
+        if pad_max_x <= pad_min_x or pad_max_y <= pad_min_y:
+            return mask
+        padded_mask = np.zeros(
+            (pad_max_y - pad_min_y, pad_max_x - pad_min_x), dtype=np.uint8
+        )
 
         # Fill the padded convex hull
-        cv2.fillConvexPoly(mask, hull_padded, 255)
+        cv2.fillConvexPoly(padded_mask, hull_padded - [pad_min_x, pad_min_y], 255)
 
         # Smooth the mask edges
-        mask = cv2.GaussianBlur(mask, (5, 5), 3)
+        padded_mask = cv2.GaussianBlur(padded_mask, (5, 5), 3)
+
+        crop = padded_mask[min_y - pad_min_y :, min_x - pad_min_x :]
+        crop = crop[: mask.shape[0], : mask.shape[1]]
+        mask[: crop.shape[0], : crop.shape[1]] = crop
 
     return mask
 
 
+def _unit_vectors(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+SCRATCH_BUFFERS = threading.local()
+
+
+def _get_scratch_buffer(
+    name: str, shape: tuple, dtype: Any = np.float32
+) -> np.ndarray:
+    # Per-thread scratch buffers that only grow, so the compositor does not
+    # allocate new masks for every face in every frame
+    buffers = getattr(SCRATCH_BUFFERS, "buffers", None)
+    if buffers is None:
+        buffers = SCRATCH_BUFFERS.buffers = {}
+    size = int(np.prod(shape))
+    buffer = buffers.get(name)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = buffers[name] = np.empty(size, dtype=dtype)
+    return buffer[:size].reshape(shape)
+
+
 def apply_color_transfer(source, target):
     """
     Apply color transfer from target to source image
@@ -0,0 +1,197 @@
+import glob
+import hashlib
+import json
+import os
+import platform
+import threading
+from typing import Any, List, Optional
+
+import onnxruntime
+from insightface.app import FaceAnalysis as InsightFaceAnalysis
+from insightface.model_zoo.attribute import Attribute
+from insightface.model_zoo.landmark import Landmark
+from insightface.utils import ensure_available
+
+import modules.globals
+from modules.io_binding import BoundArcFaceONNX, BoundINSwapper, BoundRetinaFace
+
+# providers that compile subgraphs into their own engines; ORT cannot
+# serialize those graphs, they keep their own caches instead
+COMPILING_EXECUTION_PROVIDERS = [
+    "TensorrtExecutionProvider",
+    "CoreMLExecutionProvider",
+    "OpenVINOExecutionProvider",
+]
+HASH_INDEX_FILE = "hashes.json"
+HASH_LOCK = threading.Lock()
+HARDWARE_KEY = None
+
+
+def get_session_cache_dir() -> str:
+    if modules.globals.session_cache_dir:
+        return modules.globals.session_cache_dir
+    return os.path.join(os.path.dirname(modules.globals.ROOT_DIR), "models", "ort_cache")
+
+
+def get_model_hash(model_path: str) -> str:
+    # hashing a few hundred MB on every start would eat the warm start win, so
+    # digests are remembered per path, size and mtime
+    stat = os.stat(model_path)
+    key = f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    index_path = os.path.join(get_session_cache_dir(), HASH_INDEX_FILE)
+
+    with HASH_LOCK:
+        index = {}
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+        if key in index:
+            return index[key]
+
+        sha256 = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        index[key] = sha256.hexdigest()
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        temp_index_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temp_index_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_index_path, index_path)
+        return index[key]
+
+
+def get_hardware_key() -> str:
+    """
+    The machine and a digest of the cpu model and its features. Optimized
+    graphs can hold kernels fused for the cpu they were made on, a copied or
+    shared cache must not hand them to another one.
+    """
+    global HARDWARE_KEY
+
+    if HARDWARE_KEY is None:
+        cpu = platform.processor()
+        try:
+            with open("/proc/cpuinfo", "r") as f:
+                cpu += "".join(sorted({line for line in f if line.startswith(("model name", "flags", "Features"))}))
+        except OSError:
+            pass
+        HARDWARE_KEY = f"{platform.machine().lower()}-{hashlib.sha256(cpu.encode()).hexdigest()[:8]}"
+    return HARDWARE_KEY
+
+
+def get_optimized_model_path(model_path: str, providers: List[str]) -> Optional[str]:
+    if any(provider in COMPILING_EXECUTION_PROVIDERS for provider in providers):
+        return None
+    model_name, _ = os.path.splitext(os.path.basename(model_path))
+    provider_key = "-".join(
+        provider.replace("ExecutionProvider", "").lower() for provider in providers
+    )
+    file_name = f"{model_name}-{get_model_hash(model_path)[:16]}-ort{onnxruntime.__version__}-{provider_key}-{get_hardware_key()}.onnx"
+    return os.path.join(get_session_cache_dir(), file_name)
+
+
+def create_session_options(providers: List[str]) -> onnxruntime.SessionOptions:
+    session_options = onnxruntime.SessionOptions()
+    session_options.log_severity_level = 3
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    session_options.inter_op_num_threads = 1
+
+    if "DmlExecutionProvider" in providers:
+        # DirectML does not support memory patterns or parallel execution
+        session_options.enable_mem_pattern = False
+    elif providers == ["CPUExecutionProvider"] or not providers:
+        # frames are already spread over execution_threads workers, so each
+        # session only gets its share of the cores
+        workers = max(1, modules.globals.execution_threads or 1)
+        session_options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // workers)
+        session_options.enable_cpu_mem_arena = True
+        session_options.enable_mem_pattern = True
+    else:
+        # gpu providers do the work on the device, keep host threads idle
+        session_options.intra_op_num_threads = 1
+    return session_options
+
+
+def create_inference_session(model_path: str, providers: List[str] = None) -> onnxruntime.InferenceSession:
+    """
+    Create an InferenceSession with tuned options. The optimized graph is
+    cached per model hash, ORT version, providers and cpu, warm starts load it with
+    graph optimization disabled.
+    """
+    if providers is None:
+        providers = modules.globals.execution_providers or ["CPUExecutionProvider"]
+    session_options = create_session_options(providers)
+    optimized_model_path = get_optimized_model_path(model_path, providers)
+
+    if optimized_model_path is None:
+        return onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=providers)
+
+    if os.path.isfile(optimized_model_path):
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return onnxruntime.InferenceSession(optimized_model_path, sess_options=session_options, providers=providers)
+        except Exception as e:
+            # core imports this module through face_analyser
+            from modules.core import update_status
+            update_status(f"Ignoring unusable optimized model {optimized_model_path}: {e}", "DLC.SESSION")
+            os.remove(optimized_model_path)
+            session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    # ORT writes the file while building the session, write it next to the
+    # final path and swap it in so parallel starts never load half a file
+    os.makedirs(os.path.dirname(optimized_model_path), exist_ok=True)
+    temp_model_path = f"{optimized_model_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    session_options.optimized_model_filepath = temp_model_path
+    session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=providers)
+    if os.path.isfile(temp_model_path):
+        os.replace(temp_model_path, optimized_model_path)
+    return session
+
+
+def get_model(model_path: str, providers: List[str] = None) -> Any:
+    """
+    Same routing as insightface.model_zoo.get_model, but on a session from
+    create_inference_session. The models still read their metadata from the
+    original file. Detector, recognizer and swapper run through IOBinding.
+    """
+    session = create_inference_session(model_path, providers)
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    outputs = session.get_outputs()
+
+    if len(outputs) >= 5:
+        return BoundRetinaFace(model_file=model_path, session=session)
+    elif input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_path, session=session)
+    elif input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_path, session=session)
+    elif len(inputs) == 2 and input_shape[2] == 128 and input_shape[3] == 128:
+        return BoundINSwapper(model_file=model_path, session=session)
+    elif input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return BoundArcFaceONNX(model_file=model_path, session=session)
+    return None
+
+
+class FaceAnalysis(InsightFaceAnalysis):
+    """insightface FaceAnalysis with its models loaded through get_model."""
+
+    def __init__(self, name: str = "buffalo_l", root: str = "~/.insightface", allowed_modules: List[str] = None, providers: List[str] = None):
+        onnxruntime.set_default_logger_severity(3)
+        self.models = {}
+        self.model_dir = ensure_available("models", name, root=root)
+        for onnx_file in sorted(glob.glob(os.path.join(self.model_dir, "*.onnx"))):
+            model = get_model(onnx_file, providers)
+            if model is None:
+                continue
+            if model.taskname in self.models:
+                continue
+            if allowed_modules is not None and model.taskname not in allowed_modules:
+                continue
+            self.models[model.taskname] = model
+        assert "detection" in self.models
+        self.det_model = self.models["detection"]
@@ -5,7 +5,6 @@ from typing import Callable, Tuple
 import cv2
 from cv2_enumerate_cameras import enumerate_cameras  # Add this import
 from PIL import Image, ImageOps
-import time
 import json
 import modules.globals
 import modules.metadata
@@ -18,6 +17,7 @@ from modules.face_analyser import (
     simplify_maps,
 )
 from modules.capturer import get_video_frame, get_video_frame_total
+from modules.identity_gallery import fill_map_from_gallery, remember_map
 from modules.processors.frame.core import get_frame_processors_modules
 from modules.utilities import (
     is_image,
@@ -25,12 +25,12 @@ from modules.utilities import (
     resolve_relative_path,
     has_image_extension,
 )
+import modules.camera_discovery as camera_discovery
+from modules.camera_discovery import discover_cameras
+from modules.live import LivePipeline, draw_live_stats
+from modules.live_display import LiveDisplay
 from modules.video_capture import VideoCapturer
 from modules.gettext import LanguageManager
-import platform
-
-if platform.system() == "Windows":
-    from pygrabber.dshow_graph import FilterGraph
 
 ROOT = None
 POPUP = None
@@ -43,6 +43,10 @@ PREVIEW_MAX_HEIGHT = 700
 PREVIEW_MAX_WIDTH = 1200
 PREVIEW_DEFAULT_WIDTH = 960
 PREVIEW_DEFAULT_HEIGHT = 540
+# milliseconds between checks of the live pipeline for a new frame
+LIVE_DISPLAY_INTERVAL = 5
+# milliseconds between checks whether the camera search finished
+CAMERA_POLL_INTERVAL = 100
 
 POPUP_WIDTH = 750
 POPUP_HEIGHT = 810
@@ -71,6 +75,8 @@ source_label = None
 target_label = None
 status_label = None
 popup_status_label = None
+popup_submit_button = None
+popup_scrollable_frame = None
 popup_status_label_live = None
 source_label_dict = {}
 source_label_dict_live = {}
@@ -325,22 +331,15 @@ def create_root(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.C
     camera_label = ctk.CTkLabel(root, text=_("Select Camera:"))
     camera_label.place(relx=0.1, rely=0.86, relwidth=0.2, relheight=0.05)
 
-    available_cameras = get_available_cameras()
-    camera_indices, camera_names = available_cameras
-
-    if not camera_names or camera_names[0] == "No cameras found":
-        camera_variable = ctk.StringVar(value="No cameras found")
-        camera_optionmenu = ctk.CTkOptionMenu(
-            root,
-            variable=camera_variable,
-            values=["No cameras found"],
-            state="disabled",
-        )
-    else:
-        camera_variable = ctk.StringVar(value=camera_names[0])
-        camera_optionmenu = ctk.CTkOptionMenu(
-            root, variable=camera_variable, values=camera_names
-        )
+    # cameras are searched in the background, the window does not wait for them
+    camera_indices, camera_names = [], []
+    camera_variable = ctk.StringVar(value=_("Searching for cameras..."))
+    camera_optionmenu = ctk.CTkOptionMenu(
+        root,
+        variable=camera_variable,
+        values=[camera_variable.get()],
+        state="disabled",
+    )
 
     camera_optionmenu.place(relx=0.35, rely=0.86, relwidth=0.25, relheight=0.05)
 
@@ -356,13 +355,29 @@ def create_root(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.C
                 else None
             ),
         ),
-        state=(
-            "normal"
-            if camera_names and camera_names[0] != "No cameras found"
-            else "disabled"
-        ),
+        state="disabled",
     )
+
+    def show_cameras(discovery) -> None:
+        if not discovery.done():
+            root.after(CAMERA_POLL_INTERVAL, lambda: show_cameras(discovery))
+            return
+        try:
+            indices, names = get_available_cameras(discovery.result())
+        except Exception as e:
+            print(f"Error detecting cameras: {str(e)}")
+            indices, names = [], ["No cameras found"]
+        camera_indices[:] = indices
+        camera_names[:] = names
+        camera_variable.set(camera_names[0])
+        if camera_names[0] == "No cameras found":
+            camera_optionmenu.configure(values=camera_names, state="disabled")
+        else:
+            camera_optionmenu.configure(values=camera_names, state="normal")
+            live_button.configure(state="normal")
+
     live_button.place(relx=0.65, rely=0.86, relwidth=0.2, relheight=0.05)
+    show_cameras(discover_cameras())
     # --- End Camera Selection ---
 
     status_label = ctk.CTkLabel(root, text=None, justify="center")
@@ -404,10 +419,32 @@ def analyze_target(start: Callable[[], None], root: ctk.CTk):
             get_unique_faces_from_target_image()
         elif is_video(modules.globals.target_path):
             update_status("Getting unique faces")
-            get_unique_faces_from_target_video()
+            popup_opened = False
+
+            def on_identities(identities: int, frames: int) -> None:
+                # online clustering maps the identities found so far, the
+                # mapper opens on them and follows while analysis goes on
+                nonlocal popup_opened
+                update_status(f"Found {identities} faces in {frames} frames")
+                if not modules.globals.source_target_map:
+                    return
+                fill_map_from_gallery(modules.globals.source_target_map)
+                if not popup_opened:
+                    popup_opened = True
+                    create_source_target_popup(start, root, modules.globals.source_target_map, analysing=True)
+                elif POPUP is not None and POPUP.winfo_exists():
+                    refresh_source_target_popup(modules.globals.source_target_map, analysing=True)
+
+            get_unique_faces_from_target_video(on_identities)
 
         if len(modules.globals.source_target_map) > 0:
-            create_source_target_popup(start, root, modules.globals.source_target_map)
+            filled = fill_map_from_gallery(modules.globals.source_target_map)
+            if filled:
+                update_status(f"Mapped {filled} known faces from the identity gallery")
+            if POPUP is not None and POPUP.winfo_exists():
+                refresh_source_target_popup(modules.globals.source_target_map)
+            else:
+                create_source_target_popup(start, root, modules.globals.source_target_map)
         else:
             update_status("No faces found in target")
     else:
@@ -415,9 +452,9 @@ def analyze_target(start: Callable[[], None], root: ctk.CTk):
 
 
 def create_source_target_popup(
-        start: Callable[[], None], root: ctk.CTk, map: list
+        start: Callable[[], None], root: ctk.CTk, map: list, analysing: bool = False
 ) -> None:
-    global POPUP, popup_status_label
+    global POPUP, popup_status_label, popup_submit_button
 
     POPUP = ctk.CTkToplevel(root)
     POPUP.title(_("Source x Target Mapper"))
@@ -426,15 +463,36 @@ def create_source_target_popup(
 
     def on_submit_click(start):
         if has_valid_map():
+            remember_map(modules.globals.source_target_map)
             POPUP.destroy()
             select_output_path(start)
         else:
             update_pop_status("At least 1 source with target is required!")
 
+    popup_status_label = ctk.CTkLabel(POPUP, text=None, justify="center")
+    popup_status_label.grid(row=1, column=0, pady=15)
+
+    popup_submit_button = ctk.CTkButton(
+        POPUP, text=_("Submit"), command=lambda: on_submit_click(start)
+    )
+    popup_submit_button.grid(row=2, column=0, pady=10)
+
+    refresh_source_target_popup(map, analysing)
+
+
+def refresh_source_target_popup(map: list, analysing: bool = False) -> None:
+    """Show the rows of map in the mapper, submitting waits for the analysis."""
+    global popup_scrollable_frame
+
+    if popup_scrollable_frame is not None and popup_scrollable_frame.winfo_exists():
+        popup_scrollable_frame.destroy()
+    source_label_dict.clear()
+
     scrollable_frame = ctk.CTkScrollableFrame(
         POPUP, width=POPUP_SCROLL_WIDTH, height=POPUP_SCROLL_HEIGHT
     )
     scrollable_frame.grid(row=0, column=0, padx=0, pady=0, sticky="nsew")
+    popup_scrollable_frame = scrollable_frame
 
     def on_button_click(map, button_num):
         map = update_popup_source(scrollable_frame, map, button_num)
@@ -474,13 +532,15 @@ def create_source_target_popup(
         target_image.grid(row=id, column=3, padx=10, pady=10)
         target_image.configure(image=tk_image)
 
-    popup_status_label = ctk.CTkLabel(POPUP, text=None, justify="center")
-    popup_status_label.grid(row=1, column=0, pady=15)
+        if "source" in item:
+            show_popup_source(scrollable_frame, map, id)
 
-    close_button = ctk.CTkButton(
-        POPUP, text=_("Submit"), command=lambda: on_submit_click(start)
-    )
-    close_button.grid(row=2, column=0, pady=10)
+    if analysing:
+        popup_submit_button.configure(state="disabled")
+        update_pop_status("Still analysing, faces can still be added or merged")
+    else:
+        popup_submit_button.configure(state="normal")
+        update_pop_status("")
 
 
 def update_popup_source(
@@ -511,30 +571,38 @@ def update_popup_source(
             map[button_num]["source"] = {
                 "cv2": cv2_img[int(y_min): int(y_max), int(x_min): int(x_max)],
                 "face": face,
+                "path": source_path,
             }
-
-            image = Image.fromarray(
-                cv2.cvtColor(map[button_num]["source"]["cv2"], cv2.COLOR_BGR2RGB)
-            )
-            image = image.resize(
-                (MAPPER_PREVIEW_MAX_WIDTH, MAPPER_PREVIEW_MAX_HEIGHT), Image.LANCZOS
-            )
-            tk_image = ctk.CTkImage(image, size=image.size)
-
-            source_image = ctk.CTkLabel(
-                scrollable_frame,
-                text=f"S-{button_num}",
-                width=MAPPER_PREVIEW_MAX_WIDTH,
-                height=MAPPER_PREVIEW_MAX_HEIGHT,
-            )
-            source_image.grid(row=button_num, column=1, padx=10, pady=10)
-            source_image.configure(image=tk_image)
-            source_label_dict[button_num] = source_image
+            # a different source makes this a new mapping for the gallery
+            map[button_num].pop("identity", None)
+            show_popup_source(scrollable_frame, map, button_num)
         else:
             update_pop_status("Face could not be detected in last upload!")
         return map
 
 
+def show_popup_source(
+        scrollable_frame: ctk.CTkScrollableFrame, map: list, button_num: int
+) -> None:
+    image = Image.fromarray(
+        cv2.cvtColor(map[button_num]["source"]["cv2"], cv2.COLOR_BGR2RGB)
+    )
+    image = image.resize(
+        (MAPPER_PREVIEW_MAX_WIDTH, MAPPER_PREVIEW_MAX_HEIGHT), Image.LANCZOS
+    )
+    tk_image = ctk.CTkImage(image, size=image.size)
+
+    source_image = ctk.CTkLabel(
+        scrollable_frame,
+        text=f"S-{button_num}",
+        width=MAPPER_PREVIEW_MAX_WIDTH,
+        height=MAPPER_PREVIEW_MAX_HEIGHT,
+    )
+    source_image.grid(row=button_num, column=1, padx=10, pady=10)
+    source_image.configure(image=tk_image)
+    source_label_dict[button_num] = source_image
+
+
 def create_preview(parent: ctk.CTkToplevel) -> ctk.CTkToplevel:
     global preview_label, preview_slider
 
@@ -695,25 +763,6 @@ def check_and_ignore_nsfw(target, destroy: Callable = None) -> bool:
         return False
 
 
-def fit_image_to_size(image, width: int, height: int):
-    if width is None or height is None or width <= 0 or height <= 0:
-        return image
-    h, w, _ = image.shape
-    ratio_h = 0.0
-    ratio_w = 0.0
-    ratio_w = width / w
-    ratio_h = height / h
-    # Use the smaller ratio to ensure the image fits within the given dimensions
-    ratio = min(ratio_w, ratio_h)
-    
-    # Compute new dimensions, ensuring they're at least 1 pixel
-    new_width = max(1, int(ratio * w))
-    new_height = max(1, int(ratio * h))
-    new_size = (new_width, new_height)
-
-    return cv2.resize(image, dsize=new_size)
-
-
 def render_image_preview(image_path: str, size: Tuple[int, int]) -> ctk.CTkImage:
     image = Image.open(image_path)
     if size:
@@ -798,74 +847,12 @@ def webcam_preview(root: ctk.CTk, camera_index: int):
 
 
 
-def get_available_cameras():
+def get_available_cameras(cameras: Tuple[list, list] = None):
     """Returns a list of available camera names and indices."""
-    if platform.system() == "Windows":
-        try:
-            graph = FilterGraph()
-            devices = graph.get_input_devices()
-
-            # Create list of indices and names
-            camera_indices = list(range(len(devices)))
-            camera_names = devices
-
-            # If no cameras found through DirectShow, try OpenCV fallback
-            if not camera_names:
-                # Try to open camera with index -1 and 0
-                test_indices = [-1, 0]
-                working_cameras = []
-
-                for idx in test_indices:
-                    cap = cv2.VideoCapture(idx)
-                    if cap.isOpened():
-                        working_cameras.append(f"Camera {idx}")
-                        cap.release()
-
-                if working_cameras:
-                    return test_indices[: len(working_cameras)], working_cameras
-
-            # If still no cameras found, return empty lists
-            if not camera_names:
-                return [], ["No cameras found"]
-
-            return camera_indices, camera_names
-
-        except Exception as e:
-            print(f"Error detecting cameras: {str(e)}")
-            return [], ["No cameras found"]
-    else:
-        # Unix-like systems (Linux/Mac) camera detection
-        camera_indices = []
-        camera_names = []
-
-        if platform.system() == "Darwin":  # macOS specific handling
-            # Try to open the default FaceTime camera first
-            cap = cv2.VideoCapture(0)
-            if cap.isOpened():
-                camera_indices.append(0)
-                camera_names.append("FaceTime Camera")
-                cap.release()
-
-            # On macOS, additional cameras typically use indices 1 and 2
-            for i in [1, 2]:
-                cap = cv2.VideoCapture(i)
-                if cap.isOpened():
-                    camera_indices.append(i)
-                    camera_names.append(f"Camera {i}")
-                    cap.release()
-        else:
-            # Linux camera detection - test first 10 indices
-            for i in range(10):
-                cap = cv2.VideoCapture(i)
-                if cap.isOpened():
-                    camera_indices.append(i)
-                    camera_names.append(f"Camera {i}")
-                    cap.release()
-
-        if not camera_names:
-            return [], ["No cameras found"]
-
-        return camera_indices, camera_names
+    camera_indices, camera_names = cameras or camera_discovery.get_available_cameras()
+    if not camera_names:
+        return [], ["No cameras found"]
+    return camera_indices, camera_names
 
 
 def create_webcam_preview(camera_index: int):
@@ -879,85 +866,32 @@ def create_webcam_preview(camera_index: int):
     preview_label.configure(width=PREVIEW_DEFAULT_WIDTH, height=PREVIEW_DEFAULT_HEIGHT)
     PREVIEW.deiconify()
 
-    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
-    source_image = None
-    prev_time = time.time()
-    fps_update_interval = 0.5
-    frame_count = 0
-    fps = 0
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        temp_frame = frame.copy()
-
-        if modules.globals.live_mirror:
-            temp_frame = cv2.flip(temp_frame, 1)
-
-        if modules.globals.live_resizable:
-            temp_frame = fit_image_to_size(
-                temp_frame, PREVIEW.winfo_width(), PREVIEW.winfo_height()
-            )
-
-        else:
-            temp_frame = fit_image_to_size(
-                temp_frame, PREVIEW.winfo_width(), PREVIEW.winfo_height()
-            )
+    # capture and inference run in their own threads, the Tk main thread
+    # only shows the newest processed frame
+    pipeline = LivePipeline(cap)
+    pipeline.frame_size = (PREVIEW.winfo_width(), PREVIEW.winfo_height())
+    pipeline.start()
+    display = LiveDisplay(preview_label)
+
+    def show_next_frame() -> None:
+        if PREVIEW.state() == "withdrawn" or not pipeline.running:
+            pipeline.stop()
+            cap.release()
+            PREVIEW.withdraw()
+            return
+        pipeline.frame_size = (PREVIEW.winfo_width(), PREVIEW.winfo_height())
 
-        if not modules.globals.map_faces:
-            if source_image is None and modules.globals.source_path:
-                source_image = get_one_face(cv2.imread(modules.globals.source_path))
+        result = pipeline.processed.get(timeout=0)
+        if result is not None:
+            capture_time, temp_frame = result[1:]
+            if modules.globals.show_fps:
+                draw_live_stats(temp_frame, pipeline.stats, pipeline.governor)
 
-            for frame_processor in frame_processors:
-                if frame_processor.NAME == "DLC.FACE-ENHANCER":
-                    if modules.globals.fp_ui["face_enhancer"]:
-                        temp_frame = frame_processor.process_frame(None, temp_frame)
-                else:
-                    temp_frame = frame_processor.process_frame(source_image, temp_frame)
-        else:
-            modules.globals.target_path = None
-            for frame_processor in frame_processors:
-                if frame_processor.NAME == "DLC.FACE-ENHANCER":
-                    if modules.globals.fp_ui["face_enhancer"]:
-                        temp_frame = frame_processor.process_frame_v2(temp_frame)
-                else:
-                    temp_frame = frame_processor.process_frame_v2(temp_frame)
-
-        # Calculate and display FPS
-        current_time = time.time()
-        frame_count += 1
-        if current_time - prev_time >= fps_update_interval:
-            fps = frame_count / (current_time - prev_time)
-            frame_count = 0
-            prev_time = current_time
-
-        if modules.globals.show_fps:
-            cv2.putText(
-                temp_frame,
-                f"FPS: {fps:.1f}",
-                (10, 30),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (0, 255, 0),
-                2,
-            )
+            display.show(temp_frame)
+            pipeline.stats.record(capture_time)
+        PREVIEW.after(LIVE_DISPLAY_INTERVAL, show_next_frame)
 
-        image = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
-        image = Image.fromarray(image)
-        image = ImageOps.contain(
-            image, (temp_frame.shape[1], temp_frame.shape[0]), Image.LANCZOS
-        )
-        image = ctk.CTkImage(image, size=image.size)
-        preview_label.configure(image=image)
-        ROOT.update()
-
-        if PREVIEW.state() == "withdrawn":
-            break
-
-    cap.release()
-    PREVIEW.withdraw()
+    show_next_frame()
 
 
 def create_source_target_popup_for_webcam(
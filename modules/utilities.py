@@ -5,6 +5,7 @@ import platform
 import shutil
 import ssl
 import subprocess
+import time
 import urllib
 from pathlib import Path
 from typing import List, Any
@@ -20,7 +21,7 @@ if platform.system().lower() == "darwin":
     ssl._create_default_https_context = ssl._create_unverified_context
 
 
-def run_ffmpeg(args: List[str]) -> bool:
+def get_ffmpeg_commands(args: List[str]) -> List[str]:
     commands = [
         "ffmpeg",
         "-hide_banner",
@@ -30,6 +31,11 @@ def run_ffmpeg(args: List[str]) -> bool:
         modules.globals.log_level,
     ]
     commands.extend(args)
+    return commands
+
+
+def run_ffmpeg(args: List[str]) -> bool:
+    commands = get_ffmpeg_commands(args)
     try:
         subprocess.check_output(commands, stderr=subprocess.STDOUT)
         return True
@@ -60,17 +66,54 @@ def detect_fps(target_path: str) -> float:
     return 30.0
 
 
-def extract_frames(target_path: str) -> None:
+def extract_frames(target_path: str, frame_gate: Any = None) -> bool:
+    """
+    Frames of the target into the temp directory. A frame_gate (see
+    predicter.FrameGate) sees every frame as soon as ffmpeg has written it,
+    extraction stops early and False is returned when the gate rejects.
+    """
     temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(
-        [
-            "-i",
-            target_path,
-            "-pix_fmt",
-            "rgb24",
-            os.path.join(temp_directory_path, "%04d.png"),
-        ]
+    args = [
+        "-i",
+        target_path,
+        "-pix_fmt",
+        "rgb24",
+        os.path.join(temp_directory_path, "%04d.png"),
+    ]
+    if frame_gate is None:
+        run_ffmpeg(args)
+        return True
+
+    process = subprocess.Popen(
+        get_ffmpeg_commands(args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
     )
+    frame_number = 1
+    try:
+        while True:
+            running = process.poll() is None
+            # ffmpeg writes frames in order, one is complete once the next exists
+            while os.path.isfile(
+                os.path.join(temp_directory_path, f"{frame_number + 1:04d}.png")
+            ) or (
+                not running
+                and os.path.isfile(
+                    os.path.join(temp_directory_path, f"{frame_number:04d}.png")
+                )
+            ):
+                frame_path = os.path.join(temp_directory_path, f"{frame_number:04d}.png")
+                if not frame_gate.add(frame_path):
+                    return False
+                frame_number += 1
+            if not running:
+                break
+            time.sleep(0.01)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return frame_gate.finish()
 
 
 def create_video(target_path: str, fps: float = 30.0) -> None:
@@ -120,7 +163,9 @@ def restore_audio(target_path: str, output_path: str) -> None:
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), "*.png")))
+    temp_frame_paths = glob.glob((os.path.join(glob.escape(temp_directory_path), "*.png")))
+    # %04d names grow past four digits on long videos, sort them numerically
+    return sorted(temp_frame_paths, key=lambda path: (len(os.path.basename(path)), os.path.basename(path)))
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Quantize the inswapper model to int8 for CPU inference.
+
+Calibrates on faces found in a directory of sample images, writes
+models/inswapper_128_int8.onnx and reports the speedup together with the
+quality delta, measured as the cosine similarity between the identity
+embeddings of the fp32 and int8 swap outputs.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from typing import Any, List, Tuple
+
+import cv2
+import insightface
+import numpy as np
+import onnxruntime
+from insightface.utils import face_align
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def load_sample_faces(samples_dir: str, face_analyser: Any, limit: int) -> List[Tuple[np.ndarray, Any]]:
+    samples = []
+    for image_path in sorted(glob.glob(os.path.join(glob.escape(samples_dir), "*"))):
+        if not image_path.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        frame = cv2.imread(image_path)
+        if frame is None:
+            continue
+        for face in face_analyser.get(frame):
+            samples.append((frame, face))
+            if len(samples) >= limit:
+                return samples
+    return samples
+
+
+def build_swapper_inputs(swapper: Any, frame: np.ndarray, target_face: Any, source_face: Any) -> dict:
+    # mirrors insightface INSwapper.get without the paste back
+    aligned, _ = face_align.norm_crop2(frame, target_face.kps, swapper.input_size[0])
+    blob = cv2.dnn.blobFromImage(
+        aligned,
+        1.0 / swapper.input_std,
+        swapper.input_size,
+        (swapper.input_mean, swapper.input_mean, swapper.input_mean),
+        swapRB=True,
+    )
+    latent = np.dot(source_face.normed_embedding.reshape((1, -1)), swapper.emap)
+    latent /= np.linalg.norm(latent)
+    return {swapper.input_names[0]: blob, swapper.input_names[1]: latent.astype(np.float32)}
+
+
+def build_calibration_inputs(swapper: Any, samples: List[Tuple[np.ndarray, Any]]) -> List[dict]:
+    # every sample face is swapped onto the next one so that source and
+    # target identities differ, like they do at inference time
+    inputs = []
+    for index, (frame, target_face) in enumerate(samples):
+        _, source_face = samples[(index + 1) % len(samples)]
+        inputs.append(build_swapper_inputs(swapper, frame, target_face, source_face))
+    return inputs
+
+
+class SwapperCalibrationDataReader(CalibrationDataReader):
+    def __init__(self, inputs: List[dict]):
+        self.inputs = iter(inputs)
+
+    def get_next(self) -> Any:
+        return next(self.inputs, None)
+
+
+def output_embeddings(recognizer: Any, outputs: List[np.ndarray]) -> np.ndarray:
+    images = []
+    for output in outputs:
+        image = np.clip(output[0].transpose((1, 2, 0)) * 255, 0, 255).astype(np.uint8)
+        # the 128px swap crop is the 112px arcface template shifted by 8px in x
+        # (estimate_norm uses ratio 1.0, diff_x 8 for size 128), not scaled
+        images.append(np.ascontiguousarray(cv2.cvtColor(image, cv2.COLOR_RGB2BGR)[:112, 8:120]))
+    embeddings = recognizer.get_feat(images)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def benchmark(model_path: str, inputs: List[dict], repeat: int) -> Tuple[float, List[np.ndarray]]:
+    session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    output_names = [output.name for output in session.get_outputs()]
+    outputs = [session.run(output_names, feed)[0] for feed in inputs]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for feed in inputs:
+            session.run(output_names, feed)
+    elapsed = (time.perf_counter() - start) / (repeat * len(inputs))
+    return elapsed * 1000, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the inswapper model to int8")
+    parser.add_argument("--samples", required=True, help="directory of sample images with faces used for calibration")
+    parser.add_argument("--model", default=os.path.join(MODELS_DIR, "inswapper_128.onnx"), help="fp32 inswapper model")
+    parser.add_argument("--output", default=os.path.join(MODELS_DIR, "inswapper_128_int8.onnx"), help="quantized model path")
+    parser.add_argument("--mode", default="static", choices=["static", "dynamic"], help="static uses the sample faces for calibration")
+    parser.add_argument("--max-faces", type=int, default=64, help="number of sample faces to calibrate and evaluate on")
+    parser.add_argument("--repeat", type=int, default=3, help="benchmark passes over the sample faces")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.model):
+        print(f"fp32 model not found: {args.model}")
+        return
+
+    face_analyser = insightface.app.FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
+    face_analyser.prepare(ctx_id=0, det_size=(640, 640))
+    swapper = insightface.model_zoo.get_model(args.model, providers=["CPUExecutionProvider"])
+
+    samples = load_sample_faces(args.samples, face_analyser, args.max_faces)
+    if len(samples) < 2:
+        print(f"At least 2 faces are required in {args.samples}")
+        return
+    inputs = build_calibration_inputs(swapper, samples)
+
+    print(f"Quantizing {args.model} ({args.mode}, {len(inputs)} faces)...")
+    if args.mode == "static":
+        quantize_static(
+            args.model,
+            args.output,
+            SwapperCalibrationDataReader(inputs),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+    else:
+        quantize_dynamic(args.model, args.output, weight_type=QuantType.QInt8)
+
+    recognizer = face_analyser.models["recognition"]
+    fp32_ms, fp32_outputs = benchmark(args.model, inputs, args.repeat)
+    int8_ms, int8_outputs = benchmark(args.output, inputs, args.repeat)
+    fp32_embeddings = output_embeddings(recognizer, fp32_outputs)
+    int8_embeddings = output_embeddings(recognizer, int8_outputs)
+    source_embeddings = np.array([samples[(index + 1) % len(samples)][1].normed_embedding for index in range(len(samples))])
+
+    output_similarity = np.sum(fp32_embeddings * int8_embeddings, axis=1)
+    report = {
+        "faces": len(inputs),
+        "mode": args.mode,
+        "fp32_ms": round(fp32_ms, 2),
+        "int8_ms": round(int8_ms, 2),
+        "speedup": round(fp32_ms / int8_ms, 2),
+        "fp32_vs_int8_similarity_mean": round(float(output_similarity.mean()), 4),
+        "fp32_vs_int8_similarity_min": round(float(output_similarity.min()), 4),
+        "fp32_source_similarity_mean": round(float(np.sum(fp32_embeddings * source_embeddings, axis=1).mean()), 4),
+        "int8_source_similarity_mean": round(float(np.sum(int8_embeddings * source_embeddings, axis=1).mean()), 4),
+    }
+    print(json.dumps(report, indent=2))
+    print(f"Saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()